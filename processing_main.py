@@ -6,61 +6,72 @@ from roi_rectangle import RoiRectangle
 
 from src.logger import setup_logger, Logger
 from src.processor.core import CoreProcessor
-from src.processor.loader import HDF5FileLoader
-from src.processor.saver import SaverStrategy, get_saver_strategy
+from src.processor.cache import PreprocessCache
+from src.processor.async_saver import AsyncSaver
+from src.processor.loader import HDF5FileLoader, get_hdf5_images
+from src.processor.saver import SaverStrategy, get_saver_strategy, get_file_base_name
 from src.preprocessor.image_qbpm_preprocessor import (
     compose,
     subtract_dark_background,
+    create_dark_background_subtractor,
     create_pohang,
     ImagesQbpmProcessor
 )
-from src.gui.roi import get_roi_auto, get_hdf5_images, RoiSelector
-from src.utils.file_util import get_folder_list, get_run_scan_directory, get_file_list
+from src.gui.roi import get_roi_auto, RoiSelector
+from src.processor.scan_index import get_scan_index
+from src.inspection.hdf5_validator import validate_run, get_bad_files
+from src.utils.file_util import get_run_scan_directory, get_roi_list
+from src.utils.catalog import get_catalog
+from src.utils.roi_util import union_roi_rect, to_local_roi_rect
+from src.utils.memory_tracer import MemoryTracer
+from src.utils import metrics
 from src.config.config import load_config, ExpConfig
 
 
 logger: Logger = setup_logger()
 config: ExpConfig = load_config()
+# Set XFEL_TRACE_MEMORY=1 to record the memory use of every stage (slower)
+TRACE_MEMORY: bool = os.environ.get("XFEL_TRACE_MEMORY", "") not in ("", "0")
+# Set XFEL_CROP_TO_ROIS=1 to only process and save the union of the ROIs of the scans with a 'ROI_coords.json'
+CROP_TO_ROIS: bool = os.environ.get("XFEL_CROP_TO_ROIS", "") not in ("", "0")
 
 def get_scan_nums(run_num: int) -> list[int]:
-    """Get Scan numbers from real directory"""
-    run_dir: str = get_run_scan_directory(config.path.load_dir, run_num)
-    scan_folders: list[str] = get_folder_list(run_dir)
-    return [int(scan_dir.split("=")[1]) for scan_dir in scan_folders]
+    """Get Scan numbers from the raw data catalog"""
+    catalog = get_catalog()
+    catalog.refresh(runs=[run_num])
+    return catalog.scans(run_num)
 
 
 def get_roi(scan_dir: str, index_mode: Optional[int] = None) -> RoiRectangle:
     """Get Roi for QBPM Normalization"""
-    files = get_file_list(scan_dir)
+    files = get_scan_index(scan_dir).files()
 
     if index_mode is None:
         index = len(files) // 2
     else:
         index = index_mode
 
-    file: str = os.path.join(scan_dir, files[index])
-    image = get_hdf5_images(file, config).sum(axis=0)
+    image = get_hdf5_images(files[index], config).sum(axis=0)
     return get_roi_auto(image)
 
 
 def select_roi(scan_dir: str, index_mode: Optional[int] = None) -> RoiRectangle:
     """Get Roi for QBPM Normalization"""
-    files = get_file_list(scan_dir)
-    files.sort(key=lambda name: int(name[1:-3]))
+    files = get_scan_index(scan_dir).files()
     if index_mode is None:
         index = len(files) // 2
     else:
         index = index_mode
 
-    file: str = os.path.join(scan_dir, files[index])
-    image = get_hdf5_images(file, config).sum(axis=0)
+    image = get_hdf5_images(files[index], config).sum(axis=0)
     return RoiRectangle.from_tuple(RoiSelector().select_roi(np.log1p(image)))
 
 
-def setup_preprocessors(scan_dir: str) -> dict[str, ImagesQbpmProcessor]:
-    """Return preprocessors"""
+def setup_preprocessors(scan_dir: str, roi_rect: Optional[RoiRectangle] = None) -> dict[str, ImagesQbpmProcessor]:
+    """Return preprocessors, normalizing with `roi_rect` or a ROI selected on the scan"""
 
-    roi_rect = select_roi(scan_dir, None)
+    if roi_rect is None:
+        roi_rect = select_roi(scan_dir, None)
     if roi_rect is None:
         raise ValueError(f"No ROI Rectangle Set for {scan_dir}")
     logger.info(f"ROI rectangle: {roi_rect.to_tuple()}")
@@ -74,24 +85,74 @@ def setup_preprocessors(scan_dir: str) -> dict[str, ImagesQbpmProcessor]:
     }
 
 
-def process_scan(run_n: int, scan_n: int) -> None:
-    """Process Single Scan"""
+def setup_cropped_preprocessors(roi_rects: list[RoiRectangle]) -> dict[str, ImagesQbpmProcessor]:
+    """
+    Return preprocessors working on images cropped to the union of `roi_rects`.
+    The first ROI normalizes the shots, like the selected ROI of `setup_preprocessors`.
+    """
+
+    crop_rect = union_roi_rect(roi_rects)
+    logger.info(f"Crop rectangle: {crop_rect}")
+    pohang = create_pohang(to_local_roi_rect(roi_rects[0], crop_rect))
+    subtract_cropped_dark_background = create_dark_background_subtractor(crop_rect)
+
+    new_standard = compose(pohang, subtract_cropped_dark_background)
+
+    return {
+        "new_standard": new_standard,
+    }
+
+
+def process_scan(
+    run_n: int,
+    scan_n: int,
+    roi_rects: Optional[list[RoiRectangle]] = None,
+    async_saver: Optional[AsyncSaver] = None,
+    bad_files: Optional[set[str]] = None,
+    roi_rect: Optional[RoiRectangle] = None
+) -> None:
+    """
+    Process Single Scan
+
+    If `roi_rects` is given, only the union of the ROIs is processed and saved.
+    Otherwise the full frames are, normalized with `roi_rect`, or a ROI selected on the scan if it is None.
+    If `async_saver` is given, the outputs are written in the background.
+    Files in `bad_files` are skipped.
+    With `TRACE_MEMORY`, the memory use by stage is logged and written to 'memory/run=XXXX_scan=XXXX.json'
+    in the output directory.
+    """
 
     load_dir = config.path.load_dir
     scan_dir = get_run_scan_directory(load_dir, run_n, scan_n)
 
-    preprocessors: dict[str, ImagesQbpmProcessor] = setup_preprocessors(scan_dir)
+    if roi_rects:
+        preprocessors: dict[str, ImagesQbpmProcessor] = setup_cropped_preprocessors(roi_rects)
+    else:
+        preprocessors: dict[str, ImagesQbpmProcessor] = setup_preprocessors(scan_dir, roi_rect)
 
     for preprocessor_name in preprocessors:
         logger.info(f"preprocessor: {preprocessor_name}")
-    processor: CoreProcessor = CoreProcessor(HDF5FileLoader, scan_dir, preprocessors, logger)
+
+    dark_file: str = os.path.join(config.path.analysis_dir, "DARK/dark.npy")
+    cache: PreprocessCache = PreprocessCache(config.path.cache_dir, dependencies=[dark_file])
+    memory_tracer: Optional[MemoryTracer] = MemoryTracer(logger=logger) if TRACE_MEMORY else None
+    with metrics.timer("processing.scan", run=run_n, scan=scan_n):
+        processor: CoreProcessor = CoreProcessor(
+            HDF5FileLoader, scan_dir, preprocessors, logger, cache, roi_rects,
+            skip_files=bad_files, memory_tracer=memory_tracer
+        )
+    if memory_tracer is not None:
+        memory_tracer.log_summary()
+        memory_file = os.path.join(config.path.output_dir, "memory", f"{get_file_base_name(run_n, scan_n)}.json")
+        memory_tracer.write_report(memory_file)
+        logger.info(f"Memory report written to '{memory_file}'")
 
     # Set SaverStrategy
     npz_saver: SaverStrategy = get_saver_strategy("npz")
-    processor.save(npz_saver, run_n, scan_n)
+    processor.save(npz_saver, run_n, scan_n, async_saver)
 
     mat_saver: SaverStrategy = get_saver_strategy("mat")
-    processor.save(mat_saver, run_n, scan_n)
+    processor.save(mat_saver, run_n, scan_n, async_saver)
 
     logger.info(f"Processing run={run_n}, scan={scan_n} is complete")
 
@@ -100,18 +161,31 @@ def main() -> None:
     """Processing"""
 
     run_nums: list[int] = config.runs
+    logger.info(f"Config:\n{config}")
     logger.info(f"Runs to process: {run_nums}")
 
-    for run_num in run_nums: # pylint: disable=not-an-iterable
-        logger.info(f"Run: {run_num}")
-        scan_nums: list[int] = get_scan_nums(run_num)
-        for scan_num in scan_nums:
-            try:
-                process_scan(run_num, scan_num)
-            except Exception:
-                logger.exception(f"Failed to process run={run_num}, scan={scan_num}")
-                raise
-
+    # Outputs are written in the background while the next scan is processed
+    with AsyncSaver(logger=logger) as async_saver:
+        for run_num in run_nums: # pylint: disable=not-an-iterable
+            logger.info(f"Run: {run_num}")
+            # Validate every file up front (cached by mtime) instead of failing in the middle of the run
+            bad_files: set[str] = get_bad_files(validate_run(run_num))
+            if bad_files:
+                logger.warning(f"Skipping {len(bad_files)} invalid files of run={run_num}: {sorted(bad_files)}")
+            scan_nums: list[int] = get_scan_nums(run_num)
+            for scan_num in scan_nums:
+                roi_rects: Optional[list[RoiRectangle]] = None
+                if CROP_TO_ROIS:
+                    # Crop to the ROIs in 'ROI_coords.json' when the scan has one
+                    roi_dir: str = get_run_scan_directory(config.path.analysis_dir, run_num, scan_num)
+                    roi_rects = get_roi_list(roi_dir)
+                try:
+                    process_scan(run_num, scan_num, roi_rects, async_saver, bad_files)
+                except Exception:
+                    logger.exception(f"Failed to process run={run_num}, scan={scan_num}")
+                    raise
+
+    logger.info(f"Metrics: {metrics.summary()}")
     logger.info("All processing is complete")
 
 
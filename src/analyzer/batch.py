@@ -0,0 +1,157 @@
+"""
+Analyze many ROIs over many processed scans at once.
+
+Each scan is opened once and all of its ROIs are evaluated in one vectorized pass
+(`DataAnalyzer.scan_rois`), a few frames at a time so that a worker holds about one
+image stack. Scans run in parallel worker processes and the results are
+returned as one long-format DataFrame indexed by (run, scan, roi, delay), with the
+center of mass and intensity columns of `DataAnalyzer.analyze_by_roi`.
+
+Example usage:
+    df = analyze_rois([(154, 1), (154, 2)])  # ROIs from each scan's 'ROI_coords.json'
+    df.xs(0, level="roi")["poff_com_x"].unstack(["run", "scan"]).plot()
+"""
+import os
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from roi_rectangle import RoiRectangle
+
+from src.analyzer.core import DataAnalyzer
+from src.config.config import load_config
+from src.logger import setup_logger, Logger
+from src.processor.saver import get_file_base_name
+from src.utils.file_util import get_run_scan_directory, get_roi_list
+from src.utils.math_util import mul_delta_q
+from src.utils.roi_util import roi_rects_to_array, array_to_roi_rects
+
+
+INDEX_NAMES: list[str] = ["run", "scan", "roi", "delay"]
+
+
+def get_processed_file(run_n: int, scan_n: int, file_type: str = "npz", comment: str = "") -> str:
+    """Return the path of a processed file written by the npz or h5 SaverStrategy."""
+    config = load_config()
+    comment = "_" + comment if comment else ""
+    scan_dir = get_run_scan_directory(config.path.processed_dir, run_n, scan_n)
+    return os.path.join(scan_dir, f"{get_file_base_name(run_n, scan_n)}{comment}.{file_type}")
+
+
+def analyze_scan_rois(
+    file: str,
+    roi_rects: npt.NDArray,
+    angle: int = 0,
+    lazy: bool = False
+) -> pd.DataFrame:
+    """
+    Analyze every ROI of one processed scan in one pass.
+
+    Parameters:
+        file (str): Processed npz or h5 file.
+        roi_rects (npt.NDArray): (K, 4) array of (x1, y1, x2, y2) in detector coordinates.
+        angle (int): Rotation angle passed to `DataAnalyzer`.
+        lazy (bool): Open the file lazily.
+
+    Returns:
+        pd.DataFrame: Rows for every (roi, delay), indexed by ('roi', 'delay').
+    """
+    analyzer = DataAnalyzer(file, angle, lazy)
+    local_rois = roi_rects_to_array(analyzer.to_local_roi_rect(roi_rect) for roi_rect in array_to_roi_rects(roi_rects))
+    # The tables are not reused, so they are not kept for the whole stack
+    result = analyzer.scan_rois(local_rois, keep_index=False)
+
+    columns: dict[str, npt.NDArray] = {}
+    for name in ("poff", "pon"):
+        com_x, com_y = result[f"{name}_com_x"], result[f"{name}_com_y"]
+        intensity = result[f"{name}_intensity"]
+        columns[f"{name}_com_x"] = mul_delta_q(com_x - com_x[:, :1])
+        columns[f"{name}_com_y"] = mul_delta_q(com_y - com_y[:, :1])
+        columns[f"{name}_intensity"] = intensity / intensity[:, :1]
+
+    n_rois, n_delays = len(roi_rects), len(analyzer.delay)
+    index = pd.MultiIndex.from_arrays(
+        [np.repeat(np.arange(n_rois), n_delays), np.tile(analyzer.delay, n_rois)],
+        names=["roi", "delay"]
+    )
+    roi_df = pd.DataFrame({key: val.ravel() for key, val in columns.items()}, index=index)
+    for i, coord in enumerate(("roi_x1", "roi_y1", "roi_x2", "roi_y2")):
+        roi_df[coord] = np.repeat(roi_rects[:, i], n_delays)
+    return roi_df
+
+
+def analyze_rois(
+    scans: Iterable[tuple[int, int]],
+    roi_rects: Optional[list[RoiRectangle]] = None,
+    file_type: str = "npz",
+    comment: str = "",
+    angle: int = 0,
+    lazy: bool = False,
+    max_workers: Optional[int] = None,
+    logger: Optional[Logger] = None
+) -> pd.DataFrame:
+    """
+    Analyze many ROIs over many processed scans, one worker process per scan.
+
+    Parameters:
+        scans (Iterable[tuple[int, int]]): (run, scan) numbers.
+        roi_rects (list[RoiRectangle], optional): ROIs in detector coordinates used for every scan.
+            By default each scan uses the ROIs saved with `save_roi_list` in its analysis directory.
+        file_type (str): Type of the processed files, 'npz' or 'h5'.
+        comment (str): Comment of the processed files.
+        angle (int): Rotation angle passed to `DataAnalyzer`.
+        lazy (bool): Open the files lazily, so that workers only read the frames being indexed.
+        max_workers (int, optional): Number of worker processes. 1 runs in this process.
+        logger (Logger, optional): Logger for skipped and failed scans.
+
+    Returns:
+        pd.DataFrame: Long-format results indexed by ('run', 'scan', 'roi', 'delay').
+            Scans without ROIs, processed file or whose analysis failed are skipped.
+    """
+    config = load_config()
+    logger = logger if logger is not None else setup_logger()
+
+    tasks: list[tuple[int, int, str, npt.NDArray]] = []
+    for run_n, scan_n in scans:
+        scan_roi_rects = roi_rects
+        if scan_roi_rects is None:
+            scan_roi_rects = get_roi_list(get_run_scan_directory(config.path.analysis_dir, run_n, scan_n))
+        if not scan_roi_rects:
+            logger.warning(f"No ROIs for run={run_n}, scan={scan_n}")
+            continue
+        file = get_processed_file(run_n, scan_n, file_type, comment)
+        if not os.path.exists(file):
+            logger.warning(f"No processed file '{file}'")
+            continue
+        tasks.append((run_n, scan_n, file, roi_rects_to_array(scan_roi_rects)))
+
+    frames: dict[tuple[int, int], pd.DataFrame] = {}
+    if max_workers == 1:
+        for run_n, scan_n, file, rois in tasks:
+            try:
+                frames[(run_n, scan_n)] = analyze_scan_rois(file, rois, angle, lazy)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception(f"Failed to analyze run={run_n}, scan={scan_n}")
+    else:
+        with ProcessPoolExecutor(max_workers) as executor:
+            futures = {
+                (run_n, scan_n): executor.submit(analyze_scan_rois, file, rois, angle, lazy)
+                for run_n, scan_n, file, rois in tasks
+            }
+            for (run_n, scan_n), future in futures.items():
+                try:
+                    frames[(run_n, scan_n)] = future.result()
+                except Exception:  # pylint: disable=broad-exception-caught
+                    logger.exception(f"Failed to analyze run={run_n}, scan={scan_n}")
+
+    if not frames:
+        return pd.DataFrame(index=pd.MultiIndex.from_arrays([[]] * 4, names=INDEX_NAMES))
+    return pd.concat(frames, names=["run", "scan"])
+
+
+if __name__ == "__main__":
+    roi_df = analyze_rois([(154, 1)])
+    print(roi_df)
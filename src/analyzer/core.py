@@ -1,43 +1,85 @@
 import os
 from collections.abc import Mapping
+from typing import Optional, Union
 
 import numpy as np
 import numpy.typing as npt
 import pandas as pd
 from scipy.ndimage import rotate
-from scipy.optimize import curve_fit
 from roi_rectangle import RoiRectangle
 
-from src.utils.math_util import gaussian, mul_delta_q
+from src.analyzer.loader import load_processed_data, append_processed_data
+from src.analyzer.lazy_stack import LazyImageStack
+from src.analyzer.roi_index import RoiSumIndex, roi_index_key, query_stack
+from src.analyzer.roi_tracker import RoiTracker, gather_moving_rois
+from src.preprocessor.registration import estimate_shifts, shift_images
+from src.analyzer.gaussian_fitter import fit_gaussian_1d
+from src.utils.math_util import mul_delta_q
+from src.utils.roi_util import shift_roi_rect, array_to_roi_rects, roi_rects_to_array
 
 
 class DataAnalyzer:
     """
     Analyzes data from a given file and performs various operations on the images.
 
+    Files processed in ROI cropping mode hold images cropped to the union of the analysis ROIs.
+    Their ROIs in detector coordinates are converted with `to_local_roi_rect`.
+
+    With `lazy`, the stacks are memory-mapped (npz) or read from chunks (h5) as `LazyImageStack`s:
+    opening is instant and only the regions that are indexed, e.g. `roi_rect.slice(self.poff_images)`,
+    are read, rotated and clipped.
+
+    ROI intensities and centers of mass are answered from summed-area tables (`RoiSumIndex`)
+    once they are built with `build_roi_index` or stored in the file with `save_roi_index`.
+
     Args:
-        file (str): The path to the file containing the data.
+        file (str): The path to the processed npz or h5 file containing the data.
         angle (int, optional): The angle to rotate the images. Defaults to 0.
+        lazy (bool, optional): Load the images lazily. Defaults to False.
 
     Raises:
         FileNotFoundError: If the file does not exist.
         ValueError: If the file does not contain the required keys.
     """
-    def __init__(self, file: str, angle: int = 0) -> None:
+    # Number of ROIs from which `scan_rois` builds the summed-area tables by default
+    INDEX_MIN_ROIS: int = 16
+
+    def __init__(self, file: str, angle: int = 0, lazy: bool = False) -> None:
         if not os.path.exists(file):
             raise FileNotFoundError(f"The file {file} does not exist.")
+        self.file: str = file
+        self.angle: int = angle
+        self.lazy: bool = lazy
+        self.drift: Optional[npt.NDArray] = None
 
-        data: Mapping[str, npt.NDArray] = np.load(file)
+        data: Mapping[str, npt.NDArray] = load_processed_data(file, lazy)
 
         if "delay" not in data or "pon" not in data or "poff" not in data:
             raise ValueError(
                 "The file does not contain the required keys: 'delay', 'pon', 'poff'"
             )
 
-        self.delay: npt.NDArray = data["delay"]
+        self.delay: npt.NDArray = np.asarray(data["delay"])
         self.poff_images: npt.NDArray = data["poff"]
         self.pon_images: npt.NDArray = data["pon"]
 
+        self.crop_origin: tuple[int, int] = tuple(int(v) for v in data["crop_origin"]) if "crop_origin" in data else (0, 0)
+        self.roi_rects: list[RoiRectangle] = array_to_roi_rects(data["roi_rects"]) if "roi_rects" in data else []
+        self.full_frame: npt.NDArray = data["full_frame"] if "full_frame" in data else None
+
+        # Stored indices are memory-mapped in lazy mode, so queries only read the looked up entries
+        self.roi_indices: dict[str, RoiSumIndex] = {
+            name: RoiSumIndex(np.asarray(data[roi_index_key(name, angle)]))
+            for name in ("poff", "pon")
+            if roi_index_key(name, angle) in data
+        }
+        self._stored_roi_indices: set[str] = set(self.roi_indices)
+
+        if lazy:
+            self.poff_images = LazyImageStack(self.poff_images, angle)
+            self.pon_images = LazyImageStack(self.pon_images, angle)
+            return
+
         if angle:
             self.poff_images = rotate(self.poff_images, angle, axes=(1, 2), reshape=False)
             self.pon_images = rotate(self.pon_images, angle, axes=(1, 2), reshape=False)
@@ -45,6 +87,35 @@ class DataAnalyzer:
         self.poff_images = np.maximum(0, self.poff_images)
         self.pon_images = np.maximum(0, self.pon_images)
 
+    def to_local_roi_rect(self, roi_rect: RoiRectangle) -> RoiRectangle:
+        """Convert a ROI in detector coordinates to the coordinates of the (cropped) images."""
+        return shift_roi_rect(roi_rect, -self.crop_origin[0], -self.crop_origin[1])
+
+    def correct_drift(self, roi_rect: RoiRectangle, apply: bool = True) -> npt.NDArray:
+        """
+        Estimate the drift of the delay frames by phase correlation and optionally remove it.
+
+        The shifts are measured on the pump off ROI against its mean over the delays and the
+        same shifts are applied to pump off and pump on, so pump induced changes are kept.
+        `roi_rect` should hold a feature that does not move with the delay.
+
+        Parameters:
+            roi_rect (RoiRectangle): Region used for the registration, in image coordinates.
+            apply (bool): Shift the images back. Otherwise only the drift trace is returned.
+
+        Returns:
+            npt.NDArray: Drift trace (N, 2) as (dy, dx) in pixels.
+        """
+        roi_images = np.asarray(roi_rect.slice(self.poff_images), dtype=np.float32)
+        drift = estimate_shifts(roi_images, roi_images.mean(axis=0))
+        if apply:
+            self.poff_images = np.maximum(0, shift_images(np.asarray(self.poff_images), -drift))
+            self.pon_images = np.maximum(0, shift_images(np.asarray(self.pon_images), -drift))
+            # Indices of the uncorrected images no longer apply
+            self.roi_indices = {}
+            self.drift = drift
+        return drift
+
     def get_summed_image(self) -> tuple[npt.NDArray, npt.NDArray]:
         """
         return:
@@ -54,13 +125,95 @@ class DataAnalyzer:
 
     def pon_subtract_by_poff(self):
         """Subtrack pump on images by pump off images"""
-        return np.maximum(self.pon_images - self.poff_images, 0)
+        return np.maximum(np.asarray(self.pon_images) - np.asarray(self.poff_images), 0)
+
+    def build_roi_index(self) -> dict[str, RoiSumIndex]:
+        """Build the summed-area table indices of the pump off and pump on stacks."""
+        for name in ("poff", "pon"):
+            if name not in self.roi_indices:
+                self.roi_indices[name] = RoiSumIndex.from_images(getattr(self, f"{name}_images"))
+        return self.roi_indices
+
+    def save_roi_index(self) -> None:
+        """
+        Build the indices if needed and store the ones missing from the processed file.
+
+        Raises:
+            ValueError: For h5 files opened with `lazy`, which keep the file open read-only.
+        """
+        if self.drift is not None:
+            raise ValueError("The images were drift corrected, the ROI index would not match the file")
+        if self.lazy and self.file.endswith(".h5"):
+            raise ValueError("Open the h5 file without lazy to store the ROI index in it")
+        keys = [name for name in ("poff", "pon") if name not in self._stored_roi_indices]
+        self.build_roi_index()
+        append_processed_data(self.file, {
+            roi_index_key(name, self.angle): self.roi_indices[name].tables for name in keys
+        })
+        self._stored_roi_indices.update(keys)
+
+    def _get_roi_index(self, images: npt.NDArray) -> Optional[RoiSumIndex]:
+        for name in ("poff", "pon"):
+            if images is getattr(self, f"{name}_images"):
+                return self.roi_indices.get(name)
+        return None
+
+    def scan_rois(
+        self,
+        roi_rects: Union[list[RoiRectangle], npt.NDArray],
+        use_index: Optional[bool] = None,
+        keep_index: bool = True
+    ) -> dict[str, npt.NDArray]:
+        """
+        Return the intensity and center of mass of many candidate ROIs for every delay.
+
+        Parameters:
+            roi_rects (list[RoiRectangle] | npt.NDArray): ROIs, or an (K, 4) array of (x1, y1, x2, y2).
+            use_index (bool, optional): Answer from the summed-area tables, building them if needed.
+                By default they are used when already available or for at least `INDEX_MIN_ROIS` ROIs,
+                otherwise every ROI is sliced directly.
+            keep_index (bool): Keep the built tables for later queries. Otherwise tables that are not
+                available are built a few frames at a time and dropped, which bounds the memory.
+
+        Returns:
+            dict[str, npt.NDArray]: '{poff,pon}_{intensity,com_x,com_y}' arrays of shape (K, N),
+            unnormalized and in pixels relative to each ROI origin.
+        """
+        rois = roi_rects if isinstance(roi_rects, np.ndarray) else roi_rects_to_array(roi_rects)
+        if use_index is None:
+            use_index = len(self.roi_indices) == 2 or len(rois) >= self.INDEX_MIN_ROIS
+
+        result: dict[str, npt.NDArray] = {}
+        if use_index:
+            roi_indices = self.build_roi_index() if keep_index else self.roi_indices
+            for name in ("poff", "pon"):
+                if name in roi_indices:
+                    query = roi_indices[name].query_many(rois)
+                else:
+                    query = query_stack(getattr(self, f"{name}_images"), rois)
+                for key, val in query.items():
+                    result[f"{name}_{key}"] = val
+            return result
+
+        for name in ("poff", "pon"):
+            images = getattr(self, f"{name}_images")
+            coms = [self._roi_center_of_masses(roi_rect, images) for roi_rect in array_to_roi_rects(rois)]
+            result[f"{name}_intensity"] = np.stack(
+                [self._roi_intensities(roi_rect, images) for roi_rect in array_to_roi_rects(rois)]
+            )
+            result[f"{name}_com_x"] = np.stack([com[0] for com in coms])
+            result[f"{name}_com_y"] = np.stack([com[1] for com in coms])
+        return result
 
     def _roi_center_of_masses(
         self,
         roi_rect: RoiRectangle,
         images: npt.NDArray
     ) -> tuple[npt.NDArray, npt.NDArray]:
+        roi_index = self._get_roi_index(images)
+        if roi_index is not None:
+            return roi_index.center_of_mass(roi_rect)
+
         roi_images = roi_rect.slice(images)
         height, width = roi_rect.height, roi_rect.width
 
@@ -77,49 +230,32 @@ class DataAnalyzer:
         roi_rect: RoiRectangle,
         images: npt.NDArray
     ) -> tuple[npt.NDArray, npt.NDArray, npt.NDArray]:
+        """
+        Fit Gaussians to the x and y projections of the ROI of every delay at once.
 
-        roi_images = roi_rect.slice(images)
-        height, width = roi_rect.height, roi_rect.width
-
-        intensities = []
-        com_xs = []
-        com_ys = []
-
-        for image in roi_images:
-            max_y, max_x = np.unravel_index(np.argmax(image), image.shape)
-            # max_y, max_x = height // 2, width // 2
-
-            x: npt.NDArray = np.arange(0, width)
-            y: npt.NDArray = np.arange(0, height)
-
-            x_data = image.sum(axis=0)
-            y_data = image.sum(axis=1)
-
-            initial_guess_x = [x_data[max_x], max_x, (np.max(x_data) - np.min(x_data)) / 4]
-            try:
-                params_x = curve_fit(gaussian, x, x_data, p0=initial_guess_x)[0]
-            except RuntimeError as e:
-                print(e, ": x")
-                params_x = [np.nan, np.nan, np.nan]
-
-            initial_guess_y = [y_data[max_y], max_y, (np.max(y_data) - np.min(y_data)) / 4]
-            try:
-                params_y = curve_fit(gaussian, y, y_data, p0=initial_guess_y)[0]
-            except RuntimeError as e:
-                print(e, ": y")
-                params_y = [np.nan, np.nan, np.nan]
-
-            gaussian_a_x, gaussain_com_x, _ = params_x
-            gaussian_a_y, gaussain_com_y, _ = params_y
+        Returns:
+            intensity (geometric mean of the x and y amplitudes), center x, center y.
+            Delays whose fit did not converge are NaN.
+        """
+        roi_images = np.asarray(roi_rect.slice(images), dtype=np.float64)
+        height, width = roi_images.shape[1:]
 
-            gaussian_a = np.sqrt(gaussian_a_x * gaussian_a_y)
-            intensities.append(gaussian_a)
-            com_xs.append(gaussain_com_x)
-            com_ys.append(gaussain_com_y)
+        fit_x = fit_gaussian_1d(np.arange(width), roi_images.sum(axis=1))
+        fit_y = fit_gaussian_1d(np.arange(height), roi_images.sum(axis=2))
+        converged = fit_x.converged & fit_y.converged
 
-        return np.stack(intensities), np.stack(com_xs), np.stack(com_ys)
+        with np.errstate(invalid="ignore"):
+            intensities = np.sqrt(fit_x["amplitude"] * fit_y["amplitude"])
+        intensities = np.where(converged, intensities, np.nan)
+        com_xs = np.where(converged, fit_x["center"], np.nan)
+        com_ys = np.where(converged, fit_y["center"], np.nan)
+        return intensities, com_xs, com_ys
 
     def _roi_intensities(self, roi_rect: RoiRectangle, images: npt.NDArray):
+        roi_index = self._get_roi_index(images)
+        if roi_index is not None:
+            return roi_index.intensity(roi_rect)
+
         roi_images = roi_rect.slice(images)
 
         return roi_images.mean(axis=(1, 2))
@@ -131,8 +267,8 @@ class DataAnalyzer:
         pon_com_x, pon_com_y = self._roi_center_of_masses(roi_rect, self.pon_images)
         pon_intensity = self._roi_intensities(roi_rect, self.pon_images)
 
-        # poff_guassain_intensity, poff_gussian_com_x, poff_gussian_com_y = self._roi_gaussian(roi_rect, self.poff_images)
-        # pon_guassain_intensity, pon_gussian_com_x, pon_gussian_com_y = self._roi_gaussian(roi_rect, self.pon_images)
+        poff_gaussian_intensity, poff_gaussian_com_x, poff_gaussian_com_y = self._roi_gaussian(roi_rect, self.poff_images)
+        pon_gaussian_intensity, pon_gaussian_com_x, pon_gaussian_com_y = self._roi_gaussian(roi_rect, self.pon_images)
 
         roi_df = pd.DataFrame(data={
             "poff_com_x": mul_delta_q(poff_com_x - poff_com_x[0]),
@@ -142,16 +278,64 @@ class DataAnalyzer:
             "pon_com_y": mul_delta_q(pon_com_y - pon_com_y[0]),
             "pon_intensity": pon_intensity / pon_intensity[0],
 
-            # "poff_gussian_com_x": poff_gussian_com_x,
-            # "poff_gussian_com_y": poff_gussian_com_y,
-            # "poff_guassain_intensity": poff_guassain_intensity / poff_guassain_intensity[0],
+            "poff_gaussian_com_x": mul_delta_q(poff_gaussian_com_x - poff_gaussian_com_x[0]),
+            "poff_gaussian_com_y": mul_delta_q(poff_gaussian_com_y - poff_gaussian_com_y[0]),
+            "poff_gaussian_intensity": poff_gaussian_intensity / poff_gaussian_intensity[0],
+            "pon_gaussian_com_x": mul_delta_q(pon_gaussian_com_x - pon_gaussian_com_x[0]),
+            "pon_gaussian_com_y": mul_delta_q(pon_gaussian_com_y - pon_gaussian_com_y[0]),
+            "pon_gaussian_intensity": pon_gaussian_intensity / pon_gaussian_intensity[0],
+        })
 
-            # "pon_gussian_com_x": pon_gussian_com_x,
-            # "pon_gussian_com_y": pon_gussian_com_y,
-            # "pon_guassain_intensity": pon_guassain_intensity / pon_guassain_intensity[0],
+        roi_df = roi_df.set_index(self.delay)
+        return roi_df
 
-        })
+    def _moving_roi_values(
+        self,
+        tracker: RoiTracker,
+        images: npt.NDArray
+    ) -> tuple[npt.NDArray, npt.NDArray, npt.NDArray, npt.NDArray, npt.NDArray]:
+        peak_x, peak_y = tracker.track(images)
+        roi_images, origins = gather_moving_rois(images, tracker.rects_at(peak_x, peak_y))
+        height, width = roi_images.shape[1:]
+        y_coords, x_coords = np.mgrid[:height, :width]
+
+        total_mass = roi_images.sum(axis=(1, 2))
+        com_x = origins[:, 0] + (x_coords * roi_images).sum(axis=(1, 2)) / total_mass
+        com_y = origins[:, 1] + (y_coords * roi_images).sum(axis=(1, 2)) / total_mass
+        return peak_x, peak_y, com_x, com_y, roi_images.mean(axis=(1, 2))
 
+    def analyze_by_moving_roi(
+        self,
+        roi_rect: RoiRectangle,
+        search_margin: int = 10,
+        method: str = "com"
+    ) -> pd.DataFrame:
+        """
+        Analyze a ROI that follows a drifting peak through the delays.
+
+        The peak of every delay frame is tracked with `RoiTracker` and a ROI of the size of
+        `roi_rect` centered on it is integrated. Pump off and pump on are tracked separately.
+
+        Parameters:
+            roi_rect (RoiRectangle): Initial ROI around the peak.
+            search_margin (int): Pixels around `roi_rect` in which the peak is searched.
+            method (str): Sub-pixel refinement of `RoiTracker`, 'com' or 'parabolic'.
+
+        Returns:
+            pd.DataFrame: Tracked peak position, center of mass and intensity relative to the
+            first delay, with the columns of `analyze_by_roi` and '{poff,pon}_peak_{x,y}'.
+        """
+        tracker = RoiTracker(roi_rect, search_margin, method)
+        data: dict[str, npt.NDArray] = {}
+        for name in ("poff", "pon"):
+            peak_x, peak_y, com_x, com_y, intensity = self._moving_roi_values(tracker, getattr(self, f"{name}_images"))
+            data[f"{name}_com_x"] = mul_delta_q(com_x - com_x[0])
+            data[f"{name}_com_y"] = mul_delta_q(com_y - com_y[0])
+            data[f"{name}_intensity"] = intensity / intensity[0]
+            data[f"{name}_peak_x"] = mul_delta_q(peak_x - peak_x[0])
+            data[f"{name}_peak_y"] = mul_delta_q(peak_y - peak_y[0])
+
+        roi_df = pd.DataFrame(data=data)
         roi_df = roi_df.set_index(self.delay)
         return roi_df
 
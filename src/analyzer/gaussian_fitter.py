@@ -0,0 +1,259 @@
+"""
+Batched Gaussian fitting.
+
+Every frame of a stack is fitted at once with a vectorized Levenberg-Marquardt solver,
+instead of calling `curve_fit` once per frame. Initial guesses come from the moments of
+the data and each frame has its own damping factor and convergence flag.
+
+Example usage:
+    fit = fit_gaussian_1d(np.arange(width), roi_images.sum(axis=1))
+    centers = np.where(fit.converged, fit["center"], np.nan)
+    center_errors = fit.error("center")
+"""
+from collections.abc import Callable
+from dataclasses import dataclass
+
+import numpy as np
+import numpy.typing as npt
+
+
+GAUSSIAN_1D_PARAMS: tuple[str, ...] = ("amplitude", "center", "sigma", "offset")
+GAUSSIAN_2D_PARAMS: tuple[str, ...] = ("amplitude", "center_x", "center_y", "sigma_x", "sigma_y", "offset")
+
+# Returns the model (N, M) and its Jacobian (N, M, P) for parameters (N, P)
+ModelJacobian = Callable[[npt.NDArray], tuple[npt.NDArray, npt.NDArray]]
+
+
+@dataclass
+class GaussianFitResult:
+    """
+    Fitted parameters of a stack of frames.
+
+    Attributes:
+        params (npt.NDArray): Fitted parameters of shape (N, P), ordered as `param_names`.
+        errors (npt.NDArray): One standard deviation uncertainties of `params`.
+        converged (npt.NDArray): Boolean mask (N,) of the frames whose fit converged.
+        param_names (tuple[str, ...]): Names of the parameters.
+    """
+    params: npt.NDArray
+    errors: npt.NDArray
+    converged: npt.NDArray[np.bool_]
+    param_names: tuple[str, ...]
+
+    def __getitem__(self, name: str) -> npt.NDArray:
+        return self.params[:, self.param_names.index(name)]
+
+    def error(self, name: str) -> npt.NDArray:
+        """Return the uncertainty of parameter `name`."""
+        return self.errors[:, self.param_names.index(name)]
+
+    def to_dict(self) -> dict[str, npt.NDArray]:
+        """Return the parameters and their uncertainties ('<name>_err') by name."""
+        result = {name: self[name] for name in self.param_names}
+        result.update({f"{name}_err": self.error(name) for name in self.param_names})
+        return result
+
+
+def gaussian_1d_model(x: npt.NDArray) -> ModelJacobian:
+    """Return the model and Jacobian of a * exp(-(x - mu)^2 / (2 sig^2)) + offset on `x`."""
+    x = np.asarray(x, dtype=np.float64)
+
+    def model_jacobian(params: npt.NDArray) -> tuple[npt.NDArray, npt.NDArray]:
+        a, mu, sig, _ = (p[:, np.newaxis] for p in params.T)
+        d = x - mu
+        e = np.exp(-d ** 2 / (2 * sig ** 2))
+        jac = np.empty(e.shape + (4,))
+        jac[..., 0] = e
+        jac[..., 1] = a * e * d / sig ** 2
+        jac[..., 2] = a * e * d ** 2 / sig ** 3
+        jac[..., 3] = 1.
+        return a * e + params[:, 3:4], jac
+
+    return model_jacobian
+
+
+def gaussian_2d_model(height: int, width: int) -> ModelJacobian:
+    """Return the model and Jacobian of an axis aligned 2D Gaussian on a (height, width) grid."""
+    y, x = (c.ravel().astype(np.float64) for c in np.mgrid[:height, :width])
+
+    def model_jacobian(params: npt.NDArray) -> tuple[npt.NDArray, npt.NDArray]:
+        a, x0, y0, sx, sy, _ = (p[:, np.newaxis] for p in params.T)
+        dx, dy = x - x0, y - y0
+        e = np.exp(-dx ** 2 / (2 * sx ** 2) - dy ** 2 / (2 * sy ** 2))
+        jac = np.empty(e.shape + (6,))
+        jac[..., 0] = e
+        jac[..., 1] = a * e * dx / sx ** 2
+        jac[..., 2] = a * e * dy / sy ** 2
+        jac[..., 3] = a * e * dx ** 2 / sx ** 3
+        jac[..., 4] = a * e * dy ** 2 / sy ** 3
+        jac[..., 5] = 1.
+        return a * e + params[:, 5:6], jac
+
+    return model_jacobian
+
+
+def moments_1d(x: npt.NDArray, data: npt.NDArray) -> npt.NDArray:
+    """Return initial guesses (amplitude, center, sigma, offset) of each row of `data` from its moments."""
+    offset = data.min(axis=1)
+    weights = data - offset[:, np.newaxis]
+    total = weights.sum(axis=1)
+    total = np.where(total > 0, total, 1.)
+    center = (weights * x).sum(axis=1) / total
+    sigma = np.sqrt((weights * (x - center[:, np.newaxis]) ** 2).sum(axis=1) / total)
+    spacing = np.abs(x[1] - x[0]) if len(x) > 1 else 1.
+    sigma = np.maximum(sigma, spacing / 2)
+    return np.stack([weights.max(axis=1), center, sigma, offset], axis=1)
+
+
+def moments_2d(images: npt.NDArray) -> npt.NDArray:
+    """Return initial guesses of `GAUSSIAN_2D_PARAMS` for each image of a (N, H, W) stack."""
+    height, width = images.shape[1:]
+    a, x0, sx, _ = moments_1d(np.arange(width, dtype=np.float64), images.sum(axis=1)).T
+    _, y0, sy, _ = moments_1d(np.arange(height, dtype=np.float64), images.sum(axis=2)).T
+    offset = images.min(axis=(1, 2))
+    amplitude = images.max(axis=(1, 2)) - offset
+    return np.stack([amplitude, x0, y0, sx, sy, offset], axis=1)
+
+
+def levenberg_marquardt(
+    model_jacobian: ModelJacobian,
+    data: npt.NDArray,
+    initial_params: npt.NDArray,
+    max_iter: int = 100,
+    tol: float = 1e-8,
+) -> tuple[npt.NDArray, npt.NDArray, npt.NDArray[np.bool_]]:
+    """
+    Least squares fit of `model_jacobian` to every row of `data` simultaneously.
+
+    Each row keeps its own damping factor and stops updating once its relative
+    decrease in cost falls below `tol`. Rows that are still changing after `max_iter`
+    iterations, whose damping explodes without any accepted step, or whose parameters
+    are not finite, are reported as not converged.
+
+    Parameters:
+    - model_jacobian (ModelJacobian): Returns the model (N, M) and Jacobian (N, M, P) of parameters (N, P).
+    - data (npt.NDArray): Data to fit, shape (N, M).
+    - initial_params (npt.NDArray): Initial guesses, shape (N, P).
+    - max_iter (int): Maximum number of iterations.
+    - tol (float): Relative tolerance on the cost.
+
+    Returns:
+    - tuple[npt.NDArray, npt.NDArray, npt.NDArray]: Parameters (N, P), their standard errors (N, P)
+      and the convergence mask (N,).
+    """
+    n_rows, n_points = data.shape
+    n_params = initial_params.shape[1]
+    params = initial_params.astype(np.float64, copy=True)
+    damping = np.full(n_rows, 1e-3)
+
+    model, jac = model_jacobian(params)
+    residual = data - model
+    cost = (residual ** 2).sum(axis=1)
+    active = np.isfinite(cost) & np.isfinite(params).all(axis=1)
+    converged = np.zeros(n_rows, dtype=np.bool_)
+
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        rows = np.flatnonzero(active)
+        j, r = jac[rows], residual[rows]
+        jt = j.transpose(0, 2, 1)
+        jtj = jt @ j
+        gradient = (jt @ r[..., np.newaxis])[..., 0]
+
+        # Marquardt scaling by diag(J^T J); the floor keeps the system positive definite
+        diagonal = np.maximum(np.einsum("npp->np", jtj), 1e-12)
+        lhs = jtj + (damping[rows, np.newaxis] * diagonal)[:, :, np.newaxis] * np.eye(n_params)
+        step = np.linalg.solve(lhs, gradient[..., np.newaxis])[..., 0]
+
+        trial = params[rows] + step
+        trial_model, trial_jac = model_jacobian(trial)
+        trial_residual = data[rows] - trial_model
+        trial_cost = (trial_residual ** 2).sum(axis=1)
+
+        improved = np.isfinite(trial_cost) & (trial_cost <= cost[rows])
+        accepted = rows[improved]
+        relative_change = (cost[accepted] - trial_cost[improved]) / np.maximum(cost[accepted], np.finfo(np.float64).tiny)
+
+        params[accepted] = trial[improved]
+        residual[accepted] = trial_residual[improved]
+        jac[accepted] = trial_jac[improved]
+        cost[accepted] = trial_cost[improved]
+        damping[accepted] /= 10
+        damping[rows[~improved]] *= 10
+
+        done = accepted[relative_change < tol]
+        # A row whose damping explodes makes no progress and is dropped as failed, like a curve_fit error
+        stuck = rows[~improved][damping[rows[~improved]] > 1e10]
+        converged[done] = True
+        active[done] = False
+        active[stuck] = False
+
+    converged &= np.isfinite(params).all(axis=1)
+
+    # Covariance from the Jacobian at the solution, scaled by the reduced chi-square
+    jtj = jac.transpose(0, 2, 1) @ jac
+    dof = max(n_points - n_params, 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        covariance = np.linalg.pinv(jtj) * (cost / dof)[:, np.newaxis, np.newaxis]
+        errors = np.sqrt(np.abs(np.einsum("npp->np", covariance)))
+    return params, errors, converged
+
+
+def _prepare(data: npt.NDArray) -> tuple[npt.NDArray, npt.NDArray[np.bool_]]:
+    data = np.asarray(data, dtype=np.float64)
+    finite = np.isfinite(data).all(axis=tuple(range(1, data.ndim)))
+    return np.where(np.isfinite(data), data, 0.), finite
+
+
+def fit_gaussian_1d(
+    x: npt.NDArray,
+    data: npt.NDArray,
+    max_iter: int = 100,
+    tol: float = 1e-8,
+) -> GaussianFitResult:
+    """
+    Fit a * exp(-(x - mu)^2 / (2 sig^2)) + offset to every row of `data`.
+
+    Parameters:
+    - x (npt.NDArray): Coordinates of shape (M,).
+    - data (npt.NDArray): Profiles of shape (N, M), e.g. ROI projections of every delay.
+    - max_iter (int): Maximum number of iterations.
+    - tol (float): Relative tolerance on the cost.
+
+    Returns:
+    - GaussianFitResult: amplitude, center, sigma and offset of each row.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    data, finite = _prepare(np.atleast_2d(data))
+    initial_params = moments_1d(x, data)
+    params, errors, converged = levenberg_marquardt(gaussian_1d_model(x), data, initial_params, max_iter, tol)
+    params[:, 2] = np.abs(params[:, 2])
+    return GaussianFitResult(params, errors, converged & finite, GAUSSIAN_1D_PARAMS)
+
+
+def fit_gaussian_2d(
+    images: npt.NDArray,
+    max_iter: int = 100,
+    tol: float = 1e-8,
+) -> GaussianFitResult:
+    """
+    Fit an axis aligned 2D Gaussian with offset to every image of a (N, H, W) stack.
+
+    Coordinates are pixel indices of the images, x along the width.
+
+    Parameters:
+    - images (npt.NDArray): Image stack of shape (N, H, W), e.g. ROI images of every delay.
+    - max_iter (int): Maximum number of iterations.
+    - tol (float): Relative tolerance on the cost.
+
+    Returns:
+    - GaussianFitResult: amplitude, center_x, center_y, sigma_x, sigma_y and offset of each image.
+    """
+    images, finite = _prepare(images)
+    height, width = images.shape[1:]
+    initial_params = moments_2d(images)
+    data = images.reshape(len(images), -1)
+    params, errors, converged = levenberg_marquardt(gaussian_2d_model(height, width), data, initial_params, max_iter, tol)
+    params[:, 3:5] = np.abs(params[:, 3:5])
+    return GaussianFitResult(params, errors, converged & finite, GAUSSIAN_2D_PARAMS)
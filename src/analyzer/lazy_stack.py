@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from typing import Any, Union
+
+import numpy as np
+import numpy.typing as npt
+from scipy.ndimage import affine_transform
+from scipy.special import cosdg, sindg
+
+
+# Extra input pixels read around a rotated region. Cubic spline prefiltering couples
+# pixels with a weight decaying as 0.268^distance, so 16 pixels reproduce a full-frame
+# `scipy.ndimage.rotate` to float32 precision.
+ROTATION_MARGIN: int = 16
+
+
+class LazyImageStack:
+    """
+    Image stack (N, H, W) that is only read, rotated and clipped where it is indexed.
+
+    The source is any array-like supporting basic slicing without loading everything,
+    such as a `np.memmap` of an uncompressed npz member or a chunked h5py dataset.
+    Indexing with `stack[..., y1:y2, x1:x2]` (e.g. `roi_rect.slice(stack)`) reads only
+    that region, rotates it by `angle` like `scipy.ndimage.rotate(..., axes=(1, 2), reshape=False)`
+    and clips it at zero. Results are cached, so repeated ROI queries are free.
+
+    Args:
+        source: Array-like image stack of shape (N, H, W).
+        angle (float): Rotation angle in degrees.
+        cache_size (int): Number of indexed regions to keep.
+    """
+    def __init__(self, source: Any, angle: float = 0, cache_size: int = 16) -> None:
+        if len(source.shape) != 3:
+            raise ValueError(f"Expected an image stack (N, H, W), got shape {source.shape}")
+        self.source = source
+        self.angle: float = angle
+        self.cache_size: int = cache_size
+        self._cache: OrderedDict[tuple, npt.NDArray] = OrderedDict()
+
+    @property
+    def shape(self) -> tuple[int, int, int]:
+        return tuple(self.source.shape)
+
+    @property
+    def ndim(self) -> int:
+        return 3
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(self.source.dtype)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key: Any) -> npt.NDArray:
+        frames, ys, xs = self._normalize_key(key)
+        if isinstance(frames, (int, np.integer)):
+            return self.region(slice(frames, frames + 1 if frames != -1 else None), ys, xs)[0]
+        if isinstance(frames, slice):
+            return self.region(frames, ys, xs)
+        return self.region(slice(None), ys, xs)[frames]
+
+    def __array__(self, dtype=None, copy=None) -> npt.NDArray:
+        array = self.region(slice(None), slice(None), slice(None))
+        return array if dtype is None else array.astype(dtype)
+
+    def astype(self, dtype: npt.DTypeLike) -> npt.NDArray:
+        return np.asarray(self).astype(dtype)
+
+    def sum(self, axis: Union[None, int, tuple[int, ...]] = None, batch_size: int = 64) -> npt.NDArray:
+        """Sum like `np.sum`, streaming over frames for `axis=0` to bound memory."""
+        if axis != 0:
+            return np.asarray(self).sum(axis=axis)
+        total = np.zeros(self.shape[1:], dtype=np.float64)
+        for start in range(0, len(self), batch_size):
+            total += self.read(slice(start, start + batch_size)).sum(axis=0)
+        return total.astype(self.dtype)
+
+    def mean(self, axis: Union[None, int, tuple[int, ...]] = None) -> npt.NDArray:
+        if axis != 0:
+            return np.asarray(self).mean(axis=axis)
+        return self.sum(axis=0) / len(self)
+
+    def read(self, frames: slice, ys: slice = slice(None), xs: slice = slice(None)) -> npt.NDArray:
+        """Return the rotated and clipped stack[frames, ys, xs] without caching it."""
+        return self._compute(frames, ys, xs)
+
+    def region(self, frames: slice, ys: slice, xs: slice) -> npt.NDArray:
+        """Return the rotated and clipped stack[frames, ys, xs], cached."""
+        height, width = self.shape[1:]
+        cache_key = (frames.indices(len(self)), ys.indices(height), xs.indices(width))
+        if cache_key in self._cache:
+            self._cache.move_to_end(cache_key)
+            return self._cache[cache_key]
+
+        result = self._compute(frames, ys, xs)
+        self._cache[cache_key] = result
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    def _compute(self, frames: slice, ys: slice, xs: slice) -> npt.NDArray:
+        height, width = self.shape[1:]
+        y1, y2, _ = ys.indices(height)
+        x1, x2, _ = xs.indices(width)
+        if not self.angle:
+            return np.maximum(0, np.asarray(self.source[frames, y1:y2, x1:x2]))
+
+        c, s = cosdg(self.angle), sindg(self.angle)
+        rot_matrix = np.array([[c, s], [-s, c]])
+        center = (np.array([height, width]) - 1) / 2
+        offset = center - rot_matrix @ center
+
+        # Input pixels needed for the output region, i.e. its rotated corners plus a margin
+        corners = np.array([[y1, x1], [y1, x2 - 1], [y2 - 1, x1], [y2 - 1, x2 - 1]], dtype=np.float64)
+        in_corners = corners @ rot_matrix.T + offset
+        in_y1, in_x1 = np.floor(in_corners.min(axis=0)).astype(int) - ROTATION_MARGIN
+        in_y2, in_x2 = np.ceil(in_corners.max(axis=0)).astype(int) + ROTATION_MARGIN + 1
+        in_y1, in_x1 = max(in_y1, 0), max(in_x1, 0)
+        in_y2, in_x2 = min(in_y2, height), min(in_x2, width)
+
+        images = np.asarray(self.source[frames, in_y1:in_y2, in_x1:in_x2])
+        out_shape = (y2 - y1, x2 - x1)
+        output = np.zeros((images.shape[0],) + out_shape, dtype=images.dtype)
+        if in_y2 <= in_y1 or in_x2 <= in_x1:
+            return output
+
+        region_offset = rot_matrix @ np.array([y1, x1]) + offset - np.array([in_y1, in_x1])
+        for image, out in zip(images, output):
+            affine_transform(image, rot_matrix, region_offset, out_shape, out, order=3, mode="constant", cval=0.)
+        return np.maximum(0, output)
+
+    def _normalize_key(self, key: Any) -> tuple[Any, slice, slice]:
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(item is Ellipsis for item in key):
+            index = next(i for i, item in enumerate(key) if item is Ellipsis)
+            key = key[:index] + (slice(None),) * (3 - len(key) + 1) + key[index + 1:]
+        key = key + (slice(None),) * (3 - len(key))
+        if len(key) != 3:
+            raise IndexError(f"Too many indices for LazyImageStack: {key}")
+
+        frames, ys, xs = key
+        for spatial in (ys, xs):
+            if not isinstance(spatial, slice) or spatial.step not in (None, 1):
+                raise IndexError("LazyImageStack only supports contiguous slices along the image axes")
+        return frames, ys, xs
@@ -1,19 +1,186 @@
+import json
+import struct
+import zipfile
+from typing import Any, Optional, Union
+
 import numpy as np
-from scipy.io import loadmat
 import numpy.typing as npt
+import h5py
+import hdf5plugin  # pylint: disable=unused-import
+from roi_rectangle import RoiRectangle
 
 
 class MatLoader:
-    def __init__(self, file):
-        mat_images: npt.NDArray = loadmat(file)["data"]
-        images = mat_images.swapaxes(0, 2)
-        self.images = images.swapaxes(1, 2)
+    """
+    Load an image stack from a mat file as (N, H, W).
+
+    Reads both MAT v7.3 files written by `MatSaverStrategy` (one variable per key, e.g. 'pon', 'poff')
+    and the older v5 files holding a single 'data' variable.
+
+    Args:
+        file (str): The mat file.
+        key (str, optional): Variable to read. Defaults to the only image stack of a v7.3 file,
+            which must then hold exactly one, and to 'data' for a v5 file.
+    """
+    def __init__(self, file, key: Optional[str] = None):
+        if h5py.is_hdf5(file):
+            with h5py.File(file, "r") as hf:
+                if key is None:
+                    key = self.get_image_key(hf)
+                # MATLAB H x W x N is stored as (N, W, H) in HDF5
+                self.images = hf[key][()].swapaxes(-1, -2)
+        else:
+            from scipy.io import loadmat
+
+            mat_images: npt.NDArray = loadmat(file)[key if key is not None else "data"]
+            images = mat_images.swapaxes(0, 2)
+            self.images = images.swapaxes(1, 2)
+
+    @staticmethod
+    def get_image_key(hf: h5py.File) -> str:
+        """Return the name of the only image stack (3-D variable) of a v7.3 file."""
+        keys = [key for key, val in hf.items() if isinstance(val, h5py.Dataset) and val.ndim == 3]
+        if len(keys) != 1:
+            raise KeyError(f"{hf.filename} holds the image stacks {keys}, pass the key to read")
+        return keys[0]
 
 class NpzLoader:
     def __init__(self, file: str):
         self.data =  dict(np.load(file))
 
 
+class H5Loader:
+    """
+    Read processed files written by `H5SaverStrategy`.
+
+    Datasets are only read when requested. `read` slices a single delay and/or ROI,
+    so only the chunks holding those pixels are decompressed.
+    """
+    def __init__(self, file: str):
+        self.file: str = file
+        self._hf: h5py.File = h5py.File(file, "r")
+
+    @property
+    def config(self) -> dict[str, Any]:
+        """Processing configuration stored with the data."""
+        return json.loads(self._hf.attrs["config"])
+
+    @property
+    def files(self) -> list[str]:
+        return list(self._hf.keys())
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._hf
+
+    def __getitem__(self, key: str) -> npt.NDArray:
+        return self._hf[key][()]
+
+    def dataset(self, key: str) -> h5py.Dataset:
+        """Return the lazy h5py dataset of `key`."""
+        return self._hf[key]
+
+    def read(
+        self,
+        key: str,
+        delay_index: Optional[Union[int, slice]] = None,
+        roi_rect: Optional[RoiRectangle] = None
+    ) -> npt.NDArray:
+        """
+        Read part of an image stack.
+
+        Parameters:
+            key (str): Dataset name, e.g. 'poff'.
+            delay_index (int | slice, optional): Delay frame(s) to read. All frames by default.
+            roi_rect (RoiRectangle, optional): Region of the frames to read. Full frames by default.
+        """
+        dataset = self._hf[key]
+        frames = slice(None) if delay_index is None else delay_index
+        if roi_rect is None:
+            return dataset[frames]
+        return dataset[frames, roi_rect.y1:roi_rect.y2, roi_rect.x1:roi_rect.x2]
+
+    def close(self) -> None:
+        self._hf.close()
+
+    def __enter__(self) -> "H5Loader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def memmap_npz(file: str) -> dict[str, npt.NDArray]:
+    """
+    Memory-map the arrays of an npz file.
+
+    `np.savez` stores members uncompressed, so each array can be mapped directly at its
+    offset inside the zip file. Compressed members (`np.savez_compressed`) are read normally.
+    """
+    arrays: dict[str, npt.NDArray] = {}
+    with zipfile.ZipFile(file) as zf, open(file, "rb") as f:
+        for info in zf.infolist():
+            name = info.filename[:-4] if info.filename.endswith(".npy") else info.filename
+            if info.compress_type != zipfile.ZIP_STORED:
+                with zf.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+
+            # Skip the local file header: 30 bytes + file name + extra field
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+            name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject:
+                raise ValueError(f"Cannot memory-map object array '{name}' in {file}")
+            arrays[name] = np.memmap(
+                file, dtype=dtype, mode="r", shape=shape,
+                order="F" if fortran_order else "C", offset=f.tell()
+            )
+    return arrays
+
+
+def append_processed_data(file: str, data_dict: dict[str, npt.NDArray]) -> None:
+    """
+    Add arrays to an existing processed npz or h5 file.
+
+    npz members are appended uncompressed to the zip archive, so they can be memory-mapped.
+    Keys that already exist are not allowed.
+    """
+    if file.endswith(".h5"):
+        with h5py.File(file, "a") as hf:
+            for key, val in data_dict.items():
+                hf.create_dataset(key, data=val)
+        return
+
+    with zipfile.ZipFile(file, "a", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        existing = set(zf.namelist())
+        for key, val in data_dict.items():
+            if f"{key}.npy" in existing:
+                raise ValueError(f"'{key}' already exists in {file}")
+            with zf.open(f"{key}.npy", "w", force_zip64=True) as member:
+                np.lib.format.write_array(member, np.asarray(val), allow_pickle=False)
+
+
+def load_processed_data(file: str, lazy: bool = False):
+    """
+    Return a mapping of the arrays in a processed npz or h5 file.
+
+    With `lazy`, arrays are memory-mapped (npz) or h5py datasets (h5) and nothing is read yet.
+    """
+    if file.endswith(".h5"):
+        loader = H5Loader(file)
+        return {key: loader.dataset(key) for key in loader.files} if lazy else loader
+    if lazy:
+        return memmap_npz(file)
+    return np.load(file)
+
+
 if __name__ == "__main__":
     import os
     from src.config.config import load_config
@@ -0,0 +1,153 @@
+"""
+Summed-area tables for constant time ROI queries.
+
+`RoiSumIndex` holds, for every delay frame of an image stack, the cumulative sums of
+I, x * I and y * I over both image axes. The sum of any of them over a rectangle is
+four lookups, so the intensity and center of mass of a ROI for all delays cost
+O(number of delays) regardless of the ROI size, and thousands of candidate ROIs
+are answered in one vectorized call.
+
+The tables take 3 float64 values per pixel and frame, about 6 times a float32 stack.
+`query_stack` answers one set of ROIs from the tables of a few frames at a time instead.
+
+Example usage:
+    index = RoiSumIndex.from_images(poff_images)
+    intensities = index.intensity(roi_rect)
+    result = index.query_many(roi_rects_to_array(candidate_roi_rects))
+    result = query_stack(poff_images, roi_rects_to_array(candidate_roi_rects))
+"""
+from typing import Union
+
+import numpy as np
+import numpy.typing as npt
+from roi_rectangle import RoiRectangle
+
+from src.analyzer.lazy_stack import LazyImageStack
+from src.utils.roi_util import roi_rects_to_array
+
+
+def roi_index_key(name: str, angle: float = 0) -> str:
+    """Return the key of the index of stack `name` (e.g. 'poff') rotated by `angle` in a processed file."""
+    return f"{name}_roi_index" if not angle else f"{name}_roi_index_rot{angle:g}"
+
+
+class RoiSumIndex:
+    """
+    Summed-area tables of an image stack.
+
+    Args:
+        tables (npt.NDArray): Array of shape (3, N, H + 1, W + 1) holding the zero padded
+            cumulative sums of I, x * I and y * I of each frame. A `np.memmap` works, then
+            only the looked up entries are read.
+    """
+    def __init__(self, tables: npt.NDArray) -> None:
+        if tables.ndim != 4 or tables.shape[0] != 3:
+            raise ValueError(f"Expected tables of shape (3, N, H + 1, W + 1), got {tables.shape}")
+        self.tables: npt.NDArray = tables
+
+    @classmethod
+    def from_images(cls, images: Union[npt.NDArray, LazyImageStack], batch_size: int = 16) -> "RoiSumIndex":
+        """Build the index of an (N, H, W) stack, reading `batch_size` frames at a time."""
+        n_frames, height, width = images.shape
+        tables = np.zeros((3, n_frames, height + 1, width + 1), dtype=np.float64)
+        y_coords, x_coords = np.mgrid[:height, :width]
+
+        for start in range(0, n_frames, batch_size):
+            stop = min(start + batch_size, n_frames)
+            batch = _read_frames(images, start, stop).astype(np.float64)
+            for i, weighted in enumerate((batch, x_coords * batch, y_coords * batch)):
+                tables[i, start:stop, 1:, 1:] = weighted.cumsum(axis=1).cumsum(axis=2)
+        return cls(tables)
+
+    @property
+    def shape(self) -> tuple[int, int, int]:
+        """Shape (N, H, W) of the indexed stack."""
+        _, n_frames, height, width = self.tables.shape
+        return n_frames, height - 1, width - 1
+
+    def _corners(self, rois: npt.NDArray) -> tuple[npt.NDArray, ...]:
+        _, height, width = self.shape
+        rois = np.asarray(rois, dtype=np.int64).reshape(-1, 4)
+        x1, x2 = np.clip(rois[:, 0], 0, width), np.clip(rois[:, 2], 0, width)
+        y1, y2 = np.clip(rois[:, 1], 0, height), np.clip(rois[:, 3], 0, height)
+        return x1, y1, np.maximum(x2, x1), np.maximum(y2, y1)
+
+    def sums(self, rois: npt.NDArray) -> npt.NDArray:
+        """
+        Return the sums of I, x * I and y * I over each ROI for each frame.
+
+        Parameters:
+            rois (npt.NDArray): (K, 4) array of (x1, y1, x2, y2), clipped to the image like slicing.
+
+        Returns:
+            npt.NDArray: Array of shape (3, N, K).
+        """
+        x1, y1, x2, y2 = self._corners(rois)
+        tables = self.tables
+        return tables[:, :, y2, x2] - tables[:, :, y1, x2] - tables[:, :, y2, x1] + tables[:, :, y1, x1]
+
+    def query_many(self, rois: npt.NDArray) -> dict[str, npt.NDArray]:
+        """
+        Return the mean intensity and center of mass of many ROIs for every frame.
+
+        Centers of mass are relative to the ROI origin like `DataAnalyzer._roi_center_of_masses`.
+
+        Parameters:
+            rois (npt.NDArray): (K, 4) array of (x1, y1, x2, y2), e.g. from `roi_rects_to_array`.
+
+        Returns:
+            dict[str, npt.NDArray]: 'intensity', 'com_x' and 'com_y', each of shape (K, N).
+        """
+        x1, y1, x2, y2 = self._corners(rois)
+        total, x_moment, y_moment = self.sums(rois)
+        area = ((x2 - x1) * (y2 - y1)).astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return {
+                "intensity": (total / area).T,
+                "com_x": (x_moment / total - x1).T,
+                "com_y": (y_moment / total - y1).T,
+            }
+
+    def intensity(self, roi_rect: RoiRectangle) -> npt.NDArray:
+        """Return the mean intensity of `roi_rect` for every frame."""
+        return self.query_many(roi_rects_to_array([roi_rect]))["intensity"][0]
+
+    def center_of_mass(self, roi_rect: RoiRectangle) -> tuple[npt.NDArray, npt.NDArray]:
+        """Return the center of mass (x, y) of `roi_rect`, relative to its origin, for every frame."""
+        result = self.query_many(roi_rects_to_array([roi_rect]))
+        return result["com_x"][0], result["com_y"][0]
+
+
+def _read_frames(images: Union[npt.NDArray, LazyImageStack], start: int, stop: int) -> npt.NDArray:
+    if isinstance(images, LazyImageStack):
+        return images.read(slice(start, stop))
+    return np.asarray(images[start:stop])
+
+
+def query_stack(
+    images: Union[npt.NDArray, LazyImageStack],
+    rois: npt.NDArray,
+    batch_size: int = 16
+) -> dict[str, npt.NDArray]:
+    """
+    Return `RoiSumIndex.query_many` of an (N, H, W) stack without keeping its tables.
+
+    The tables are built for `batch_size` frames at a time, so the memory stays at the
+    tables of one batch instead of the whole stack.
+
+    Parameters:
+        images (npt.NDArray | LazyImageStack): Image stack.
+        rois (npt.NDArray): (K, 4) array of (x1, y1, x2, y2).
+        batch_size (int): Frames indexed at a time.
+
+    Returns:
+        dict[str, npt.NDArray]: 'intensity', 'com_x' and 'com_y', each of shape (K, N).
+    """
+    n_frames = images.shape[0]
+    results = [
+        RoiSumIndex.from_images(_read_frames(images, start, min(start + batch_size, n_frames))).query_many(rois)
+        for start in range(0, n_frames, batch_size)
+    ]
+    if not results:
+        return {key: np.empty((len(rois), 0)) for key in ("intensity", "com_x", "com_y")}
+    return {key: np.concatenate([result[key] for result in results], axis=1) for key in results[0]}
@@ -1,72 +1,204 @@
-from collections.abc import Mapping
+"""
+Track a drifting peak through the delay frames of an image stack.
+
+`RoiTracker` finds the peak of every frame at once: the brightest pixel inside a search
+region around the initial ROI, refined to sub-pixel precision by a windowed center of mass
+or a parabolic fit. It returns one RoiRectangle per frame centered on the peak, which
+`DataAnalyzer.analyze_by_moving_roi` integrates without looping over frames.
+
+Example usage:
+    tracker = RoiTracker(roi_rect, search_margin=10)
+    peak_x, peak_y = tracker.track(images)
+    roi_rects = tracker.moving_roi_rects(images)
+"""
+from typing import Union
 
 import numpy as np
 import numpy.typing as npt
 from roi_rectangle import RoiRectangle
-from matplotlib import patches
 
-from src.gui.roi import RoiSelector
-from src.config.config import load_config, ExpConfig
+from src.utils.roi_util import shift_roi_rect, roi_rects_to_array
+
+
+class RoiTracker:
+    """
+    Sub-pixel peak tracker working on all frames of a stack at once.
+
+    Args:
+        roi_rect (RoiRectangle): Initial ROI around the peak, also the size of the moving ROIs.
+        search_margin (int): Pixels added around `roi_rect` in which the peak is searched.
+        method (str): 'com' for the center of mass of a (2 * window + 1)^2 window around
+            the brightest pixel, 'parabolic' for a 3 point parabola along each axis.
+        window (int): Half size of the center of mass window.
+    """
+    METHODS: tuple[str, ...] = ("com", "parabolic")
+
+    def __init__(
+        self,
+        roi_rect: RoiRectangle,
+        search_margin: int = 10,
+        method: str = "com",
+        window: int = 3
+    ) -> None:
+        if method not in self.METHODS:
+            raise ValueError(f"Unsupported method: {method}, use one of {self.METHODS}")
+        self.roi_rect: RoiRectangle = roi_rect
+        self.search_margin: int = search_margin
+        self.method: str = method
+        self.window: int = window
+
+    def search_rect(self, shape: tuple[int, int]) -> RoiRectangle:
+        """Return the search region inside an image of `shape` (H, W)."""
+        height, width = shape
+        return RoiRectangle(
+            x1=max(self.roi_rect.x1 - self.search_margin, 0),
+            y1=max(self.roi_rect.y1 - self.search_margin, 0),
+            x2=min(self.roi_rect.x2 + self.search_margin, width),
+            y2=min(self.roi_rect.y2 + self.search_margin, height),
+        )
 
+    def track(self, images: npt.NDArray) -> tuple[npt.NDArray, npt.NDArray]:
+        """
+        Find the sub-pixel peak position of every frame.
+
+        Parameters:
+            images (npt.NDArray): Image stack (N, H, W).
+
+        Returns:
+            tuple[npt.NDArray, npt.NDArray]: Peak x and y of every frame in image coordinates.
+        """
+        search_rect = self.search_rect(images.shape[-2:])
+        region = np.asarray(search_rect.slice(images), dtype=np.float64)
+        n_frames, height, width = region.shape
+
+        peak_y, peak_x = np.unravel_index(region.reshape(n_frames, -1).argmax(axis=1), (height, width))
+        if self.method == "com":
+            sub_x, sub_y = self._windowed_center_of_mass(region, peak_x, peak_y)
+        else:
+            sub_x, sub_y = self._parabolic_peak(region, peak_x, peak_y)
+        return sub_x + search_rect.x1, sub_y + search_rect.y1
+
+    def _windowed_center_of_mass(
+        self,
+        region: npt.NDArray,
+        peak_x: npt.NDArray,
+        peak_y: npt.NDArray
+    ) -> tuple[npt.NDArray, npt.NDArray]:
+        n_frames, height, width = region.shape
+        offsets = np.arange(-self.window, self.window + 1)
+        # Gather the window around each peak; pixels outside the region get no weight
+        ys = peak_y[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+        xs = peak_x[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+        inside = (ys >= 0) & (ys < height) & (xs >= 0) & (xs < width)
+        frames = np.arange(n_frames)[:, np.newaxis, np.newaxis]
+        values = region[frames, np.clip(ys, 0, height - 1), np.clip(xs, 0, width - 1)]
+        # Subtract the window minimum, a flat background pulls the center toward the window center
+        background = np.where(inside, values, np.inf).min(axis=(1, 2), keepdims=True)
+        weights = np.where(inside, values - background, 0.)
+
+        total = weights.sum(axis=(1, 2))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sub_x = (weights * xs).sum(axis=(1, 2)) / total
+            sub_y = (weights * ys).sum(axis=(1, 2)) / total
+        return np.where(total > 0, sub_x, peak_x), np.where(total > 0, sub_y, peak_y)
+
+    @staticmethod
+    def _parabolic_peak(
+        region: npt.NDArray,
+        peak_x: npt.NDArray,
+        peak_y: npt.NDArray
+    ) -> tuple[npt.NDArray, npt.NDArray]:
+        n_frames, height, width = region.shape
+        frames = np.arange(n_frames)
+
+        def vertex(lower: npt.NDArray, center: npt.NDArray, upper: npt.NDArray) -> npt.NDArray:
+            curvature = lower - 2 * center + upper
+            with np.errstate(invalid="ignore", divide="ignore"):
+                shift = 0.5 * (lower - upper) / curvature
+            # Fall back to the pixel itself at the border or when the peak is not a maximum
+            return np.where((curvature < 0) & (np.abs(shift) <= 1), shift, 0.)
+
+        x_lower, x_upper = np.clip(peak_x - 1, 0, width - 1), np.clip(peak_x + 1, 0, width - 1)
+        y_lower, y_upper = np.clip(peak_y - 1, 0, height - 1), np.clip(peak_y + 1, 0, height - 1)
+        center = region[frames, peak_y, peak_x]
+        shift_x = vertex(region[frames, peak_y, x_lower], center, region[frames, peak_y, x_upper])
+        shift_y = vertex(region[frames, y_lower, peak_x], center, region[frames, y_upper, peak_x])
+        shift_x = np.where((peak_x > 0) & (peak_x < width - 1), shift_x, 0.)
+        shift_y = np.where((peak_y > 0) & (peak_y < height - 1), shift_y, 0.)
+        return peak_x + shift_x, peak_y + shift_y
+
+    def moving_roi_rects(self, images: npt.NDArray) -> list[RoiRectangle]:
+        """Return a RoiRectangle of the initial size centered on the peak of every frame."""
+        return self.rects_at(*self.track(images))
+
+    def rects_at(self, peak_x: npt.NDArray, peak_y: npt.NDArray) -> list[RoiRectangle]:
+        """Return a RoiRectangle of the initial size centered on each peak returned by `track`."""
+        center_x = (self.roi_rect.x1 + self.roi_rect.x2) / 2
+        center_y = (self.roi_rect.y1 + self.roi_rect.y2) / 2
+        return [
+            shift_roi_rect(self.roi_rect, int(round(x - center_x)), int(round(y - center_y)))
+            for x, y in zip(peak_x, peak_y)
+        ]
+
+
+def gather_moving_rois(
+    images: npt.NDArray,
+    roi_rects: Union[list[RoiRectangle], npt.NDArray]
+) -> tuple[npt.NDArray, npt.NDArray]:
+    """
+    Cut one equally sized ROI out of every frame without looping over frames.
+
+    ROIs are shifted back inside the image where they leave it.
+
+    Parameters:
+        images (npt.NDArray): Image stack (N, H, W), or a `LazyImageStack`.
+        roi_rects (list[RoiRectangle] | npt.NDArray): One ROI per frame, or an (N, 4) array of (x1, y1, x2, y2).
+
+    Returns:
+        tuple[npt.NDArray, npt.NDArray]: ROI images (N, h, w) and the (N, 2) origins (x1, y1) actually used.
+    """
+    rois = roi_rects if isinstance(roi_rects, np.ndarray) else roi_rects_to_array(roi_rects)
+    n_frames, height, width = images.shape
+    if len(rois) != n_frames:
+        raise ValueError(f"Expected one ROI per frame ({n_frames}), got {len(rois)}")
+    roi_width, roi_height = rois[0, 2] - rois[0, 0], rois[0, 3] - rois[0, 1]
+    if np.any(rois[:, 2] - rois[:, 0] != roi_width) or np.any(rois[:, 3] - rois[:, 1] != roi_height):
+        raise ValueError("All moving ROIs must have the same size")
+
+    x1 = np.clip(rois[:, 0], 0, max(width - roi_width, 0))
+    y1 = np.clip(rois[:, 1], 0, max(height - roi_height, 0))
+
+    # Read only the region covering every ROI, then gather inside it
+    bound_x1, bound_y1 = x1.min(), y1.min()
+    bound = np.asarray(images[..., bound_y1:y1.max() + roi_height, bound_x1:x1.max() + roi_width])
+    frames = np.arange(n_frames)[:, np.newaxis, np.newaxis]
+    ys = (y1 - bound_y1)[:, np.newaxis, np.newaxis] + np.arange(roi_height)[np.newaxis, :, np.newaxis]
+    xs = (x1 - bound_x1)[:, np.newaxis, np.newaxis] + np.arange(roi_width)[np.newaxis, np.newaxis, :]
+    return bound[frames, ys, xs], np.stack([x1, y1], axis=1)
 
-if __name__ == "__main__":
-    import os
 
+if __name__ == "__main__":
     import matplotlib.pyplot as plt
 
+    from src.analyzer.batch import get_processed_file
+    from src.analyzer.core import DataAnalyzer
+    from src.gui.roi import RoiSelector
+
     run = 154
     scan = 1
 
-    config: ExpConfig = load_config()
-    processed_dir: str = config.path.processed_dir
-    npz_file = os.path.join(processed_dir, f"run={run:0>4}_scan={scan:0>4}.npz")
-    data: Mapping[str, npt.NDArray] = np.load(npz_file)
-    delays: npt.NDArray = data["delay"]
-    images: npt.NDArray = data["pon"]
+    npz_file = get_processed_file(run, scan)
+    analyzer = DataAnalyzer(npz_file)
 
-    init_roi = RoiSelector().select_roi(np.log1p(images[0]))
+    init_roi = RoiSelector().select_roi(np.log1p(analyzer.pon_images[0]))
     init_roi_rect: RoiRectangle = RoiRectangle.from_tuple(init_roi)
-    roi_rects: list[RoiRectangle] = [init_roi_rect]
-
-    for image in images:
-        roi_image = roi_rects[-1].slice(image)
-        com = np.unravel_index(np.argmax(roi_image), roi_image.shape)[::-1]
-        new_center = (
-            round(roi_rects[-1].x1 + com[0]),
-            round(roi_rects[-1].y1 + com[1])
-        )
-        new_roi_rect = init_roi_rect.move_to_center(new_center)
-        roi_rects.append(new_roi_rect)
-
-    xs = []
-    ys = []
-    for roi_rect, image in zip(roi_rects[1:], images):
-        roi_rect.slice(image)
-        com = np.unravel_index(np.argmax(roi_image), roi_image.shape)[::-1]
-        x = roi_rect.x1 + com[0]
-        y = roi_rect.y1 + com[1]
-
-        xs.append(x)
-        ys.append(y)
-
-    # fig, axs = plt.subplots(2, 1)
-    # axs[0].plot(delays, xs)
-    # axs[1].plot(delays, ys)
-
-    # plt.show()
-
-    for idx, image in enumerate(np.log1p(images)):
-
-        # 이미지와 ROI를 그릴 그림 생성
-        fig, ax = plt.subplots()
-        ax.imshow(image)
 
-        # 해당 이미지의 ROI 정보 가져오기
-        roi_rect = roi_rects[idx]
-        rect = patches.Rectangle((roi_rect.x1, roi_rect.y1), roi_rect.width, roi_rect.height, linewidth=1, edgecolor='r', facecolor='none')
-        ax.add_patch(rect)
+    xs, ys = RoiTracker(init_roi_rect).track(analyzer.pon_images)
 
-        # 이미지와 ROI를 파일로 저장
-        output_path = os.path.join("Y:/240608_FXS/raw_data/h5/type=raw/Image/moving_roi", f"image_{idx}.png")
-        plt.savefig(output_path)
-        plt.close(fig)
+    fig, axs = plt.subplots(2, 1, sharex=True)
+    axs[0].plot(analyzer.delay, xs, marker='o')
+    axs[0].set_ylabel("peak x (pixel)")
+    axs[1].plot(analyzer.delay, ys, marker='o')
+    axs[1].set_ylabel("peak y (pixel)")
+    axs[1].set_xlabel("delay")
+    plt.show()
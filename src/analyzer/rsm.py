@@ -0,0 +1,221 @@
+"""
+Reciprocal space maps of rocking (θ) scans.
+
+Every pixel of a flat detector perpendicular to the beam (see `src.utils.geometry`) measures
+the momentum transfer
+    Q_lab = k_out - k_in,    |k| = 2π / λ,
+in the lab frame (x along the detector rows, y along the columns, z along the beam). Rocking the
+sample by θ around `axis` turns Q_lab into the sample frame Q = R(θ)^-1 Q_lab, so the frames of a
+rocking scan fill a 3D volume of (qx, qy, qz). The intensities are histogrammed onto a regular
+grid with `np.bincount`, a chunk of frames at a time, so memory stays bounded by `chunk_size`.
+
+Example usage:
+    analyzer = DataAnalyzer(npz_file)  # processed rocking scan, 'delay' holds θ
+    mapper = ReciprocalSpaceMapper(get_geometry(), analyzer.poff_images.shape[-2:])
+    rsm = mapper.map(analyzer.poff_images, analyzer.delay, bins=(100, 100, 100))
+    volume = rsm.mean
+"""
+from dataclasses import dataclass
+from typing import Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+
+from src.utils.geometry import DetectorGeometry
+
+
+@dataclass(frozen=True)
+class ReciprocalSpaceMap:
+    """
+    Histogrammed rocking scan.
+
+    Attributes:
+        intensity (npt.NDArray): Summed intensity of every (qx, qy, qz) voxel.
+        counts (npt.NDArray): Number of pixels summed into every voxel.
+        edges (tuple[npt.NDArray, npt.NDArray, npt.NDArray]): Voxel edges along qx, qy and qz.
+    """
+    intensity: npt.NDArray
+    counts: npt.NDArray
+    edges: tuple[npt.NDArray, npt.NDArray, npt.NDArray]
+
+    @property
+    def mean(self) -> npt.NDArray:
+        """Mean intensity of every voxel, NaN for empty voxels."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.counts > 0, self.intensity / self.counts, np.nan)
+
+    @property
+    def centers(self) -> tuple[npt.NDArray, npt.NDArray, npt.NDArray]:
+        """Voxel centers along qx, qy and qz."""
+        return tuple((edge[1:] + edge[:-1]) / 2 for edge in self.edges)
+
+    def projection(self, axis: int) -> npt.NDArray:
+        """Return the mean intensity summed along `axis` (0: qx, 1: qy, 2: qz)."""
+        return np.nansum(self.mean, axis=axis)
+
+
+def rotation_matrices(thetas: npt.NDArray, axis: str = "x") -> npt.NDArray:
+    """Return the (N, 3, 3) right handed rotations by `thetas` [deg] around the lab `axis`."""
+    angles = np.deg2rad(np.asarray(thetas, dtype=np.float64))
+    cos, sin = np.cos(angles), np.sin(angles)
+    one, zero = np.ones_like(angles), np.zeros_like(angles)
+    if axis == "x":
+        rows = [[one, zero, zero], [zero, cos, -sin], [zero, sin, cos]]
+    elif axis == "y":
+        rows = [[cos, zero, sin], [zero, one, zero], [-sin, zero, cos]]
+    elif axis == "z":
+        rows = [[cos, -sin, zero], [sin, cos, zero], [zero, zero, one]]
+    else:
+        raise ValueError(f"Unsupported rotation axis: {axis}, use 'x', 'y' or 'z'")
+    return np.moveaxis(np.array(rows), -1, 0)
+
+
+class ReciprocalSpaceMapper:
+    """
+    Histogram rocking scans onto a regular (qx, qy, qz) grid.
+
+    Args:
+        geometry (DetectorGeometry): Detector geometry. q is in 1/Å.
+        shape (tuple[int, int]): Shape (H, W) of the frames.
+        axis (str): Lab axis of the θ rotation, 'x' (horizontal), 'y' (vertical) or 'z' (beam).
+        mask (npt.NDArray, optional): Bad pixel mask (H, W), True for pixels to ignore.
+        origin (tuple[int, int]): Detector coordinates (x, y) of the first frame pixel, e.g. an ROI origin.
+        detector_shape (tuple[int, int], optional): Full detector shape used for the default beam center.
+        chunk_size (int): Number of (frame, pixel) samples binned at once.
+    """
+    AXES: tuple[str, ...] = ("x", "y", "z")
+
+    def __init__(
+        self,
+        geometry: DetectorGeometry,
+        shape: tuple[int, int],
+        axis: str = "x",
+        mask: Optional[npt.NDArray] = None,
+        origin: tuple[int, int] = (0, 0),
+        detector_shape: Optional[tuple[int, int]] = None,
+        chunk_size: int = 1 << 22
+    ) -> None:
+        if axis not in self.AXES:
+            raise ValueError(f"Unsupported rotation axis: {axis}, use one of {self.AXES}")
+        self.geometry: DetectorGeometry = geometry
+        self.shape: tuple[int, int] = tuple(int(v) for v in shape)
+        self.axis: str = axis
+        self.origin: tuple[int, int] = origin
+        self.detector_shape: tuple[int, int] = tuple(detector_shape) if detector_shape is not None else self.shape
+        self.chunk_size: int = chunk_size
+
+        self.pixels: npt.NDArray[np.int64] = np.arange(self.shape[0] * self.shape[1])
+        if mask is not None:
+            self.pixels = np.flatnonzero(~np.asarray(mask, dtype=np.bool_).ravel())
+        self.q_lab: npt.NDArray = self.lab_q()[self.pixels]
+
+    def lab_q(self) -> npt.NDArray:
+        """Return the lab frame momentum transfer (H * W, 3) of every pixel."""
+        beam_x, beam_y = self.geometry.beam_center(self.detector_shape)
+        y, x = np.mgrid[:self.shape[0], :self.shape[1]]
+        position = np.stack([
+            (x.ravel() + self.origin[0] - beam_x) * self.geometry.dps,
+            (y.ravel() + self.origin[1] - beam_y) * self.geometry.dps,
+            np.full(x.size, self.geometry.sdd),
+        ], axis=1)
+        wave_number = self.geometry.k / 2
+        k_out = wave_number * position / np.linalg.norm(position, axis=1, keepdims=True)
+        return k_out - np.array([0., 0., wave_number])
+
+    def sample_q(self, thetas: npt.NDArray) -> npt.NDArray:
+        """Return the sample frame momentum transfer (N, pixels, 3) of every unmasked pixel at every θ."""
+        # Q = R^-1 Q_lab = R^T Q_lab, i.e. the row vector Q_lab @ R
+        return np.einsum("pi,fij->fpj", self.q_lab, rotation_matrices(thetas, self.axis))
+
+    def _frame_chunks(self, n_frames: int) -> range:
+        return range(0, n_frames, max(1, self.chunk_size // len(self.pixels)))
+
+    def q_range(self, thetas: npt.NDArray) -> tuple[npt.NDArray, npt.NDArray]:
+        """Return the lower and upper (qx, qy, qz) reached over the scan."""
+        thetas = np.asarray(thetas, dtype=np.float64)
+        lower, upper = np.full(3, np.inf), np.full(3, -np.inf)
+        step = self._frame_chunks(len(thetas)).step
+        for start in self._frame_chunks(len(thetas)):
+            q = self.sample_q(thetas[start:start + step])
+            lower = np.minimum(lower, q.min(axis=(0, 1)))
+            upper = np.maximum(upper, q.max(axis=(0, 1)))
+        return lower, upper
+
+    def map(
+        self,
+        images: npt.NDArray,
+        thetas: npt.NDArray,
+        bins: Union[int, tuple[int, int, int]] = 100,
+        q_range: Optional[tuple[npt.NDArray, npt.NDArray]] = None
+    ) -> ReciprocalSpaceMap:
+        """
+        Histogram a rocking scan onto a (qx, qy, qz) grid.
+
+        Parameters:
+            images (npt.NDArray): Frames (N, H, W), or a `LazyImageStack`.
+            thetas (npt.NDArray): Sample angle θ [deg] of every frame.
+            bins (int | tuple[int, int, int]): Number of voxels along each axis.
+            q_range (tuple[npt.NDArray, npt.NDArray], optional): Lower and upper (qx, qy, qz) of the
+                grid. Defaults to the range reached over the scan.
+
+        Returns:
+            ReciprocalSpaceMap: Summed intensities and pixel counts of every voxel.
+        """
+        thetas = np.asarray(thetas, dtype=np.float64)
+        n_frames = images.shape[0]
+        if images.shape[-2:] != self.shape:
+            raise ValueError(f"Expected frames of shape (N, {self.shape[0]}, {self.shape[1]}), got {images.shape}")
+        if len(thetas) != n_frames:
+            raise ValueError(f"Expected one θ per frame ({n_frames}), got {len(thetas)}")
+
+        n_bins = np.broadcast_to(np.asarray(bins, dtype=np.int64), (3,))
+        lower, upper = (np.asarray(v, dtype=np.float64) for v in (q_range or self.q_range(thetas)))
+        edges = tuple(np.linspace(lower[i], upper[i], n_bins[i] + 1) for i in range(3))
+        scale = n_bins / np.where(upper > lower, upper - lower, 1.)
+        strides = np.array([n_bins[1] * n_bins[2], n_bins[2], 1])
+        total = int(np.prod(n_bins))
+
+        intensity = np.zeros(total)
+        counts = np.zeros(total, dtype=np.int64)
+        step = self._frame_chunks(n_frames).step
+        for start in self._frame_chunks(n_frames):
+            frames = np.asarray(images[start:start + step], dtype=np.float64).reshape(-1, self.shape[0] * self.shape[1])
+            values = frames[:, self.pixels].ravel()
+            index = np.floor((self.sample_q(thetas[start:start + step]).reshape(-1, 3) - lower) * scale).astype(np.int64)
+            # The upper edge is inclusive like np.histogramdd
+            index = np.where(index == n_bins, n_bins - 1, index)
+            valid = np.all((index >= 0) & (index < n_bins), axis=1) & np.isfinite(values)
+            flat = index[valid] @ strides
+            intensity += np.bincount(flat, weights=values[valid], minlength=total)
+            counts += np.bincount(flat, minlength=total)
+
+        return ReciprocalSpaceMap(intensity.reshape(tuple(n_bins)), counts.reshape(tuple(n_bins)), edges)
+
+
+if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+
+    from src.analyzer.batch import get_processed_file
+    from src.analyzer.core import DataAnalyzer
+    from src.utils.geometry import get_geometry
+
+    run = 154
+    scan = 1
+
+    npz_file = get_processed_file(run, scan)
+    analyzer = DataAnalyzer(npz_file)
+
+    images = np.maximum(analyzer.poff_images, 0)
+    mapper = ReciprocalSpaceMapper(get_geometry(), images.shape[-2:])
+    rsm = mapper.map(images, analyzer.delay, bins=(120, 120, 120))
+
+    qx, qy, qz = rsm.centers
+    fig, axs = plt.subplots(1, 3, figsize=(15, 5))
+    for ax, axis, (h, v), labels in zip(
+        axs, (2, 1, 0), ((qx, qy), (qx, qz), (qy, qz)), (("qx", "qy"), ("qx", "qz"), ("qy", "qz"))
+    ):
+        ax.pcolormesh(h, v, np.log1p(rsm.projection(axis)).T)
+        ax.set_xlabel(f"{labels[0]} (1/Å)")
+        ax.set_ylabel(f"{labels[1]} (1/Å)")
+    fig.suptitle(f"Reciprocal space map run={run:0>4}")
+    plt.show()
@@ -0,0 +1,106 @@
+from typing import Optional
+
+import click
+
+from src.benchmark.synthetic import SyntheticSpec
+from src.benchmark.micro import run_benchmarks, save_results, compare_results
+from src.benchmark.scaling import run_scaling, save_scaling
+from src.benchmark.startup import ENTRY_POINTS, baseline, check_entry_point
+
+
+@click.group()
+def benchmark() -> None:
+    """Benchmarks of the processing chain on synthetic data"""
+
+
+@benchmark.command()
+@click.option('--shots', type=int, default=100, help='Shots per file')
+@click.option('--files', type=int, default=10, help='Files in the scan')
+@click.option('--height', type=int, default=256, help='Detector height [pixel]')
+@click.option('--width', type=int, default=512, help='Detector width [pixel]')
+@click.option('--compression', type=click.Choice(['none', 'gzip', 'lz4', 'zstd', 'blosc']), default='none')
+@click.option('--timestamp-jitter', type=float, default=0., help='Fraction of shots missing from the QBPM stream')
+@click.option('--repeat', type=int, default=5, help='Timed calls per case')
+@click.option('--warmup', type=int, default=1, help='Untimed calls per case')
+@click.option('--select', type=str, default=None, help='Only run cases whose name contains this text')
+@click.option('--output', type=click.Path(dir_okay=False), default=None, help='Result file, logs/benchmark/... by default')
+def run(
+    shots: int, files: int, height: int, width: int, compression: str, timestamp_jitter: float,
+    repeat: int, warmup: int, select: Optional[str], output: Optional[str]
+) -> None:
+    """Time every case and write the results as JSON"""
+    spec = SyntheticSpec(
+        n_shots=shots, shape=(height, width),
+        compression=None if compression == 'none' else compression,
+        timestamp_jitter=timestamp_jitter
+    )
+    results = run_benchmarks(spec, files, repeat, warmup, select)
+    for result in results:
+        row = result.to_dict()
+        throughput = f"{row['mb_per_s']:10.1f} MB/s" if row['mb_per_s'] else ""
+        click.echo(f"{result.name:<40} {row['min'] * 1e3:10.2f} ms  (median {row['median'] * 1e3:.2f} ms) {throughput}")
+    file = save_results(results, spec, output, n_files=files, repeat=repeat, warmup=warmup)
+    click.echo(f"Results written to '{file}'")
+
+
+@benchmark.command()
+@click.argument('old_file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('new_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--stat', type=click.Choice(['min', 'median', 'mean']), default='min')
+def compare(old_file: str, new_file: str, stat: str) -> None:
+    """Compare the results of two runs, e.g. of two commits"""
+    click.echo(compare_results(old_file, new_file, stat).to_string(float_format=lambda v: f"{v:.4g}"))
+
+
+def _int_list(text: str) -> list[int]:
+    return [int(v) for v in text.split(",")]
+
+
+@benchmark.command()
+@click.option('--workers', type=str, default='1,2,4', help='Comma separated worker counts')
+@click.option('--shots', type=str, default='100', help='Comma separated shots per file')
+@click.option('--shapes', type=str, default='256x512', help='Comma separated frame shapes HxW')
+@click.option('--compression', type=str, default='none,lz4', help='Comma separated compressions')
+@click.option('--scans', type=int, default=None, help='Scans per point, the largest worker count by default')
+@click.option('--files', type=int, default=10, help='Files per scan')
+@click.option('--root', type=click.Path(file_okay=False), default=None, help='Directory of the synthetic data')
+@click.option('--output', type=click.Path(file_okay=False), default=None, help='Output directory, logs/benchmark/... by default')
+def scaling(
+    workers: str, shots: str, shapes: str, compression: str, scans: Optional[int],
+    files: int, root: Optional[str], output: Optional[str]
+) -> None:
+    """Sweep processing_main over workers, data size and compression"""
+    df = run_scaling(
+        _int_list(workers),
+        _int_list(shots),
+        [tuple(int(v) for v in shape.split("x")) for shape in shapes.split(",")],
+        [None if name == 'none' else name for name in compression.split(",")],
+        scans, files, root
+    )
+    columns = [
+        "workers", "n_shots", "height", "width", "compression", "frames_per_s", "disk_mb_per_s",
+        "raw_mb_per_s", "max_peak_rss_mb", "cpu_per_worker", "speedup", "efficiency"
+    ]
+    click.echo(df[columns].to_string(index=False, float_format=lambda v: f"{v:.3g}"))
+    if (df["returncodes"].map(any)).any():
+        click.echo("Some workers failed, see their errors above", err=True)
+    click.echo(f"Table and plots written to '{save_scaling(df, output)}'")
+
+
+@benchmark.command()
+@click.option('--repeat', type=int, default=5, help='Runs per entry point')
+def startup(repeat: int) -> None:
+    """Check the startup time and imports of the command line entry points"""
+    click.echo(f"{'interpreter':<20} {baseline(repeat):6.2f} s")
+    results = [check_entry_point(entry_point, repeat) for entry_point in ENTRY_POINTS]
+    for result in results:
+        status = "ok" if result.ok else "FAIL"
+        click.echo(f"{result.name:<20} {result.best:6.2f} s  (budget {result.budget:.2f} s)  {status}")
+        if result.forbidden_imports:
+            click.echo(f"{'':<20} imports {', '.join(result.forbidden_imports)} at startup")
+    if not all(result.ok for result in results):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,271 @@
+"""
+Micro-benchmarks of the processing chain on synthetic data.
+
+Every case times one step on a synthetic experiment (see `src.benchmark.synthetic`):
+    loader.*        HDF5FileLoader on one file and its get_data
+    preprocess.*    each ImagesQbpmProcessor on the pump-on shots of one file
+    processor.*     CoreProcessor on the whole scan
+    saver.*         each SaverStrategy writing the processed scan
+    analyzer.*      DataAnalyzer opening the processed scan and analyze_by_roi
+
+Results are written as JSON with the commit they were measured on, so two commits are
+compared with `compare_results`.
+
+Usage:
+    python -m src.benchmark run --shots 100 --height 256 --width 512 --compression lz4
+    python -m src.benchmark compare logs/benchmark/OLD.json logs/benchmark/NEW.json
+"""
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from dataclasses import dataclass, field, asdict
+from statistics import mean, median, pstdev
+from typing import Any, Callable, Optional
+
+import numpy as np
+import pandas as pd
+from roi_rectangle import RoiRectangle
+
+from src.benchmark.synthetic import SyntheticSpec, create_experiment
+from src.processor.core import CoreProcessor
+from src.processor.loader import HDF5FileLoader
+from src.processor.saver import get_saver_strategy
+from src.analyzer.core import DataAnalyzer
+from src.preprocessor.image_qbpm_preprocessor import (
+    ImagesQbpmProcessor,
+    create_pohang,
+    create_drift_corrector,
+    subtract_dark_background,
+    normalize_images_by_qbpm,
+    equalize_intensities,
+    remove_outliers_using_ransac,
+)
+from src.utils.file_util import get_run_scan_directory
+from src.logger import setup_logger
+from src.config.config import use_config_file
+
+
+RESULTS_DIR = os.path.join("logs", "benchmark")
+
+
+@dataclass
+class BenchmarkResult:
+    """Timings of one benchmark case in seconds."""
+    name: str
+    times: list[float]
+    n_bytes: int = 0
+    n_frames: int = 0
+
+    @property
+    def best(self) -> float:
+        return min(self.times)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            **asdict(self),
+            "min": self.best,
+            "median": median(self.times),
+            "mean": mean(self.times),
+            "std": pstdev(self.times),
+            "mb_per_s": self.n_bytes / self.best / 1e6 if self.n_bytes else None,
+            "frames_per_s": self.n_frames / self.best if self.n_frames else None,
+        }
+
+
+@dataclass
+class BenchmarkCase:
+    """A step to time. `n_bytes` and `n_frames` are the data it handles per call, for throughputs."""
+    name: str
+    func: Callable[[], Any]
+    n_bytes: int = 0
+    n_frames: int = 0
+    setup: Optional[Callable[[], Any]] = field(default=None, repr=False)
+
+
+def measure(func: Callable[[], Any], repeat: int = 5, warmup: int = 1, setup: Optional[Callable[[], Any]] = None) -> list[float]:
+    """
+    Time `func` `repeat` times after `warmup` untimed calls.
+
+    Parameters:
+    - func (Callable[[], Any]): The step to time.
+    - repeat (int): Number of timed calls.
+    - warmup (int): Number of calls before timing, e.g. to fill caches and import lazily.
+    - setup (Callable[[], Any], optional): Untimed call before every call of `func`.
+
+    Returns:
+    - list[float]: Wall time of every timed call in seconds.
+    """
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        func()
+    times: list[float] = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def build_cases(spec: SyntheticSpec, scan_dir: str, analysis_dir: str) -> list[BenchmarkCase]:
+    """Return the benchmark cases on the synthetic scan in `scan_dir`."""
+    logger = setup_logger()
+    files = sorted(name for name in os.listdir(scan_dir) if name.endswith(".h5"))
+    file = os.path.join(scan_dir, files[len(files) // 2])
+    height, width = spec.shape
+    roi_rect = RoiRectangle(x1=width // 2 - 16, y1=height // 2 - 16, x2=width // 2 + 16, y2=height // 2 + 16)
+
+    loader = HDF5FileLoader(file)
+    data = loader.get_data()
+    images_qbpm = (data["pon"], data["pon_qbpm"])
+    file_frames = len(loader.images)
+    file_bytes = loader.images.nbytes
+    scan_frames = file_frames * len(files)
+    scan_bytes = file_bytes * len(files)
+
+    cases = [
+        BenchmarkCase("loader.HDF5FileLoader", lambda: HDF5FileLoader(file), file_bytes, file_frames),
+        BenchmarkCase("loader.get_data", loader.get_data, file_bytes, file_frames),
+    ]
+
+    preprocessors: dict[str, ImagesQbpmProcessor] = {
+        "subtract_dark_background": subtract_dark_background,
+        "normalize_images_by_qbpm": normalize_images_by_qbpm,
+        "equalize_intensities": equalize_intensities,
+        "remove_outliers_using_ransac": remove_outliers_using_ransac,
+        "pohang": create_pohang(roi_rect),
+        "drift_corrector": create_drift_corrector(roi_rect),
+    }
+    for name, preprocessor in preprocessors.items():
+        cases.append(BenchmarkCase(
+            f"preprocess.{name}", lambda preprocessor=preprocessor: preprocessor(images_qbpm),
+            images_qbpm[0].nbytes, len(images_qbpm[0])
+        ))
+
+    processor = CoreProcessor(HDF5FileLoader, scan_dir, logger=logger)
+    cases.append(BenchmarkCase(
+        "processor.CoreProcessor",
+        lambda: CoreProcessor(HDF5FileLoader, scan_dir, logger=logger),
+        scan_bytes, scan_frames
+    ))
+    data_dict = processor.result["no_processing"]
+    result_bytes = sum(np.asarray(value).nbytes for value in data_dict.values())
+
+    processed_files: dict[str, str] = {}
+    for file_type in ("npz", "mat", "h5"):
+        saver = get_saver_strategy(file_type)
+        saver.save(1, 1, data_dict)
+        processed_files[file_type] = saver.file
+        cases.append(BenchmarkCase(
+            f"saver.{file_type}", lambda saver=saver: saver.save(1, 1, data_dict), result_bytes, len(data_dict["delay"])
+        ))
+
+    analyzer = DataAnalyzer(processed_files["npz"])
+    cases += [
+        BenchmarkCase("analyzer.DataAnalyzer", lambda: DataAnalyzer(processed_files["npz"]), result_bytes),
+        BenchmarkCase("analyzer.DataAnalyzer_lazy", lambda: DataAnalyzer(processed_files["npz"], lazy=True)),
+        BenchmarkCase("analyzer.DataAnalyzer_h5", lambda: DataAnalyzer(processed_files["h5"]), result_bytes),
+        BenchmarkCase("analyzer.analyze_by_roi", lambda: analyzer.analyze_by_roi(roi_rect)),
+    ]
+    logger.info(f"Benchmark data in {analysis_dir}")
+    return cases
+
+
+def run_benchmarks(
+    spec: SyntheticSpec,
+    n_files: int = 10,
+    repeat: int = 5,
+    warmup: int = 1,
+    select: Optional[str] = None,
+    root: Optional[str] = None
+) -> list[BenchmarkResult]:
+    """
+    Create a synthetic experiment and time every case on it.
+
+    Parameters:
+    - spec (SyntheticSpec): Content and layout of the raw files.
+    - n_files (int): Files in the scan.
+    - repeat (int), warmup (int): See `measure`.
+    - select (str, optional): Only run the cases whose name contains this text.
+    - root (str, optional): Directory of the experiment. Defaults to a temporary directory that is removed.
+
+    Returns:
+    - list[BenchmarkResult]: Timings of every case.
+    """
+    with tempfile.TemporaryDirectory(prefix="xfel_benchmark_") as tmp_dir:
+        config_file = create_experiment(root if root is not None else tmp_dir, spec, n_files)
+        with use_config_file(config_file) as config:
+            scan_dir = get_run_scan_directory(config.path.load_dir, 1, 1)
+            cases = build_cases(spec, scan_dir, config.path.analysis_dir)
+            results = []
+            for case in cases:
+                if select is not None and select not in case.name:
+                    continue
+                times = measure(case.func, repeat, warmup, case.setup)
+                results.append(BenchmarkResult(case.name, times, case.n_bytes, case.n_frames))
+    return results
+
+
+def get_git_state() -> dict[str, Any]:
+    """Return the current commit and whether the working tree has changes."""
+    def git(*args: str) -> str:
+        return subprocess.run(["git", *args], capture_output=True, text=True, check=False).stdout.strip()
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def save_results(results: list[BenchmarkResult], spec: SyntheticSpec, file: Optional[str] = None, **settings: Any) -> str:
+    """
+    Write the results as JSON with the commit, the machine and the synthetic data they were measured on.
+
+    Returns:
+    - str: The written file, 'logs/benchmark/{time}_{commit}.json' by default.
+    """
+    git_state = get_git_state()
+    if file is None:
+        file = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d_%H%M%S')}_{git_state['commit'][:8] or 'nogit'}.json")
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        **git_state,
+        "platform": {
+            "python": platform.python_version(),
+            "system": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+        },
+        "spec": asdict(spec),
+        "settings": settings,
+        "results": [result.to_dict() for result in results],
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+    with open(file, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    return file
+
+
+def load_results(file: str) -> dict[str, Any]:
+    with open(file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare_results(old_file: str, new_file: str, stat: str = "min") -> pd.DataFrame:
+    """
+    Compare two result files case by case.
+
+    Returns:
+    - pd.DataFrame: `stat` of both files and their ratio new / old by case, so values above 1 are slowdowns.
+    """
+    old = {result["name"]: result[stat] for result in load_results(old_file)["results"]}
+    new = {result["name"]: result[stat] for result in load_results(new_file)["results"]}
+    names = [name for name in old if name in new] + [name for name in new if name not in old]
+    df = pd.DataFrame(
+        {"old": [old.get(name, np.nan) for name in names], "new": [new.get(name, np.nan) for name in names]},
+        index=pd.Index(names, name="case"),
+    )
+    df["ratio"] = df["new"] / df["old"]
+    return df
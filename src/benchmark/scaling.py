@@ -0,0 +1,307 @@
+"""
+End-to-end scaling harness of `processing_main.process_scan` on synthetic scans.
+
+Every point of the sweep (workers x shots per file x frame shape x compression) processes the same
+`n_scans` scans of a synthetic experiment, split over `workers` processes. Every worker is a separate
+Python process running `process_scan` (load, preprocess, npz and mat save) on its scans, and is sampled
+with psutil for
+    - the peak RSS of the worker and its children (e.g. the scan index pool),
+    - the bytes it read (`io_counters`, where the platform reports them),
+    - its user + system CPU time.
+Each point reports frames/s, MB/s of compressed (on disk) and uncompressed data, peak RSS per process,
+and CPU utilization. `cpu_per_worker` near 1 means the workers are compute bound (decompression and
+preprocessing); speedup flattening while `cpu_per_worker` drops points to the disk or memory bandwidth.
+
+Files that were just written are usually still in the page cache. To measure the disk, put `root`
+on the filesystem of interest and use more data than fits in memory.
+
+Usage:
+    python -m src.benchmark scaling --workers 1,2,4,8 --shots 100,400 --compression none,lz4
+"""
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import dataclass, asdict
+from typing import Any, Optional
+
+import numpy as np
+import pandas as pd
+import psutil
+
+from src.benchmark.synthetic import SyntheticSpec, create_experiment
+from src.config.config import CONFIG_ENV_VAR, load_config, use_config_file
+
+
+@dataclass
+class ProcessStats:
+    """Resource use of one worker process and its children."""
+    peak_rss: int = 0
+    cpu_time: float = 0.
+    read_bytes: int = 0
+
+
+@dataclass
+class ScalingPoint:
+    """Measurements of one point of the sweep."""
+    workers: int
+    n_shots: int
+    height: int
+    width: int
+    compression: str
+    n_scans: int
+    n_files: int
+    wall_time: float
+    n_frames: int
+    disk_bytes: int
+    raw_bytes: int
+    peak_rss: list[int]
+    cpu_time: float
+    read_bytes: int
+    returncodes: list[int]
+
+    @property
+    def frames_per_s(self) -> float:
+        return self.n_frames / self.wall_time
+
+    @property
+    def cpu_per_worker(self) -> float:
+        """CPU seconds per worker per wall second, 1 if every worker kept one core busy."""
+        return self.cpu_time / self.wall_time / self.workers
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            **asdict(self),
+            "frames_per_s": self.frames_per_s,
+            "disk_mb_per_s": self.disk_bytes / self.wall_time / 1e6,
+            "raw_mb_per_s": self.raw_bytes / self.wall_time / 1e6,
+            "read_mb_per_s": self.read_bytes / self.wall_time / 1e6,
+            "max_peak_rss_mb": max(self.peak_rss) / 1e6 if self.peak_rss else 0.,
+            "cpu_per_worker": self.cpu_per_worker,
+            "cpu_utilization": self.cpu_time / self.wall_time / (os.cpu_count() or 1),
+        }
+
+
+def _sample(process: psutil.Process, stats: ProcessStats, cpu_times: dict[int, float], read_bytes: dict[int, int]) -> None:
+    """Update `stats` with one sample of `process` and its children."""
+    rss = 0
+    try:
+        tree = [process] + process.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return
+    for member in tree:
+        try:
+            with member.oneshot():
+                rss += member.memory_info().rss
+                times = member.cpu_times()
+                cpu_times[member.pid] = times.user + times.system
+                if hasattr(member, "io_counters"):
+                    read_bytes[member.pid] = member.io_counters().read_bytes
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+    stats.peak_rss = max(stats.peak_rss, rss)
+    stats.cpu_time = sum(cpu_times.values())
+    stats.read_bytes = sum(read_bytes.values())
+
+
+def run_workers(config_file: str, scan_groups: list[list[int]], roi: tuple[int, int, int, int], interval: float = 0.05) -> tuple[float, list[ProcessStats], list[int]]:
+    """
+    Start one worker process per scan group and sample them until all exit.
+
+    Returns:
+    - tuple[float, list[ProcessStats], list[int]]: Wall time, resource use and return code of every worker.
+    """
+    env = {**os.environ, CONFIG_ENV_VAR: os.path.abspath(config_file)}
+    command = [sys.executable, "-m", "src.benchmark.scaling", "--roi", ",".join(map(str, roi))]
+    start = time.perf_counter()
+    popens = [
+        subprocess.Popen(command + [str(scan_n) for scan_n in scans], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        for scans in scan_groups
+    ]
+    processes = [psutil.Process(popen.pid) for popen in popens]
+    stats = [ProcessStats() for _ in popens]
+    cpu_times: list[dict[int, float]] = [{} for _ in popens]
+    read_bytes: list[dict[int, int]] = [{} for _ in popens]
+
+    # stderr is drained by threads so that chatty workers do not block on a full pipe
+    stderr_tails: list[list[bytes]] = [[] for _ in popens]
+    drainers = [
+        _start_drainer(popen.stderr, tail) for popen, tail in zip(popens, stderr_tails)
+    ]
+    while any(popen.poll() is None for popen in popens):
+        for i, popen in enumerate(popens):
+            if popen.poll() is None:
+                _sample(processes[i], stats[i], cpu_times[i], read_bytes[i])
+        time.sleep(interval)
+    wall_time = time.perf_counter() - start
+    for drainer in drainers:
+        drainer.join()
+
+    returncodes = [popen.returncode for popen in popens]
+    for returncode, tail in zip(returncodes, stderr_tails):
+        if returncode != 0:
+            sys.stderr.write(b"".join(tail[-20:]).decode(errors="replace"))
+    return wall_time, stats, returncodes
+
+
+def _start_drainer(stream, tail: list[bytes]) -> threading.Thread:
+    def drain() -> None:
+        for line in stream:
+            tail.append(line)
+            del tail[:-20]
+    thread = threading.Thread(target=drain, daemon=True)
+    thread.start()
+    return thread
+
+
+def _data_sizes(load_dir: str, spec: SyntheticSpec, scans: list[int]) -> tuple[int, int, int, int]:
+    """Return the number of files, frames, bytes on disk and uncompressed image bytes of the scans of run 1."""
+    n_files = disk_bytes = 0
+    for scan_n in scans:
+        scan_dir = os.path.join(load_dir, "run=001", f"scan={scan_n:0>3}")
+        for name in os.listdir(scan_dir):
+            n_files += 1
+            disk_bytes += os.path.getsize(os.path.join(scan_dir, name))
+    n_frames = n_files * spec.n_shots
+    return n_files, n_frames, disk_bytes, n_frames * spec.frame_bytes
+
+
+def run_scaling(
+    workers: list[int],
+    shots: list[int],
+    shapes: list[tuple[int, int]],
+    compressions: list[Optional[str]],
+    n_scans: Optional[int] = None,
+    n_files: int = 10,
+    root: Optional[str] = None,
+) -> pd.DataFrame:
+    """
+    Run the sweep.
+
+    Parameters:
+    - workers (list[int]): Worker process counts.
+    - shots (list[int]): Shots per file, the unit the loader reads and preprocesses at once.
+    - shapes (list[tuple[int, int]]): Detector frame shapes (H, W).
+    - compressions (list[str, optional]): Compressions of the raw files, see `SyntheticSpec`.
+    - n_scans (int, optional): Scans processed at every point. Defaults to the largest worker count.
+    - n_files (int): Files per scan.
+    - root (str, optional): Directory of the synthetic experiments. Defaults to 'benchmark' in the configured cache directory.
+
+    Returns:
+    - pd.DataFrame: One row per point with the throughputs, peak RSS and CPU utilization.
+    """
+    n_scans = max(workers) if n_scans is None else n_scans
+    root = os.path.join(load_config().path.cache_dir, "benchmark") if root is None else root
+    rows: list[dict[str, Any]] = []
+    for n_shots, shape, compression in itertools.product(shots, shapes, compressions):
+        spec = SyntheticSpec(n_shots=n_shots, shape=shape, compression=compression)
+        experiment_dir = os.path.join(root, f"shots={n_shots}_shape={shape[0]}x{shape[1]}_{compression or 'none'}")
+        shutil.rmtree(experiment_dir, ignore_errors=True)
+        config_file = create_experiment(experiment_dir, spec, n_files, runs={1: n_scans})
+        with use_config_file(config_file) as config:
+            cache_dir, load_dir = config.path.cache_dir, config.path.load_dir
+        scans = list(range(1, n_scans + 1))
+        n_total_files, n_frames, disk_bytes, raw_bytes = _data_sizes(load_dir, spec, scans)
+        roi = (0, 0, shape[1], shape[0])
+
+        for n_workers in workers:
+            # Every point starts without the preprocess cache, scan indices and outputs of the previous one
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            scan_groups = [group for group in np.array_split(scans, n_workers) if len(group)]
+            wall_time, stats, returncodes = run_workers(config_file, [list(map(int, group)) for group in scan_groups], roi)
+            point = ScalingPoint(
+                workers=len(scan_groups), n_shots=n_shots, height=shape[0], width=shape[1],
+                compression=compression or "none", n_scans=n_scans, n_files=n_total_files,
+                wall_time=wall_time, n_frames=n_frames, disk_bytes=disk_bytes, raw_bytes=raw_bytes,
+                peak_rss=[stat.peak_rss for stat in stats], cpu_time=sum(stat.cpu_time for stat in stats),
+                read_bytes=sum(stat.read_bytes for stat in stats), returncodes=returncodes,
+            )
+            rows.append(point.to_dict())
+
+    df = pd.DataFrame(rows)
+    keys = ["n_shots", "height", "width", "compression"]
+    baseline = df.groupby(keys)["frames_per_s"].transform("first")
+    df["speedup"] = df["frames_per_s"] / baseline
+    df["efficiency"] = df["speedup"] / df["workers"] * df.groupby(keys)["workers"].transform("first")
+    return df
+
+
+def plot_scaling(df: pd.DataFrame, file: str) -> None:
+    """Plot frames/s, MB/s, peak RSS and CPU per worker against the worker count, one line per data setting."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    panels = [
+        ("frames_per_s", "Frames / s"),
+        ("raw_mb_per_s", "Uncompressed MB / s"),
+        ("max_peak_rss_mb", "Peak RSS per process [MB]"),
+        ("cpu_per_worker", "CPU s per worker per s"),
+    ]
+    fig, axes = plt.subplots(2, 2, figsize=(12, 9))
+    for (column, label), ax in zip(panels, axes.flat):
+        for (n_shots, height, width, compression), group in df.groupby(["n_shots", "height", "width", "compression"]):
+            ax.plot(group["workers"], group[column], "o-", label=f"{n_shots} shots, {height}x{width}, {compression}")
+        if column == "frames_per_s":
+            # Linear scaling from the first point of every setting
+            for _, group in df.groupby(["n_shots", "height", "width", "compression"]):
+                first = group.iloc[0]
+                ax.plot(group["workers"], first[column] * group["workers"] / first["workers"], ":", color="gray")
+        ax.set_xlabel("Workers")
+        ax.set_ylabel(label)
+        ax.set_xscale("log", base=2)
+        ax.grid(True, alpha=0.3)
+    axes[0, 0].legend(fontsize="small")
+    fig.suptitle(f"process_scan scaling ({os.cpu_count()} CPUs)")
+    fig.tight_layout()
+    fig.savefig(file, dpi=120)
+    plt.close(fig)
+
+
+def save_scaling(df: pd.DataFrame, output_dir: Optional[str] = None) -> str:
+    """
+    Write the table as CSV and JSON and the plots as PNG.
+
+    Returns:
+    - str: The output directory, 'logs/benchmark/scaling_{time}' by default.
+    """
+    from src.benchmark.micro import RESULTS_DIR, get_git_state
+
+    if output_dir is None:
+        output_dir = os.path.join(RESULTS_DIR, f"scaling_{time.strftime('%Y%m%d_%H%M%S')}")
+    os.makedirs(output_dir, exist_ok=True)
+    df.to_csv(os.path.join(output_dir, "scaling.csv"), index=False)
+    with open(os.path.join(output_dir, "scaling.json"), "w", encoding="utf-8") as f:
+        json.dump(
+            {**get_git_state(), "cpu_count": os.cpu_count(), "points": json.loads(df.to_json(orient="records"))},
+            f, indent=2
+        )
+    plot_scaling(df, os.path.join(output_dir, "scaling.png"))
+    return output_dir
+
+
+def _worker(scans: list[int], roi: tuple[int, int, int, int]) -> None:
+    """Process `scans` of run 1 with one full frame ROI, as `processing_main.main` does for ROI scans."""
+    from roi_rectangle import RoiRectangle
+    import processing_main
+
+    x1, y1, x2, y2 = roi
+    for scan_n in scans:
+        processing_main.process_scan(1, scan_n, [RoiRectangle(x1=x1, y1=y1, x2=x2, y2=y2)])
+
+
+if __name__ == "__main__":
+    import click
+
+    @click.command()
+    @click.argument("scans", type=int, nargs=-1)
+    @click.option("--roi", type=str, required=True, help="x1,y1,x2,y2")
+    def worker(scans: tuple[int, ...], roi: str) -> None:
+        """Scaling harness worker, started by `run_workers`"""
+        _worker(list(scans), tuple(int(v) for v in roi.split(",")))
+
+    worker()  # pylint: disable=no-value-for-parameter
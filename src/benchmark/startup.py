@@ -0,0 +1,100 @@
+"""
+Startup time guard of the command line entry points.
+
+Every entry point is started in fresh interpreters (`python -m ... --help`, or an import for
+modules without a CLI) and its best wall time is compared with a budget. The heavy packages
+it must not import at startup are checked too, which catches regressions independently of the
+speed of the machine: a module-level `import matplotlib.pyplot` in a shared module shows up
+here before anyone notices the delay.
+
+Usage:
+    python -m src.benchmark startup            # exits with 1 if an entry point is over budget
+"""
+import json
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field, asdict
+from typing import Any
+
+
+@dataclass(frozen=True)
+class EntryPoint:
+    """
+    A command whose startup is guarded.
+
+    Attributes:
+        name (str): Name in the results.
+        args (tuple[str, ...]): Arguments of the interpreter.
+        module (str): Module whose imports are checked.
+        budget (float): Maximum wall time of the best run [s], including the interpreter.
+        forbidden (tuple[str, ...]): Top-level packages (or submodules) the module must not import.
+    """
+    name: str
+    args: tuple[str, ...]
+    module: str
+    budget: float
+    forbidden: tuple[str, ...] = ()
+
+
+ENTRY_POINTS: tuple[EntryPoint, ...] = (
+    EntryPoint(
+        "file_check", ("-m", "src.inspection", "--help"), "src.inspection.__main__", 0.8,
+        ("pandas", "scipy", "matplotlib", "sklearn", "h5py", "tifffile"),
+    ),
+    EntryPoint(
+        "gui_cli", ("-m", "src.gui", "--help"), "src.gui.__main__", 0.9,
+        ("pandas", "scipy", "matplotlib", "sklearn", "tifffile"),
+    ),
+    EntryPoint(
+        "processing_main", ("-c", "import processing_main"), "processing_main", 2.,
+        ("matplotlib", "sklearn", "scipy.optimize", "scipy.signal", "scipy.stats", "tifffile"),
+    ),
+)
+
+
+@dataclass
+class StartupResult:
+    name: str
+    times: list[float]
+    budget: float
+    forbidden_imports: list[str] = field(default_factory=list)
+
+    @property
+    def best(self) -> float:
+        return min(self.times)
+
+    @property
+    def ok(self) -> bool:
+        return self.best <= self.budget and not self.forbidden_imports
+
+    def to_dict(self) -> dict[str, Any]:
+        return {**asdict(self), "best": self.best, "ok": self.ok}
+
+
+def time_command(args: tuple[str, ...], repeat: int = 5) -> list[float]:
+    """Return the wall times of `repeat` runs of the interpreter with `args`."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def imported_modules(module: str) -> set[str]:
+    """Return the modules loaded by importing `module` in a fresh interpreter."""
+    code = f"import sys, json, {module}; print(json.dumps(sorted(sys.modules)))"
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    return set(json.loads(output.strip().splitlines()[-1]))
+
+
+def check_entry_point(entry_point: EntryPoint, repeat: int = 5) -> StartupResult:
+    modules = imported_modules(entry_point.module)
+    forbidden = sorted(name for name in entry_point.forbidden if name in modules)
+    return StartupResult(entry_point.name, time_command(entry_point.args, repeat), entry_point.budget, forbidden)
+
+
+def baseline(repeat: int = 5) -> float:
+    """Return the best startup time of a bare interpreter, for reference."""
+    return min(time_command(("-c", "pass"), repeat))
@@ -0,0 +1,225 @@
+"""
+Synthetic PAL-XFEL raw data for benchmarks and tests without beamtime data.
+
+Files have the layout `HDF5FileLoader` reads:
+    metadata                                pandas DataFrame indexed by timestamp with the
+                                            'timestamp_info.RATE_<xray>_<pump>' and 'delay_value' columns
+    detector/<hutch>/<detector>/image       block0_items (timestamps), block0_values (N, H, W)
+    qbpm/<hutch>/qbpm1/waveforms.chX        axis1 (timestamps), block0_values (N, waveform length), X = 1..4
+
+Frames hold a Poisson background and a Gaussian Bragg peak scaled by the shot's QBPM signal,
+which moves and dims with the delay in pump-on shots.
+
+Example usage:
+    spec = SyntheticSpec(n_shots=200, shape=(512, 1024), compression="lz4")
+    config_file = create_experiment("/tmp/synthetic", spec, n_files=20)
+    with use_config_file(config_file):
+        processor = CoreProcessor(HDF5FileLoader, get_run_scan_directory(load_config().path.load_dir, 1, 1))
+"""
+import os
+from dataclasses import dataclass, asdict
+from typing import Any, Optional
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+import h5py
+import hdf5plugin
+import yaml
+
+from src.utils.file_util import create_run_scan_directory
+
+
+@dataclass(frozen=True)
+class SyntheticSpec:
+    """
+    Description of synthetic raw files.
+
+    Attributes:
+        n_shots (int): Shots per file.
+        shape (tuple[int, int]): Detector frame shape (H, W).
+        dtype (str): Detector dtype.
+        compression (str, optional): None, 'gzip', 'lz4', 'zstd' or 'blosc'.
+        compression_level (int, optional): Level of 'gzip', 'zstd' and 'blosc'.
+        chunk_shots (int): Shots per detector chunk.
+        timestamp_jitter (float): Fraction of shots missing from the QBPM stream, so they are dropped by the matching.
+        intensity_jitter (float): Relative shot to shot standard deviation of the beam intensity.
+        position_jitter (float): Shot to shot standard deviation of the peak position [pixel].
+        waveform_length (int): Samples per QBPM waveform.
+        background (float): Mean Poisson background per pixel.
+        peak_height (float): Peak height at the mean beam intensity.
+        hutch (str), detector (str), xray (str), pump_setting (str): Names used in the group and column names.
+        seed (int): Seed of the random numbers.
+    """
+    n_shots: int = 100
+    shape: tuple[int, int] = (256, 512)
+    dtype: str = "float32"
+    compression: Optional[str] = None
+    compression_level: Optional[int] = None
+    chunk_shots: int = 1
+    timestamp_jitter: float = 0.
+    intensity_jitter: float = 0.1
+    position_jitter: float = 0.
+    waveform_length: int = 10
+    background: float = 2.
+    peak_height: float = 200.
+    hutch: str = "eh1"
+    detector: str = "jungfrau2"
+    xray: str = "HX"
+    pump_setting: str = "15HZ"
+    seed: int = 0
+
+    @property
+    def frame_bytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    def compression_kwargs(self) -> dict[str, Any]:
+        """Return the h5py `create_dataset` keyword arguments of the compression."""
+        if self.compression is None:
+            return {}
+        if self.compression == "gzip":
+            return {"compression": "gzip", "compression_opts": self.compression_level or 4}
+        if self.compression == "lz4":
+            return dict(hdf5plugin.LZ4())
+        if self.compression == "zstd":
+            return dict(hdf5plugin.Zstd(clevel=self.compression_level or 3))
+        if self.compression == "blosc":
+            return dict(hdf5plugin.Blosc(cname="lz4", clevel=self.compression_level or 5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+        raise ValueError(f"Unsupported compression: {self.compression}")
+
+
+def make_frames(spec: SyntheticSpec, delay: float, pump_state: npt.NDArray[np.bool_], qbpm: npt.NDArray, rng: np.random.Generator) -> npt.NDArray:
+    """Return the detector frames (N, H, W) of one file."""
+    height, width = spec.shape
+    n_shots = len(pump_state)
+    center_x = width / 2 + rng.normal(0, spec.position_jitter, n_shots) if spec.position_jitter else np.full(n_shots, width / 2)
+    center_y = height / 2 + rng.normal(0, spec.position_jitter, n_shots) if spec.position_jitter else np.full(n_shots, height / 2)
+    # Pump-on shots: the peak moves and loses intensity with the delay
+    center_x = center_x + np.where(pump_state, 0.5 * np.tanh(delay), 0.)
+    height_scale = qbpm / qbpm.mean() * np.where(pump_state, 1 - 0.2 * (1 - np.exp(-max(delay, 0.))), 1.)
+
+    y = np.arange(height, dtype=np.float32)[np.newaxis, :, np.newaxis]
+    x = np.arange(width, dtype=np.float32)[np.newaxis, np.newaxis, :]
+    peak = np.exp(
+        -((x - center_x[:, np.newaxis, np.newaxis].astype(np.float32)) ** 2
+          + (y - center_y[:, np.newaxis, np.newaxis].astype(np.float32)) ** 2) / 18
+    )
+    frames = spec.peak_height * height_scale[:, np.newaxis, np.newaxis].astype(np.float32) * peak
+    frames += rng.poisson(spec.background, frames.shape).astype(np.float32)
+    return frames.astype(spec.dtype)
+
+
+def write_synthetic_file(file: str, spec: SyntheticSpec, delay: float = 0., file_index: int = 0) -> None:
+    """
+    Write one synthetic raw file.
+
+    Parameters:
+    - file (str): Path of the HDF5 file.
+    - spec (SyntheticSpec): Content and layout of the file.
+    - delay (float): Delay of all shots.
+    - file_index (int): Position of the file in its scan, for distinct timestamps and random numbers.
+    """
+    rng = np.random.default_rng((spec.seed, file_index))
+    timestamps = 10 ** 9 + (file_index * spec.n_shots + np.arange(spec.n_shots, dtype=np.int64)) * 66_666_667
+    pump_state = np.arange(spec.n_shots) % 2 == 1
+    intensity = np.maximum(1 + rng.normal(0, spec.intensity_jitter, spec.n_shots), 0.05)
+
+    metadata = pd.DataFrame(
+        {
+            f"timestamp_info.RATE_{spec.xray}_{spec.pump_setting}": pump_state,
+            "delay_value": np.full(spec.n_shots, delay),
+        },
+        index=pd.Index(timestamps, name="timestamp"),
+    )
+    tmp_file = f"{file}.{os.getpid()}.tmp"
+    metadata.to_hdf(tmp_file, key="metadata", mode="w")
+
+    # Shots missing from the QBPM stream are dropped by the timestamp matching
+    qbpm_kept = rng.random(spec.n_shots) >= spec.timestamp_jitter
+    with h5py.File(tmp_file, "a") as hf:
+        image_group = hf.create_group(f"detector/{spec.hutch}/{spec.detector}/image")
+        image_group["block0_items"] = timestamps
+        frames = make_frames(spec, delay, pump_state, intensity, rng)
+        image_group.create_dataset(
+            "block0_values", data=frames,
+            chunks=(min(spec.chunk_shots, spec.n_shots),) + tuple(spec.shape),
+            **spec.compression_kwargs()
+        )
+
+        qbpm_group = hf.create_group(f"qbpm/{spec.hutch}/qbpm1")
+        envelope = np.exp(-((np.arange(spec.waveform_length) - spec.waveform_length / 2) ** 2) / 4)
+        for channel in range(4):
+            channel_group = qbpm_group.create_group(f"waveforms.ch{channel + 1}")
+            channel_group["axis1"] = timestamps[qbpm_kept]
+            waveforms = intensity[:, np.newaxis] * envelope * rng.uniform(0.9, 1.1)
+            channel_group["block0_values"] = waveforms[qbpm_kept].astype(np.float32)
+    os.replace(tmp_file, file)
+
+
+def write_synthetic_scan(
+    load_dir: str,
+    run_n: int,
+    scan_n: int,
+    spec: SyntheticSpec,
+    n_files: int = 10,
+    delays: Optional[npt.NDArray] = None
+) -> str:
+    """
+    Write the files 'p0001.h5'... of a scan, one delay per file.
+
+    Returns:
+    - str: The scan directory.
+    """
+    scan_dir = create_run_scan_directory(load_dir, run_n, scan_n)
+    delays = np.linspace(-1, 5, n_files) if delays is None else np.asarray(delays)
+    for file_index, delay in enumerate(delays):
+        write_synthetic_file(os.path.join(scan_dir, f"p{file_index + 1:0>4}.h5"), spec, float(delay), file_index)
+    return scan_dir
+
+
+def create_experiment(
+    root: str,
+    spec: SyntheticSpec,
+    n_files: int = 10,
+    runs: Optional[dict[int, int]] = None
+) -> str:
+    """
+    Create a synthetic experiment: raw scans, a dark file and a config file using them.
+
+    Parameters:
+    - root (str): Directory of the experiment, holding 'raw', 'analysis' and 'config.yaml'.
+    - spec (SyntheticSpec): Content and layout of the raw files.
+    - n_files (int): Files per scan.
+    - runs (dict[int, int], optional): Number of scans by run number. Defaults to one run with one scan.
+
+    Returns:
+    - str: The config file, to be used with `use_config_file`.
+    """
+    runs = {1: 1} if runs is None else runs
+    load_dir = os.path.join(root, "raw")
+    analysis_dir = os.path.join(root, "analysis")
+    for run_n, n_scans in runs.items():
+        for scan_n in range(1, n_scans + 1):
+            write_synthetic_scan(load_dir, run_n, scan_n, spec, n_files)
+
+    rng = np.random.default_rng(spec.seed)
+    os.makedirs(os.path.join(analysis_dir, "DARK"), exist_ok=True)
+    dark = rng.poisson(spec.background / 2, (10,) + tuple(spec.shape)).astype(np.float32)
+    np.save(os.path.join(analysis_dir, "DARK", "dark.npy"), dark)
+
+    config_dict = {
+        "runs": sorted(runs),
+        "path": {
+            "load_dir": load_dir, "analysis_dir": analysis_dir,
+            "output_dir": "output_data", "mat_dir": "mat_files", "processed_dir": "processed_data", "cache_dir": "cache",
+        },
+        "param": {
+            "hutch": spec.hutch, "detector": spec.detector, "xray": spec.xray, "pump_setting": spec.pump_setting,
+            "sdd": 1.3, "dps": 7.5e-5, "beam_energy": 9.7,
+        },
+        "synthetic": asdict(spec),
+    }
+    config_file = os.path.join(root, "config.yaml")
+    with open(config_file, "w", encoding="utf-8") as f:
+        yaml.safe_dump(config_dict, f, default_flow_style=False, sort_keys=False)
+    return config_file
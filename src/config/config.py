@@ -1,22 +1,59 @@
+import os
+from contextlib import contextmanager
 from pathlib import Path
 from functools import lru_cache
+from typing import Iterator
 
 import yaml
 
 from src.config.config_definitions import ExpConfig
 
 
+CONFIG_ENV_VAR = "XFEL_CONFIG"
+
+
+def get_config_file() -> Path:
+    """Return the config file, the repository's config.yaml unless `XFEL_CONFIG` names another one"""
+    if os.environ.get(CONFIG_ENV_VAR):
+        return Path(os.environ[CONFIG_ENV_VAR])
+    return Path(__file__).resolve().parent.parent.parent / "config.yaml"
+
+
 @lru_cache(maxsize=1)
 def load_config() -> ExpConfig:
     """load config file and return config object"""
-    config_file = Path(__file__).resolve().parent.parent.parent / "config.yaml"
+    config_file = get_config_file()
     with open(config_file, 'r', encoding="utf-8") as f:
-        config_dict = yaml.safe_load(f)
+        # The C loader, when PyYAML was built with it, parses several times faster
+        config_dict = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
     return ExpConfig(**config_dict)
 
 
 def save_config(config_dict: dict) -> None:
     """get config dict and save to file"""
-    config_file = Path(__file__).resolve().parent.parent.parent / "config.yaml"
+    config_file = get_config_file()
     with open(config_file, 'w', encoding="utf-8") as f:
         yaml.safe_dump(config_dict, f, default_flow_style=False, sort_keys=False)
+
+
+@contextmanager
+def use_config_file(config_file: str) -> Iterator[ExpConfig]:
+    """
+    Load the config from `config_file` inside the block, also in processes started from it.
+    Values derived from the config and cached elsewhere (e.g. `get_geometry`) are not reset.
+
+    Example usage:
+        with use_config_file("/tmp/synthetic/config.yaml") as config:
+            processing_main.process_scan(1, 1)
+    """
+    previous = os.environ.get(CONFIG_ENV_VAR)
+    os.environ[CONFIG_ENV_VAR] = os.path.abspath(config_file)
+    load_config.cache_clear()
+    try:
+        yield load_config()
+    finally:
+        if previous is None:
+            os.environ.pop(CONFIG_ENV_VAR, None)
+        else:
+            os.environ[CONFIG_ENV_VAR] = previous
+        load_config.cache_clear()
@@ -9,6 +9,7 @@ Classes:
     combining configuration parameters and paths.
 """
 import os
+from typing import Optional
 
 from pydantic import BaseModel, model_validator, Field
 
@@ -33,6 +34,11 @@ class ExpParams(BaseModel):
         x2 (int): The x2 setting.
         y1 (int): The y1 setting.
         y2 (int): The y2 setting.
+        sdd (float): Sample to detector distance [m].
+        dps (float): Detector pixel size [m].
+        beam_energy (float): X-ray energy [keV].
+        beam_x (float, optional): Beam center column on the detector [pixel]. Detector center if unset.
+        beam_y (float, optional): Beam center row on the detector [pixel]. Detector center if unset.
     """
     hutch: Hutch = Hutch.EH1
     detector: Detector = Detector.JUNGFRAU2
@@ -46,6 +52,8 @@ class ExpParams(BaseModel):
     dps: float = 7.5e-5
     beam_energy: float = 9.7
     sigma_factor: float = 1
+    beam_x: Optional[float] = None
+    beam_y: Optional[float] = None
     wavelength: float = None
 
     @model_validator(mode='before')
@@ -65,6 +73,10 @@ class ExpPaths(BaseModel):
     Attributes:
         load_dir (str): The load directory path.
         anaylsis_dir (str): The save directory path.
+        cache_dir (str): The preprocessing cache directory path.
+        staging_dir (str, optional): Local directory (e.g. on an SSD) where raw files of `load_dir` are
+            copied before they are read. Unset to read them in place.
+        staging_quota_gb (float): Disk quota of `staging_dir` in GB.
     """
     load_dir: str = ""
     analysis_dir: str = ""
@@ -72,6 +84,10 @@ class ExpPaths(BaseModel):
     mat_dir: str = "mat_files"
     processed_dir: str = "processed_data"
     output_dir: str = "output_data"
+    cache_dir: str = "cache"
+    # Not joined to analysis_dir, which is usually on the same network share as load_dir
+    staging_dir: Optional[str] = None
+    staging_quota_gb: float = 50.
 
     @model_validator(mode='before')
     @classmethod
@@ -82,6 +98,7 @@ class ExpPaths(BaseModel):
             values['mat_dir'] = os.path.join(analysis_dir, values['mat_dir'])
             values['processed_dir'] = os.path.join(analysis_dir, values['processed_dir'])
             values['output_dir'] = os.path.join(analysis_dir, values['output_dir'])
+            values['cache_dir'] = os.path.join(analysis_dir, values.get('cache_dir', 'cache'))
         return values
 
 
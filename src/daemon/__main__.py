@@ -0,0 +1,70 @@
+from typing import Optional
+
+import click
+
+from src.daemon.server import DEFAULT_HOST, DEFAULT_PORT
+
+
+@click.group()
+def daemon() -> None:
+    """Resident processing service"""
+
+
+@daemon.command()
+@click.option('--host', type=str, default=DEFAULT_HOST, help='Address to listen on')
+@click.option('--port', type=int, default=DEFAULT_PORT, help='Port to listen on')
+@click.option('--workers', type=int, default=2, help='Number of worker processes')
+def serve(host: str, port: int, workers: int) -> None:
+    """Start the daemon and serve jobs until interrupted"""
+    from src.daemon.server import serve as run_server
+
+    run_server(host, port, workers)
+
+
+@daemon.command()
+@click.argument('run_n', type=int)
+@click.argument('scan_nums', type=int, nargs=-1, required=True)
+@click.option('--host', type=str, default=DEFAULT_HOST, help='Address of the daemon')
+@click.option('--port', type=int, default=DEFAULT_PORT, help='Port of the daemon')
+@click.option('--no-validate', is_flag=True, help='Do not skip the files failing validation')
+@click.option('--crop/--full-frame', default=None, help="Crop to the scan's 'ROI_coords.json' [default: XFEL_CROP_TO_ROIS of the daemon]")
+@click.option('--detach', is_flag=True, help='Print the job ids instead of following the jobs')
+@click.option('--verbose', is_flag=True, help='Also show the progress of every file')
+def submit(run_n: int, scan_nums: tuple[int, ...], host: str, port: int, no_validate: bool, crop: Optional[bool], detach: bool, verbose: bool) -> None:
+    """Process scans of a run on the daemon"""
+    from src.daemon.client import ProcessingClient
+
+    client = ProcessingClient(host, port)
+    job_ids = [client.submit(run_n, scan_n, validate=not no_validate, crop=crop) for scan_n in scan_nums]
+    if detach:
+        click.echo(" ".join(map(str, job_ids)))
+        return
+
+    failed = False
+    for job_id in job_ids:
+        for event in client.events(job_id):
+            if event["event"] == "log" and (verbose or event["level"] != "TRACE"):
+                click.echo(f"[job {job_id}] {event['level']:<7} {event['message']}")
+            elif event["event"] == "done":
+                click.echo(f"[job {job_id}] done in {event['result']['seconds']:.1f} s")
+            elif event["event"] == "failed":
+                failed = True
+                click.echo(f"[job {job_id}] failed: {event['error']}", err=True)
+    if failed:
+        raise SystemExit(1)
+
+
+@daemon.command()
+@click.option('--host', type=str, default=DEFAULT_HOST, help='Address of the daemon')
+@click.option('--port', type=int, default=DEFAULT_PORT, help='Port of the daemon')
+def status(host: str, port: int) -> None:
+    """List the jobs of the daemon"""
+    from src.daemon.client import ProcessingClient
+
+    for job in ProcessingClient(host, port).status():
+        spec = job["spec"]
+        click.echo(f"{job['job']:>5}  run={spec['run']} scan={spec['scan']}  {job['status']}")
+
+
+if __name__ == '__main__':
+    daemon()
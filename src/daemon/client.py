@@ -0,0 +1,111 @@
+"""
+Client of the processing daemon, for the command line and notebooks.
+
+Example usage:
+    client = ProcessingClient()
+    job_id = client.submit(12, 3)
+    for event in client.events(job_id):
+        print(event["event"], event.get("message", ""))
+
+    # or block until the job ends
+    result = client.run(12, 3)
+"""
+import http.client
+import json
+from typing import Any, Iterator, Optional
+
+from roi_rectangle import RoiRectangle
+
+from src.daemon.server import DEFAULT_HOST, DEFAULT_PORT
+
+
+class DaemonError(RuntimeError):
+    """The daemon rejected a request or a job failed."""
+
+
+class ProcessingClient:
+    """
+    Submit jobs to a `ProcessingDaemon` and follow their progress.
+
+    Args:
+        host (str): Host of the daemon.
+        port (int): Port of the daemon.
+        timeout (float, optional): Socket timeout in seconds, None waits for events forever.
+    """
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, timeout: Optional[float] = None) -> None:
+        self.host: str = host
+        self.port: int = port
+        self.timeout: Optional[float] = timeout
+
+    def _request(self, method: str, path: str, body: Optional[dict[str, Any]] = None) -> http.client.HTTPResponse:
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+        connection.request(method, path, body=payload, headers=headers)
+        response = connection.getresponse()
+        if response.status >= 400:
+            raise DaemonError(json.loads(response.read() or b"{}").get("error", f"HTTP {response.status}"))
+        return response
+
+    def _json(self, method: str, path: str, body: Optional[dict[str, Any]] = None) -> Any:
+        with self._request(method, path, body) as response:
+            return json.loads(response.read())
+
+    def health(self) -> dict[str, Any]:
+        return self._json("GET", "/health")
+
+    def submit(
+        self,
+        run_n: int,
+        scan_n: int,
+        roi_rects: Optional[list[RoiRectangle]] = None,
+        validate: bool = True,
+        crop: Optional[bool] = None
+    ) -> int:
+        """
+        Queue the processing of a scan.
+
+        Parameters:
+        - run_n (int), scan_n (int): The scan to process.
+        - roi_rects (list[RoiRectangle], optional): ROIs to crop to. Without them, full frames are processed.
+        - validate (bool): Skip the files of the run that fail validation.
+        - crop (bool, optional): Without `roi_rects`, crop to the scan's 'ROI_coords.json'.
+          Defaults to `XFEL_CROP_TO_ROIS` of the daemon.
+
+        Returns:
+        - int: The job id.
+        """
+        spec: dict[str, Any] = {"run": run_n, "scan": scan_n, "validate": validate}
+        if crop is not None:
+            spec["crop"] = crop
+        if roi_rects:
+            spec["roi_rects"] = [[roi.x1, roi.y1, roi.x2, roi.y2] for roi in roi_rects]
+        return self._json("POST", "/jobs", spec)["job"]
+
+    def status(self, job_id: Optional[int] = None) -> Any:
+        """Return the status of a job, or of every job."""
+        return self._json("GET", "/jobs" if job_id is None else f"/jobs/{job_id}")
+
+    def events(self, job_id: int) -> Iterator[dict[str, Any]]:
+        """Yield the events of a job from its start, until it is done or failed."""
+        with self._request("GET", f"/jobs/{job_id}/events") as response:
+            for line in response:
+                if line.strip():
+                    yield json.loads(line)
+
+    def run(
+        self,
+        run_n: int,
+        scan_n: int,
+        roi_rects: Optional[list[RoiRectangle]] = None,
+        validate: bool = True,
+        crop: Optional[bool] = None
+    ) -> dict[str, Any]:
+        """Submit a job and wait for it. Raises `DaemonError` if it fails."""
+        job_id = self.submit(run_n, scan_n, roi_rects, validate, crop)
+        for event in self.events(job_id):
+            if event["event"] == "done":
+                return event["result"]
+            if event["event"] == "failed":
+                raise DaemonError(f"Job {job_id} failed: {event['error']}")
+        raise DaemonError(f"Lost the events of job {job_id}")
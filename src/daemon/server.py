@@ -0,0 +1,299 @@
+"""
+Resident processing service with warm worker processes.
+
+Every `processing_main` invocation pays for interpreter startup, imports, config parsing,
+dark loading and geometry setup before the first file is read. `ProcessingDaemon` pays
+them once: it keeps a pool of worker processes that import the processing code, parse the
+config and load the dark and detector geometry when they start, and runs jobs on them.
+
+Jobs are submitted over HTTP on localhost:
+    POST /jobs                  {"run": 12, "scan": 3, "roi_rects": [[x1, y1, x2, y2], ...]} -> {"job": ID}
+    GET  /jobs                  status of every job
+    GET  /jobs/ID               status of one job
+    GET  /jobs/ID/events        progress as newline delimited JSON, streamed until the job ends
+    GET  /health
+
+With `roi_rects`, only their union is processed and saved. Without it, full frames are processed,
+normalized with an automatic ROI, unless `"crop": true` (default `XFEL_CROP_TO_ROIS`) crops to the
+ROIs of 'ROI_coords.json' of the scan, as in `processing_main.main`. Results are saved as npz and mat.
+The config is read when the workers start; restart the daemon after changing it.
+
+Usage:
+    python -m src.daemon serve --workers 2
+    python -m src.daemon submit 12 3
+"""
+import itertools
+import json
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Iterator, Optional
+
+from src.logger import setup_logger, is_metric, Logger
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# Set in every worker process by `_init_worker`
+_events: Optional[queue.Queue] = None
+
+
+def _init_worker(events: queue.Queue) -> None:
+    """Import the processing code and fill the caches every job would otherwise build first."""
+    global _events  # pylint: disable=global-statement
+    _events = events
+
+    import processing_main  # noqa: F401  pylint: disable=unused-import,import-outside-toplevel
+    from src.preprocessor.generic_preprocessors import load_dark
+    from src.utils.geometry import get_geometry
+
+    get_geometry()
+    try:
+        load_dark()
+    except FileNotFoundError:
+        # Jobs that subtract the dark fail with the same error
+        pass
+
+
+def _ping() -> None:
+    """Task that makes the pool start a worker."""
+
+
+def _run_job(job_id: int, spec: dict[str, Any]) -> dict[str, Any]:
+    """Process one scan in a worker, forwarding its log records as progress events."""
+    from roi_rectangle import RoiRectangle
+    import processing_main
+    from src.inspection.hdf5_validator import validate_run, get_bad_files
+    from src.utils.file_util import get_run_scan_directory, get_roi_list
+
+    def forward(message) -> None:
+        record = message.record
+        _events.put({
+            "job": job_id, "event": "log", "level": record["level"].name,
+            "time": record["time"].timestamp(), "message": record["message"],
+        })
+
+    run_n, scan_n = int(spec["run"]), int(spec["scan"])
+    config = processing_main.config
+    # TRACE also forwards the per-file progress of CoreProcessor, which the console does not show
+    handler = processing_main.logger.add(
+        forward, level="TRACE", format="{message}", filter=lambda record: not is_metric(record)
+    )
+    start = time.perf_counter()
+    try:
+        _events.put({"job": job_id, "event": "started", "time": time.time()})
+        roi_rect = None
+        if spec.get("roi_rects"):
+            roi_rects = [RoiRectangle(x1=x1, y1=y1, x2=x2, y2=y2) for x1, y1, x2, y2 in spec["roi_rects"]]
+        elif spec.get("crop", processing_main.CROP_TO_ROIS):
+            roi_rects = get_roi_list(get_run_scan_directory(config.path.analysis_dir, run_n, scan_n))
+        else:
+            roi_rects = None
+        if not roi_rects:
+            # Workers cannot show the ROI selector
+            roi_rect = processing_main.get_roi(get_run_scan_directory(config.path.load_dir, run_n, scan_n))
+        bad_files = get_bad_files(validate_run(run_n)) if spec.get("validate", True) else set()
+        processing_main.process_scan(run_n, scan_n, roi_rects, bad_files=bad_files, roi_rect=roi_rect)
+    finally:
+        processing_main.logger.remove(handler)
+    return {"run": run_n, "scan": scan_n, "seconds": time.perf_counter() - start}
+
+
+@dataclass
+class Job:
+    """A submitted job and the progress events received so far."""
+    id: int
+    spec: dict[str, Any]
+    status: str = "queued"
+    submitted: float = field(default_factory=time.time)
+    result: Optional[dict[str, Any]] = None
+    error: Optional[str] = None
+    events: list[dict[str, Any]] = field(default_factory=list)
+    changed: threading.Condition = field(default_factory=threading.Condition, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def add_event(self, event: dict[str, Any]) -> None:
+        with self.changed:
+            if event["event"] in ("done", "failed"):
+                self.status = event["event"]
+            elif event["event"] == "started" and not self.finished:
+                self.status = "running"
+            self.events.append(event)
+            self.changed.notify_all()
+
+    def follow(self, timeout: float = 1.) -> Iterator[dict[str, Any]]:
+        """Yield every event, waiting for new ones until the job has finished."""
+        sent = 0
+        while True:
+            with self.changed:
+                while sent == len(self.events) and not self.finished:
+                    self.changed.wait(timeout)
+                events = self.events[sent:]
+                finished = self.finished
+            yield from events
+            sent += len(events)
+            if finished and sent == len(self.events):
+                return
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "job": self.id, "spec": self.spec, "status": self.status, "submitted": self.submitted,
+            "result": self.result, "error": self.error, "n_events": len(self.events),
+        }
+
+
+class ProcessingDaemon:
+    """
+    Pool of warm worker processes serving processing jobs.
+
+    Args:
+        max_workers (int): Number of worker processes, i.e. scans processed at the same time.
+        logger (Logger, optional): Logger of the daemon.
+    """
+    def __init__(self, max_workers: int = 2, logger: Optional[Logger] = None) -> None:
+        self.logger: Logger = logger if logger is not None else setup_logger()
+        # Workers are spawned, so they do not inherit the threads and locks of the server
+        context = multiprocessing.get_context("spawn")
+        self._manager = context.Manager()
+        self._events: queue.Queue = self._manager.Queue()
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=context, initializer=_init_worker, initargs=(self._events,)
+        )
+        self.jobs: dict[int, Job] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._dispatcher = threading.Thread(target=self._dispatch_events, daemon=True)
+        self._dispatcher.start()
+        # Start every worker now, so that the first jobs do not wait for the imports
+        for future in [self._executor.submit(_ping) for _ in range(max_workers)]:
+            future.result()
+
+    def submit(self, spec: dict[str, Any]) -> Job:
+        """Queue a job. `spec` needs 'run' and 'scan', and may hold 'roi_rects' and 'validate'."""
+        if "run" not in spec or "scan" not in spec:
+            raise ValueError("A job needs 'run' and 'scan'")
+        spec = {**spec, "run": int(spec["run"]), "scan": int(spec["scan"])}
+        with self._lock:
+            job = Job(next(self._ids), spec)
+            self.jobs[job.id] = job
+        future = self._executor.submit(_run_job, job.id, spec)
+        future.add_done_callback(lambda future: self._finish(job, future))
+        self.logger.info(f"Job {job.id} queued: {spec}")
+        return job
+
+    def _finish(self, job: Job, future: Future) -> None:
+        try:
+            job.result = future.result()
+        except Exception as e:  # pylint: disable=broad-except
+            job.error = f"{type(e).__name__}: {e}"
+            self.logger.error(f"Job {job.id} failed: {job.error}")
+        else:
+            self.logger.info(f"Job {job.id} done in {job.result['seconds']:.1f} s")
+        # Queued behind the job's last log records, which the worker put before returning
+        self._events.put({"job": job.id, "event": "failed" if job.error else "done"})
+
+    def _dispatch_events(self) -> None:
+        """Move the events of the workers to their jobs."""
+        while True:
+            try:
+                event = self._events.get()
+            except (EOFError, OSError):
+                return
+            if event is None:
+                return
+            job = self.jobs.get(event["job"])
+            if job is None:
+                continue
+            if event["event"] in ("done", "failed"):
+                event.update(time=time.time(), result=job.result, error=job.error)
+            job.add_event(event)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._events.put(None)
+        self._dispatcher.join(timeout=5)
+        self._manager.shutdown()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    daemon: ProcessingDaemon
+
+    def log_message(self, format: str, *args: Any) -> None:  # pylint: disable=redefined-builtin
+        self.daemon.logger.debug(format % args)
+
+    def _send_json(self, data: Any, status: int = 200) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _get_job(self, job_id: str) -> Optional[Job]:
+        job = self.daemon.jobs.get(int(job_id)) if job_id.isdigit() else None
+        if job is None:
+            self._send_json({"error": f"No job {job_id}"}, 404)
+        return job
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        if parts == ["health"]:
+            self._send_json({"status": "ok", "jobs": len(self.daemon.jobs)})
+        elif parts == ["jobs"]:
+            self._send_json([job.to_dict() for job in self.daemon.jobs.values()])
+        elif len(parts) == 2 and parts[0] == "jobs":
+            job = self._get_job(parts[1])
+            if job is not None:
+                self._send_json(job.to_dict())
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "events":
+            job = self._get_job(parts[1])
+            if job is None:
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            try:
+                for event in job.follow():
+                    self.wfile.write(json.dumps(event).encode() + b"\n")
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # The client stopped following, the job goes on
+                pass
+        else:
+            self._send_json({"error": f"Unknown path {self.path}"}, 404)
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        if self.path.rstrip("/") != "/jobs":
+            self._send_json({"error": f"Unknown path {self.path}"}, 404)
+            return
+        try:
+            spec = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            job = self.daemon.submit(spec)
+        except (ValueError, TypeError) as e:
+            self._send_json({"error": str(e)}, 400)
+            return
+        self._send_json({"job": job.id}, 201)
+
+
+def serve(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, max_workers: int = 2) -> None:
+    """Run the daemon until interrupted."""
+    daemon = ProcessingDaemon(max_workers)
+    handler = type("Handler", (_Handler,), {"daemon": daemon})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    daemon.logger.info(f"Processing daemon with {max_workers} workers listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.shutdown()
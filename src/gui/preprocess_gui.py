@@ -1,12 +1,11 @@
-import os
-
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.widgets import Slider
 
 from src.preprocessor.generic_preprocessors import get_linear_regression_confidence_bounds, ransac_regression
 from src.processor.loader import HDF5FileLoader
-from src.utils.file_util import get_run_scan_directory, get_file_list
+from src.processor.scan_index import get_scan_index
+from src.utils.file_util import get_run_scan_directory
 
 from src.config.config import load_config
 import numpy.typing as npt
@@ -91,8 +90,7 @@ def find_outliers_run_scan_gui(run: int, scan: int) -> float:
 
     config = load_config()
     scan_dir = get_run_scan_directory(config.path.load_dir, run, scan)
-    files = get_file_list(scan_dir)
-    file = os.path.join(scan_dir, files[len(files) // 2])
+    file = get_scan_index(scan_dir).middle_file()
 
     rr = HDF5FileLoader(file)
     images = rr.images
@@ -104,8 +102,7 @@ def find_outliers_run_scan_gui(run: int, scan: int) -> float:
 def RANSAC_regression_gui(run: int, scan: int) -> None:
     config = load_config()
     scan_dir = get_run_scan_directory(config.path.load_dir, run, scan)
-    files = get_file_list(scan_dir)
-    file = os.path.join(scan_dir, files[len(files) // 2])
+    file = get_scan_index(scan_dir).middle_file()
 
     rr = HDF5FileLoader(file)
     images = rr.images
@@ -1,19 +1,15 @@
-import os
-
 from typing import Optional
 
-import matplotlib.pyplot as plt
-from matplotlib import patches
 import numpy as np
 import numpy.typing as npt
 from roi_rectangle import RoiRectangle
 
-from src.processor.loader import get_hdf5_images
-from src.utils.file_util import get_run_scan_directory, get_file_list
+from src.utils.file_util import get_run_scan_directory
 from src.config.config import load_config, ExpConfig
 
 
 class RoiSelector:
+    """Draw a rectangle on an image with the mouse. matplotlib is only imported when a selection starts."""
     def __init__(self):
         self.drawing = False
         self.ix, self.iy = -1, -1
@@ -30,9 +26,11 @@ class RoiSelector:
                 self.fx, self.fy = self.ix, self.iy
                 if self.rect is not None:
                     self.rect.remove()
+                from matplotlib import patches
+
                 self.rect = patches.Rectangle((self.ix, self.iy), 1, 1, linewidth=1, edgecolor='r', facecolor='none')
                 self.ax.add_patch(self.rect)
-                plt.draw()
+                self.ax.figure.canvas.draw_idle()
 
     def on_mouse_release(self, event):
 
@@ -42,7 +40,7 @@ class RoiSelector:
             if self.rect is not None:
                 self.rect.set_width(self.fx - self.ix)
                 self.rect.set_height(self.fy - self.iy)
-                plt.draw()
+                self.ax.figure.canvas.draw_idle()
 
     def on_mouse_move(self, event):
 
@@ -51,11 +49,13 @@ class RoiSelector:
             if self.rect is not None:
                 self.rect.set_width(self.fx - self.ix)
                 self.rect.set_height(self.fy - self.iy)
-                plt.draw()
+                self.ax.figure.canvas.draw_idle()
 
     def select_roi(self, image: npt.NDArray) -> Optional[tuple[int, int, int, int]]:
         if image.ndim != 2:
             raise TypeError(f"Invalid shape {image.shape} for image data")
+        import matplotlib.pyplot as plt
+
         fig, self.ax = plt.subplots(figsize=(10, 6))
         self.ax.imshow(image)
 
@@ -73,17 +73,21 @@ class RoiSelector:
 
 
 def select_roi_by_run_scan(run: int, scan: int, index_mode: Optional[int] = None) -> Optional[RoiRectangle]:
+    # The loaders pull in pandas and h5py, which the ROI selector alone does not need
+    from src.processor.loader import get_hdf5_images
+    from src.processor.scan_index import get_scan_index
+
     config: ExpConfig = load_config()
     load_dir = config.path.load_dir
     scan_dir = get_run_scan_directory(load_dir, run, scan)
-    files = get_file_list(scan_dir)
+    files = get_scan_index(scan_dir).files()
 
     if index_mode is None:
         index = len(files) // 2
     elif isinstance(index_mode, int):
         index = index_mode
 
-    images = get_hdf5_images(os.path.join(scan_dir, files[index]), config)
+    images = get_hdf5_images(files[index], config)
     image = np.log1p(images.sum(axis=0))
     image = np.maximum(0, image)
     roi = RoiSelector().select_roi(image)
@@ -98,7 +102,9 @@ def get_roi_auto(
 ) -> RoiRectangle:
     """get roi_rect by max pixel"""
     center = np.unravel_index(np.argmax(image), image.shape)[::-1]
-    return RoiRectangle(center[0] - width, center[1] - width, center[0] + width, center[1] + width)
+    return RoiRectangle(
+        x1=int(center[0]) - width, y1=int(center[1]) - width, x2=int(center[0]) + width, y2=int(center[1]) + width
+    )
 
 
 if __name__ == "__main__":
@@ -2,40 +2,35 @@ import os
 from datetime import datetime
 
 import click
-import h5py
 
-from src.config.config import load_config
+from src.utils.catalog import RawDataCatalog, get_catalog
 from src.utils.file_util import get_run_scan_directory
 
 
-def list_files_in_directory(directory: str, show_size: bool, show_modified: bool, show_hdf5_keys: bool) -> None:
-    """List files in the given directory, optionally showing size, modification date, and HDF5 keys information."""
-    if not os.path.exists(directory):
-        raise click.ClickException(f"Directory '{directory}' not found.")
+def list_run_files(catalog: RawDataCatalog, run_n: int, show_size: bool, show_modified: bool, show_hdf5_keys: bool) -> None:
+    """List the cataloged files of a run, optionally showing size, modification date, and HDF5 keys information."""
+    if run_n not in catalog.runs():
+        raise click.ClickException(f"Run {run_n} not found in '{catalog.root_dir}'.")
 
-    click.echo(directory)
-    scan_names: list[str] = sorted(os.listdir(directory))
+    if show_hdf5_keys:
+        import h5py
 
-    for scan_name in scan_names:
-        click.echo(scan_name)
-        scan_dir = os.path.join(directory, scan_name)
-        file_names: list[str] = sorted(os.listdir(scan_dir))
+    click.echo(get_run_scan_directory(catalog.root_dir, run_n))
+    for scan_n in catalog.scans(run_n):
+        click.echo(f"scan={scan_n:0>3}")
 
-        for file_name in file_names:
-            file_path = os.path.join(scan_dir, file_name)
-            line = [file_name]
+        for record in catalog.files(run_n, scan_n):
+            line = [os.path.basename(record.path)]
 
             if show_size:
-                file_size = os.path.getsize(file_path)
-                line.append(f'size {file_size} (bytes)')
+                line.append(f'size {record.size} (bytes)')
 
             if show_modified:
-                time = os.path.getmtime(file_path)
-                date = datetime.fromtimestamp(time).strftime('%Y-%m-%d %H:%M:%S')
+                date = datetime.fromtimestamp(record.mtime_ns / 1e9).strftime('%Y-%m-%d %H:%M:%S')
                 line.append(f'date {date}')
 
-            if show_hdf5_keys and file_name.endswith('.h5'):
-                with h5py.File(file_path, 'r') as hdf5_file:
+            if show_hdf5_keys:
+                with h5py.File(record.path, 'r') as hdf5_file:
                     keys = list(hdf5_file.keys())
                     line.append(f'keys {", ".join(keys)}')
 
@@ -49,11 +44,10 @@ def list_files_in_directory(directory: str, show_size: bool, show_modified: bool
 @click.option('--keys', is_flag=True, help='Show keys contained in HDF5 files')
 def file_check(run_n: int, size: bool, date: bool, keys: bool) -> None:
     """List files of the run directory"""
-    config = load_config()
-    load_dir = config.path.load_dir
-    run_dir = get_run_scan_directory(load_dir, run_n)
+    catalog = get_catalog()
+    catalog.refresh(runs=[run_n])
 
-    list_files_in_directory(run_dir, size, date, keys)
+    list_run_files(catalog, run_n, size, date, keys)
 
 
 if __name__ == '__main__':
@@ -1,4 +1,58 @@
+"""
+Integrity validation of raw HDF5 files.
+
+Every file of a run is opened on a process pool and checked for
+    - the required groups 'detector/<hutch>/<detector>/image', 'qbpm/<hutch>/qbpm1' and 'metadata',
+    - consistent dataset shapes (one image and one QBPM waveform per timestamp),
+    - overlapping image, QBPM and metadata timestamps,
+    - optionally, that the first chunk of every dataset decompresses.
+Results are cached by file size and mtime, so validating a run again only opens new or
+changed files, and are written as a JSON report that processing uses to skip bad files.
+
+Usage:
+    python -m src.inspection.hdf5_validator RUN_N [--decompress] [--workers N] [--report FILE]
+"""
+import hashlib
+import json
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, asdict
+from functools import partial
+from typing import Any, Iterable, Optional
+
+import numpy as np
+import h5py
+import hdf5plugin  # pylint: disable=unused-import
+
+from src.utils.catalog import get_catalog
+from src.config.config import load_config, ExpConfig
+
+
+@dataclass
+class ValidationResult:
+    """Outcome of validating one raw file. The file is usable if `errors` is empty."""
+    file: str
+    size: int
+    mtime_ns: int
+    decompressed: bool = False
+    n_images: int = 0
+    n_qbpm: int = 0
+    n_metadata: int = 0
+    n_matched: int = 0
+    errors: list[str] = field(default_factory=list)
+    warnings: list[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    def to_dict(self) -> dict[str, Any]:
+        return {**asdict(self), "ok": self.ok}
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "ValidationResult":
+        return cls(**{key: val for key, val in data.items() if key != "ok"})
 
 
 def check_scan(scan_dir: str) -> dict[str, int]:
@@ -10,20 +64,211 @@ def check_scan(scan_dir: str) -> dict[str, int]:
         file = os.path.join(scan_dir, file_name)
         size = os.path.getsize(file)
         sizes[file_name] = size
-    
+
     return sizes
 
 
-if __name__ == '__main__':
-    from src.config.config import load_config
-    from src.utils.file_util import get_run_scan_directory
+def _metadata_timestamps(group: h5py.Group) -> np.ndarray:
+    """Return the index of a pandas DataFrame stored in fixed ('axis1') or table format."""
+    if "axis1" in group:
+        return np.asarray(group["axis1"], dtype=np.int64)
+    if "table" in group:
+        return np.asarray(group["table"]["index"], dtype=np.int64)
+    raise KeyError("no index ('axis1' or 'table') in 'metadata'")
+
+
+def _read_first_chunk(dataset: h5py.Dataset) -> None:
+    """Read (and so decompress) the first chunk of `dataset`."""
+    if dataset.size == 0:
+        return
+    extent = dataset.chunks if dataset.chunks is not None else (1,) + dataset.shape[1:]
+    dataset[tuple(slice(0, length) for length in extent[:dataset.ndim])]
+
+
+def validate_file(file: str, config: ExpConfig, decompress: bool = False) -> ValidationResult:
+    """
+    Check the structure of a raw HDF5 file.
+
+    Parameters:
+    - file (str): Path of the raw HDF5 file.
+    - config (ExpConfig): Experiment configuration, for the hutch and detector.
+    - decompress (bool): Also read the first chunk of every dataset.
+
+    Returns:
+    - ValidationResult: Counts, errors and warnings of the file. Nothing is raised.
+    """
+    stat = os.stat(file)
+    result = ValidationResult(file, stat.st_size, stat.st_mtime_ns, decompressed=decompress)
+    image_path = f"detector/{config.param.hutch.value}/{config.param.detector.value}/image"
+    qbpm_path = f"qbpm/{config.param.hutch.value}/qbpm1"
+
+    try:
+        with h5py.File(file, "r") as hf:
+            missing = [path for path in (image_path, qbpm_path, "metadata") if path not in hf]
+            if missing:
+                result.errors.append(f"missing groups: {', '.join(missing)}")
+                return result
+
+            images = hf[f"{image_path}/block0_values"]
+            images_ts = np.asarray(hf[f"{image_path}/block0_items"], dtype=np.int64)
+            result.n_images = len(images_ts)
+            if images.ndim != 3:
+                result.errors.append(f"image dataset has shape {images.shape}, expected (N, H, W)")
+            elif images.shape[0] != len(images_ts):
+                result.errors.append(f"{images.shape[0]} images for {len(images_ts)} timestamps")
+
+            qbpm_ts = np.asarray(hf[f"{qbpm_path}/waveforms.ch1/axis1"], dtype=np.int64)
+            result.n_qbpm = len(qbpm_ts)
+            qbpm_datasets = [hf[f"{qbpm_path}/waveforms.ch{i + 1}/block0_values"] for i in range(4)]
+            for i, waveforms in enumerate(qbpm_datasets):
+                if waveforms.shape[0] != len(qbpm_ts):
+                    result.errors.append(f"qbpm ch{i + 1} has {waveforms.shape[0]} waveforms for {len(qbpm_ts)} timestamps")
+
+            metadata_ts = _metadata_timestamps(hf["metadata"])
+            result.n_metadata = len(metadata_ts)
+
+            result.n_matched = len(np.intersect1d(np.intersect1d(images_ts, qbpm_ts), metadata_ts))
+            if result.n_matched == 0:
+                result.errors.append("image, qbpm and metadata timestamps do not overlap")
+            elif result.n_matched < max(result.n_images, result.n_qbpm, result.n_metadata):
+                result.warnings.append(
+                    f"only {result.n_matched} of {result.n_images} images, {result.n_qbpm} qbpm "
+                    f"and {result.n_metadata} metadata timestamps match"
+                )
+
+            if decompress:
+                for dataset in [images] + qbpm_datasets:
+                    try:
+                        _read_first_chunk(dataset)
+                    except Exception as e:  # pylint: disable=broad-except
+                        result.errors.append(f"cannot decompress '{dataset.name}': {type(e).__name__}: {e}")
+    except Exception as e:  # pylint: disable=broad-except
+        # Truncated or corrupt files fail anywhere while opening or reading
+        message = str(e).strip().splitlines()
+        result.errors.append(f"{type(e).__name__}: {message[-1] if message else ''}")
+    return result
+
+
+def _validate_file(file: str, decompress: bool) -> ValidationResult:
+    return validate_file(file, load_config(), decompress)
+
+
+def _config_key(config: ExpConfig) -> str:
+    return hashlib.sha256(repr((config.param.hutch.value, config.param.detector.value)).encode()).hexdigest()[:16]
+
+
+def validate_files(
+    files: Iterable[str],
+    decompress: bool = False,
+    max_workers: Optional[int] = None,
+    cache_file: Optional[str] = None
+) -> list[ValidationResult]:
+    """
+    Validate files in parallel, reusing the cached results of unchanged files.
+
+    Parameters:
+    - files (Iterable[str]): Raw HDF5 files.
+    - decompress (bool): Also read the first chunk of every dataset.
+    - max_workers (int, optional): Number of processes, 1 validates in this process.
+    - cache_file (str, optional): JSON file with the results of earlier validations.
+
+    Returns:
+    - list[ValidationResult]: One result per file, in the order of `files`.
+    """
+    files = [os.path.abspath(file) for file in files]
+    config = load_config()
+    cached: dict[str, dict[str, Any]] = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+        if cache.get("config_key") == _config_key(config):
+            cached = cache["files"]
+
+    results: dict[str, ValidationResult] = {}
+    stale: list[str] = []
+    for file in files:
+        entry = cached.get(file)
+        stat = os.stat(file)
+        if (
+            entry is not None
+            and (entry["size"], entry["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns)
+            and (entry["decompressed"] or not decompress)
+        ):
+            results[file] = ValidationResult.from_dict(entry)
+        else:
+            stale.append(file)
+
+    if max_workers == 1 or len(stale) <= 1:
+        fresh = [validate_file(file, config, decompress) for file in stale]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            fresh = list(executor.map(partial(_validate_file, decompress=decompress), stale))
+    results.update({result.file: result for result in fresh})
+
+    if cache_file is not None and fresh:
+        cached.update({result.file: result.to_dict() for result in fresh})
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"config_key": _config_key(config), "files": cached}, f)
+        os.replace(tmp_file, cache_file)
+
+    return [results[file] for file in files]
+
+
+def validate_run(run_n: int, decompress: bool = False, max_workers: Optional[int] = None) -> list[ValidationResult]:
+    """
+    Validate every file of a run of the configured raw data directory.
+
+    Results are cached in 'validation/run=XXX.json' in the cache directory.
+    """
     config = load_config()
-    load_dir: str = config.path.load_dir
+    catalog = get_catalog()
+    catalog.refresh(runs=[run_n])
+    files = [record.path for scan_n in catalog.scans(run_n) for record in catalog.files(run_n, scan_n)]
+    cache_file = os.path.join(config.path.cache_dir, "validation", f"run={run_n:0>3}.json")
+    return validate_files(files, decompress, max_workers, cache_file)
+
 
-    run_n: int = int(input("run number: "))
-    scan_dir: str = get_run_scan_directory(load_dir, run_n, 1)
+def write_report(results: list[ValidationResult], file: str) -> None:
+    """Write the results as a JSON report with a summary."""
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "n_files": len(results),
+        "n_bad": sum(not result.ok for result in results),
+        "n_warnings": sum(bool(result.warnings) for result in results),
+        "bad_files": [result.file for result in results if not result.ok],
+        "files": [result.to_dict() for result in results],
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+    with open(file, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+
+def get_bad_files(results: list[ValidationResult]) -> set[str]:
+    """Return the paths of the files that failed validation."""
+    return {result.file for result in results if not result.ok}
+
+
+if __name__ == '__main__':
+    import click
 
-    sizes = check_scan(scan_dir)
+    @click.command()
+    @click.argument('run_n', type=int)
+    @click.option('--decompress', is_flag=True, help='Also decompress the first chunk of every dataset')
+    @click.option('--workers', type=int, default=None, help='Number of worker processes')
+    @click.option('--report', type=click.Path(dir_okay=False), default=None, help='Write a JSON report to this file')
+    def validate(run_n: int, decompress: bool, workers: Optional[int], report: Optional[str]) -> None:
+        """Validate every raw file of a run"""
+        results = validate_run(run_n, decompress, workers)
+        for result in results:
+            if not result.ok:
+                click.echo(f"BAD  {result.file}: {'; '.join(result.errors)}")
+            elif result.warnings:
+                click.echo(f"WARN {result.file}: {'; '.join(result.warnings)}")
+        click.echo(f"{len(results)} files, {len(get_bad_files(results))} bad")
+        if report is not None:
+            write_report(results, report)
+            click.echo(f"Report written to '{report}'")
 
-    for file_name, size in sizes.items():
-        print(f'{file_name} {size} bytes')
+    validate()  # pylint: disable=no-value-for-parameter
@@ -1,33 +1,17 @@
-import os
 from typing import Any
 
 import numpy as np
 import pandas as pd
 import h5py
 
-from src.utils.file_util import get_file_list, get_folder_list
+from src.utils.catalog import RawDataCatalog
 
 
 def get_file_status(root: str) -> dict:
-
-    status: dict = {}
-
-    runs: list[str] = get_folder_list(root)
-    for run in runs:
-        path = os.path.join(root, run)
-        scans = get_folder_list(path)
-        for scan in scans:
-            path = os.path.join(path, scan)
-            files = get_file_list(path)
-
-            name = "_".join(path[-2:])[:-2]
-
-            nums = {int(file[1:-3]) for file in files}
-            max_num = max(nums)
-            missing_nums = set(range(1, max_num + 1)) - nums
-            status[name] = [max_num, missing_nums]
-
-    return status
+    """Return [last file number, missing file numbers] of every scan under root by 'run=XXX_scan=XXX'."""
+    with RawDataCatalog(root) as catalog:
+        catalog.refresh()
+        return {name: [max_num, set(missing_nums)] for name, (max_num, missing_nums) in catalog.status().items()}
 
 
 def h5_tree(val: Any, pre: None = '') -> None:
@@ -7,25 +7,69 @@ with specific formatting, log file settings, and rotation/compression options.
 Log files are stored in the 'logs' directory, organized by date, and named with a timestamp.
 Each log file is rotated when it reaches 500 MB in size and compressed in ZIP format.
 
+The sinks are added once per process, however often `setup_logger` is called, and are
+enqueued: a log call only formats the message and puts it on a queue, and a background
+thread writes it, so slow disks and consoles do not hold up the processing.
+Records bound with `METRIC_KEY` (see `src.utils.metrics`) go to a separate JSON lines
+file, '{timestamp}.metrics.jsonl', instead of the console and the log file.
+
 Example usage:
     from logger_setup import setup_logger
     logger = setup_logger()
     logger.info("This is an info message.")
 """
+import sys
+import threading
+
 import loguru
 from loguru._logger import Logger
 
 
+FORMAT: str = "{time:YYYY-MM-DD HH:mm:ss.SSS} | {level} | {name}:{function}:{line} - {message}"
+LOG_FILE: str = "logs/{time:YYYY-MM-DD}/{time:YYYYMMDD_HHmmss}.log"
+METRICS_FILE: str = "logs/{time:YYYY-MM-DD}/{time:YYYYMMDD_HHmmss}.metrics.jsonl"
+METRIC_KEY: str = "metric"
+
+_lock = threading.Lock()
+_configured: bool = False
+
+
+def is_metric(record: dict) -> bool:
+    """Return whether a loguru record belongs to the metrics channel."""
+    return METRIC_KEY in record["extra"]
+
+
+def _is_log(record: dict) -> bool:
+    return METRIC_KEY not in record["extra"]
+
+
 def setup_logger() -> Logger:
     """
     Configures and sets up the logger with a custom format and log file settings.
 
+    Only the first call of a process adds the sinks; later calls return the same logger.
+    The default console sink of loguru is replaced by an enqueued one.
+
     Returns:
         Logger: The configured logger instance.
     """
-    formatter = "{time:YYYY-MM-DD HH:mm:ss.SSS} | {level} | {name}:{function}:{line} - {message}"
-    log_file: str = "logs/{time:YYYY-MM-DD}/{time:YYYYMMDD_HHmmss}.log"
-    loguru.logger.add(log_file, format=formatter, rotation="500 MB", compression="zip")
+    global _configured  # pylint: disable=global-statement
+    with _lock:
+        if not _configured:
+            try:
+                loguru.logger.remove(0)
+            except ValueError:
+                # Already removed by the application
+                pass
+            loguru.logger.add(sys.stderr, level="DEBUG", filter=_is_log, enqueue=True)
+            loguru.logger.add(
+                LOG_FILE, format=FORMAT, rotation="500 MB", compression="zip", filter=_is_log, enqueue=True
+            )
+            # Created on the first metric only
+            loguru.logger.add(
+                METRICS_FILE, format="{message}", level="TRACE", filter=is_metric, enqueue=True, delay=True
+            )
+            _configured = True
 
     return loguru.logger
 
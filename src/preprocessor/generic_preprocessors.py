@@ -1,10 +1,10 @@
 import os
+from functools import lru_cache
 from typing import Optional
 
 import numpy as np
 import numpy.typing as npt
-from scipy.optimize import curve_fit
-from sklearn.linear_model import RANSACRegressor
+from roi_rectangle import RoiRectangle
 
 from src.config.config import load_config
 
@@ -21,6 +21,9 @@ def ransac_regression(y: np.ndarray, x: np.ndarray, min_samples: Optional[int] =
     Returns:
     - tuple[npt.NDArray[np.bool_], npt.NDArray, npt.NDArray]: A tuple containing the inlier mask, coefficient, and intercept of the linear model.
     """
+    # sklearn takes a second to import, so only code paths using RANSAC pay for it
+    from sklearn.linear_model import RANSACRegressor
+
     X = x[:, np.newaxis]
     ransac = RANSACRegressor(min_samples=min_samples).fit(X, y)
     inlier_mask = ransac.inlier_mask_
@@ -58,6 +61,8 @@ def get_linear_regression_confidence_bounds(
     This method assumes a linear relationship in the data. For strong non-linearities,
     a different approach may be necessary.
     """
+    from scipy.optimize import curve_fit
+
     def linear_model(x, m, b):
         return m * x + b
 
@@ -118,16 +123,45 @@ def div_images_by_qbpm(images: npt.NDArray, qbpm: npt.NDArray) -> npt.NDArray:
     return images * qbpm.mean() / qbpm[:, np.newaxis, np.newaxis]
 
 
-def subtract_dark(images: npt.NDArray) -> npt.NDArray:
-    config = load_config()
-    dark_file = os.path.join(config.path.analysis_dir, "DARK/dark.npy")
+@lru_cache(maxsize=4)
+def _load_dark(dark_file: str, mtime_ns: int) -> npt.NDArray:
+    """Mean of the dark images clipped at zero, read once per version of the file."""
+    dark = np.maximum(np.mean(np.load(dark_file), axis=0), 0)
+    dark.flags.writeable = False
+    return dark
+
+
+def load_dark(dark_file: Optional[str] = None) -> npt.NDArray:
+    """
+    Return the mean dark image (H, W), clipped at zero.
+
+    Parameters:
+    - dark_file (str, optional): Stack of dark images (N, H, W). Defaults to 'DARK/dark.npy' in the analysis directory.
 
+    Returns:
+    - npt.NDArray: Read-only mean dark image, cached until the file changes.
+    """
+    if dark_file is None:
+        dark_file = os.path.join(load_config().path.analysis_dir, "DARK/dark.npy")
     if not os.path.exists(dark_file):
         raise FileNotFoundError(f"No such file or directory: {dark_file}")
+    return _load_dark(os.path.abspath(dark_file), os.stat(dark_file).st_mtime_ns)
+
+
+def subtract_dark(images: npt.NDArray, roi_rect: Optional[RoiRectangle] = None) -> npt.NDArray:
+    """
+    Subtract the mean dark image from images.
 
-    dark_images = np.load(dark_file)
-    dark = np.mean(dark_images, axis=0)
-    none_zero_dark = np.maximum(dark, 0)
+    Parameters:
+    images (NDArray): Array of images. Shape: (N, H, W)
+    roi_rect (RoiRectangle, optional): Region of the detector the images were cropped to.
+
+    Returns:
+    NDArray: Dark subtracted images, clipped at zero.
+    """
+    none_zero_dark = load_dark()
+    if roi_rect is not None:
+        none_zero_dark = roi_rect.slice(none_zero_dark)
     return np.maximum(0, images - none_zero_dark[np.newaxis, :, :])
     # return np.maximum(images - dark[np.newaxis, :, :], 0)
 
@@ -13,6 +13,7 @@ from src.preprocessor.generic_preprocessors import (
     equalize_brightness,
     add_bias
 )
+from src.preprocessor.registration import register_images
 
 
 ImagesQbpm = tuple[npt.NDArray, npt.NDArray]
@@ -82,6 +83,39 @@ def subtract_dark_background(images_qbpm: ImagesQbpm) -> ImagesQbpm:
     return subtract_dark(images_qbpm[0]), images_qbpm[1]
 
 
+def create_dark_background_subtractor(crop_rect: RoiRectangle) -> ImagesQbpmProcessor:
+    """
+    Create a function to remove the dark background from images cropped to `crop_rect`.
+
+    Parameters:
+    - crop_rect: RoiRectangle, the region of the detector the images were cropped to.
+
+    Returns:
+    - ImageQbpmProcessor: A function that takes ImagesQbpm and returns the dark subtracted ImagesQbpm.
+    """
+    def subtract_cropped_dark_background(images_qbpm: ImagesQbpm) -> ImagesQbpm:
+        return subtract_dark(images_qbpm[0], crop_rect), images_qbpm[1]
+    return subtract_cropped_dark_background
+
+
+def create_drift_corrector(roi_rect: RoiRectangle) -> ImagesQbpmProcessor:
+    """
+    Create a function to register the shots of a batch on the content of `roi_rect`.
+
+    Every shot is shifted onto the mean ROI image of its batch (one delay file),
+    which removes shot to shot jitter of the detector or sample position.
+
+    Parameters:
+    - roi_rect: RoiRectangle, region with a feature that should not move, in image coordinates.
+
+    Returns:
+    - ImageQbpmProcessor: A function that takes ImagesQbpm and returns the registered ImagesQbpm.
+    """
+    def correct_drift(images_qbpm: ImagesQbpm) -> ImagesQbpm:
+        return register_images(images_qbpm[0], roi_rect)[0], images_qbpm[1]
+    return correct_drift
+
+
 def normalize_images_by_qbpm(images_qbpm: ImagesQbpm) -> ImagesQbpm:
     """
     Normalize the images by the Qbpm values.
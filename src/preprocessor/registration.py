@@ -0,0 +1,155 @@
+"""
+Drift estimation and correction by FFT phase correlation.
+
+Shifts of every frame against a reference are found from the peak of the normalized cross
+power spectrum of the ROI, computed for the whole batch with real FFTs, and refined to
+sub-pixel precision with a Gaussian through the peak. Frames are shifted back with the
+Fourier shift theorem, i.e. periodically.
+
+Example usage:
+    shifts = estimate_shifts(roi_rect.slice(images), roi_rect.slice(images).mean(axis=0))
+    registered = shift_images(images, -shifts)
+"""
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+from scipy import fft
+from roi_rectangle import RoiRectangle
+
+
+def _gaussian_offset(lower: npt.NDArray, center: npt.NDArray, upper: npt.NDArray) -> npt.NDArray:
+    """Sub-pixel offset of the vertex of a Gaussian through three samples around a maximum."""
+    tiny = np.finfo(np.float64).tiny
+    lower, center, upper = (np.log(np.maximum(v, tiny)) for v in (lower, center, upper))
+    curvature = lower - 2 * center + upper
+    with np.errstate(invalid="ignore", divide="ignore"):
+        offset = 0.5 * (lower - upper) / curvature
+    return np.where((curvature < 0) & (np.abs(offset) <= 1), offset, 0.)
+
+
+def _phase_correlation(
+    images: npt.NDArray,
+    reference_spectrum: npt.NDArray,
+    window: npt.NDArray,
+    spectral_filter: npt.NDArray
+) -> npt.NDArray:
+    n_images, height, width = images.shape
+    images = (images - images.mean(axis=(1, 2), keepdims=True)) * window
+    cross_power = fft.rfft2(images, workers=-1) * reference_spectrum
+    cross_power /= np.maximum(np.abs(cross_power), np.finfo(np.float32).tiny)
+    correlation = fft.irfft2(cross_power * spectral_filter, s=(height, width), workers=-1)
+
+    frames = np.arange(n_images)
+    peak_y, peak_x = np.unravel_index(correlation.reshape(n_images, -1).argmax(axis=1), (height, width))
+    center = correlation[frames, peak_y, peak_x]
+    dy = peak_y + _gaussian_offset(
+        correlation[frames, (peak_y - 1) % height, peak_x], center, correlation[frames, (peak_y + 1) % height, peak_x]
+    )
+    dx = peak_x + _gaussian_offset(
+        correlation[frames, peak_y, (peak_x - 1) % width], center, correlation[frames, peak_y, (peak_x + 1) % width]
+    )
+    # The correlation is periodic, peaks past the middle are negative shifts
+    return np.stack([np.where(dy > height / 2, dy - height, dy), np.where(dx > width / 2, dx - width, dx)], axis=1)
+
+
+def estimate_shifts(
+    images: npt.NDArray,
+    reference: npt.NDArray,
+    bandwidth: float = 0.05,
+    refine: int = 2,
+    batch_size: int = 64
+) -> npt.NDArray:
+    """
+    Estimate the sub-pixel shift of every image against a reference by phase correlation.
+
+    The whitened cross power spectrum is weighted by a Gaussian low-pass of width `bandwidth`
+    (cycles per pixel), which suppresses the noise dominated high frequencies and makes the
+    correlation peak Gaussian, so a 3 point Gaussian fit locates it. The apodization window
+    biases large shifts toward zero; each of the `refine` passes shifts the images by the
+    current estimate and adds the remaining shift.
+
+    Parameters:
+    - images (npt.NDArray): Image stack (N, h, w), usually the ROI of each frame.
+    - reference (npt.NDArray): Reference image (h, w).
+    - bandwidth (float): Width of the spectral low-pass in cycles per pixel.
+    - refine (int): Number of refinement passes.
+    - batch_size (int): Number of images transformed at once.
+
+    Returns:
+    - npt.NDArray: Shifts (N, 2) as (dy, dx), such that images[i] ≈ reference moved by shifts[i].
+    """
+    from scipy.signal.windows import hann
+
+    n_images, height, width = images.shape
+    window = (hann(height, sym=False)[:, np.newaxis] * hann(width, sym=False)[np.newaxis, :]).astype(np.float32)
+    reference = np.asarray(reference, dtype=np.float32)
+    reference_spectrum = np.conj(fft.rfft2((reference - reference.mean()) * window))
+    frequency_squared = fft.fftfreq(height)[:, np.newaxis] ** 2 + fft.rfftfreq(width)[np.newaxis, :] ** 2
+    spectral_filter = np.exp(-frequency_squared / (2 * bandwidth ** 2)).astype(np.float32)
+
+    shifts = np.zeros((n_images, 2))
+    for start in range(0, n_images, batch_size):
+        batch = np.asarray(images[start:start + batch_size], dtype=np.float32)
+        batch_shifts = _phase_correlation(batch, reference_spectrum, window, spectral_filter)
+        for _ in range(refine):
+            registered = shift_images(batch, -batch_shifts)
+            batch_shifts += _phase_correlation(registered, reference_spectrum, window, spectral_filter)
+        shifts[start:start + len(batch)] = batch_shifts
+    return shifts
+
+
+def shift_images(images: npt.NDArray, shifts: npt.NDArray, batch_size: int = 16) -> npt.NDArray:
+    """
+    Move every image by its sub-pixel shift using the Fourier shift theorem.
+
+    Content leaving one edge enters on the opposite edge.
+
+    Parameters:
+    - images (npt.NDArray): Image stack (N, H, W).
+    - shifts (npt.NDArray): Shifts (N, 2) as (dy, dx). Pass `-estimate_shifts(...)` to register.
+    - batch_size (int): Number of images transformed at once.
+
+    Returns:
+    - npt.NDArray: Shifted images with the dtype of `images` if floating, else float32.
+    """
+    n_images, height, width = images.shape
+    dtype = images.dtype if np.issubdtype(images.dtype, np.floating) else np.float32
+    freq_y = fft.fftfreq(height)[np.newaxis, :, np.newaxis]
+    freq_x = fft.rfftfreq(width)[np.newaxis, np.newaxis, :]
+
+    shifted = np.empty((n_images, height, width), dtype=dtype)
+    for start in range(0, n_images, batch_size):
+        batch_shifts = shifts[start:start + batch_size]
+        dy, dx = (s[:, np.newaxis, np.newaxis] for s in batch_shifts.T)
+        phase = np.exp(-2j * np.pi * (freq_y * dy + freq_x * dx)).astype(np.complex64)
+        spectrum = fft.rfft2(np.asarray(images[start:start + batch_size], dtype=np.float32), workers=-1)
+        shifted[start:start + len(batch_shifts)] = fft.irfft2(spectrum * phase, s=(height, width), workers=-1)
+    return shifted
+
+
+def register_images(
+    images: npt.NDArray,
+    roi_rect: RoiRectangle,
+    reference: Optional[npt.NDArray] = None,
+    apply: bool = True
+) -> tuple[npt.NDArray, npt.NDArray]:
+    """
+    Register an image stack on the content of `roi_rect`.
+
+    Parameters:
+    - images (npt.NDArray): Image stack (N, H, W).
+    - roi_rect (RoiRectangle): Region with a feature that should not move, in image coordinates.
+    - reference (npt.NDArray, optional): Reference ROI image (h, w). Defaults to the mean ROI image.
+    - apply (bool): Shift the images back. Otherwise only the drift trace is computed.
+
+    Returns:
+    - tuple[npt.NDArray, npt.NDArray]: Registered (or unchanged) images and the shifts (N, 2) as (dy, dx).
+    """
+    roi_images = np.asarray(roi_rect.slice(images))
+    if reference is None:
+        reference = roi_images.mean(axis=0)
+    shifts = estimate_shifts(roi_images, reference)
+    if apply:
+        images = shift_images(images, -shifts)
+    return images, shifts
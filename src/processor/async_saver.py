@@ -0,0 +1,146 @@
+"""
+Background saving of processed results.
+
+`AsyncSaver` writes result dicts through any `SaverStrategy` on writer threads, so the
+next scan can be processed while the previous one is written to the (network) disk.
+Memory is bounded: `submit` blocks while more than `max_pending_gb` of data waits to be
+written. Savers write to a temporary file that is renamed atomically once complete.
+
+Example usage:
+    with AsyncSaver(logger=logger) as async_saver:
+        for run_n, scan_n in scans:
+            processor = CoreProcessor(...)
+            processor.save(get_saver_strategy("npz"), run_n, scan_n, async_saver)
+    # leaving the block waits for every write and raises if any of them failed
+"""
+import queue
+import threading
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from src.logger import setup_logger, Logger
+from src.processor.saver import SaverStrategy
+from src.utils import metrics
+
+
+@dataclass
+class SaveJob:
+    """A result dict waiting to be written."""
+    saver: SaverStrategy
+    run_n: int
+    scan_n: int
+    data_dict: dict[str, npt.NDArray]
+    comment: str = ""
+    nbytes: int = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.nbytes = int(sum(np.asarray(val).nbytes for val in self.data_dict.values()))
+
+    def __str__(self) -> str:
+        return f"{self.saver.file_type} run={self.run_n} scan={self.scan_n}"
+
+
+class AsyncSaver:
+    """
+    Writer queue saving result dicts in the background.
+
+    Args:
+        max_pending_gb (float): Maximum size of the data waiting to be written.
+            A single job larger than this is still accepted once the queue is empty.
+        workers (int): Number of writer threads. Do not share one SaverStrategy
+            instance between jobs when using more than one worker.
+        logger (Logger, optional): Logger for progress and failures.
+    """
+    def __init__(self, max_pending_gb: float = 4., workers: int = 1, logger: Optional[Logger] = None) -> None:
+        self.max_pending_bytes: int = int(max_pending_gb * 1024 ** 3)
+        self.logger: Logger = logger if logger is not None else setup_logger()
+        self.failures: list[tuple[SaveJob, BaseException]] = []
+
+        self._queue: queue.Queue[Optional[SaveJob]] = queue.Queue()
+        self._pending_bytes: int = 0
+        self._condition: threading.Condition = threading.Condition()
+        self._closed: bool = False
+        self._threads: list[threading.Thread] = [
+            threading.Thread(target=self._work, name=f"AsyncSaver-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def pending_bytes(self) -> int:
+        return self._pending_bytes
+
+    def submit(
+        self,
+        saver: SaverStrategy,
+        run_n: int,
+        scan_n: int,
+        data_dict: dict[str, npt.NDArray],
+        comment: str = ""
+    ) -> None:
+        """
+        Queue data_dict to be saved, blocking while the queue holds too much data.
+
+        The arrays of data_dict must not be modified after submitting.
+        """
+        if self._closed:
+            raise RuntimeError("AsyncSaver is closed")
+        job = SaveJob(saver, run_n, scan_n, data_dict, comment)
+        with self._condition:
+            while self._pending_bytes > 0 and self._pending_bytes + job.nbytes > self.max_pending_bytes:
+                self._condition.wait()
+            self._pending_bytes += job.nbytes
+        self._queue.put(job)
+        self.logger.info(f"Queued {job} ({job.nbytes / 1024 ** 2:.1f} MB)")
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                with metrics.timer("saver.save", file_type=job.saver.file_type, nbytes=job.nbytes):
+                    job.saver.save(job.run_n, job.scan_n, job.data_dict, job.comment)
+                self.logger.info(f"Saved file '{job.saver.file}'")
+            except BaseException as e:  # pylint: disable=broad-exception-caught
+                self.failures.append((job, e))
+                metrics.count("saver.failed", file_type=job.saver.file_type)
+                self.logger.opt(exception=e).error(f"Failed to save {job}")
+            finally:
+                with self._condition:
+                    self._pending_bytes -= job.nbytes
+                    self._condition.notify_all()
+
+    def close(self, raise_on_failure: bool = True) -> list[tuple[SaveJob, BaseException]]:
+        """
+        Wait until every queued job is written and stop the writer threads.
+
+        Returns:
+            list[tuple[SaveJob, BaseException]]: The jobs that failed.
+
+        Raises:
+            RuntimeError: If a job failed and `raise_on_failure` is set.
+        """
+        if not self._closed:
+            self._closed = True
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+
+        for job, error in self.failures:
+            self.logger.error(f"Not saved: {job}: {type(error).__name__}: {error}")
+        if self.failures and raise_on_failure:
+            raise RuntimeError(f"{len(self.failures)} file(s) failed to save")
+        return self.failures
+
+    def __enter__(self) -> "AsyncSaver":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        # Do not hide the exception that is already propagating
+        self.close(raise_on_failure=exc_type is None)
@@ -0,0 +1,433 @@
+"""
+Content-addressed disk cache for per-file preprocessing results.
+
+Every raw HDF5 file is reduced by each preprocessing pipeline to a few small
+arrays (mean pump-on/pump-off image and delay). These reductions only depend on
+the raw file and on the pipeline definition, so they can be reused between
+runs of `processing_main` when only the analysis settings change.
+
+Cache keys combine:
+    - the identity of the raw file (absolute path, size and mtime, or a content hash),
+    - a canonical fingerprint of the pipeline (function code, ROI, sigma, ...),
+    - the identity of extra dependencies such as the dark file,
+    - the code version, a hash of the source of the loader and the preprocessing modules.
+
+The fingerprint of a function only covers its own code and closure, not the module-level
+helpers it calls (`subtract_dark`, `load_dark`, the internals of `pohang`, ...) nor the
+loader class, so the code version invalidates every entry when any of that code is edited.
+
+Entries are evicted least-recently-used first once the cache exceeds its disk quota.
+
+Example usage:
+    cache = PreprocessCache(config.path.cache_dir, dependencies=[dark_file])
+    processor = CoreProcessor(HDF5FileLoader, scan_dir, preprocessors, logger, cache=cache)
+    logger.info(cache.stats)
+"""
+import os
+import json
+import time
+import hashlib
+import functools
+import threading
+import types
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict, is_dataclass
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+
+def file_identity(file: str, content_hash: bool = False) -> dict[str, Any]:
+    """
+    Return a json serializable identity of a file.
+
+    Parameters:
+    - file (str): Path to the file.
+    - content_hash (bool): Hash the file content instead of trusting size and mtime.
+
+    Returns:
+    - dict[str, Any]: Identity of the file.
+    """
+    stat = os.stat(file)
+    identity: dict[str, Any] = {"path": os.path.abspath(file), "size": stat.st_size}
+    if content_hash:
+        sha = hashlib.sha256()
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        identity["sha256"] = sha.hexdigest()
+    else:
+        identity["mtime_ns"] = stat.st_mtime_ns
+    return identity
+
+
+# Sources whose code determines the cached outputs, relative to the repository root
+CODE_VERSION_SOURCES: tuple[str, ...] = (
+    "src/preprocessor/*.py",
+    "src/processor/loader.py",
+    "src/processor/core.py",
+    "src/utils/roi_util.py",
+    "src/utils/fxs.py",
+)
+
+
+@functools.lru_cache(maxsize=1)
+def code_version() -> str:
+    """Return a hash of the sources in `CODE_VERSION_SOURCES`, part of every preprocess cache key."""
+    root = Path(__file__).resolve().parent.parent.parent
+    sha = hashlib.sha256()
+    for pattern in CODE_VERSION_SOURCES:
+        for file in sorted(root.glob(pattern)):
+            sha.update(file.relative_to(root).as_posix().encode())
+            # Line endings differ between checkouts
+            sha.update(file.read_bytes().replace(b"\r\n", b"\n"))
+    return sha.hexdigest()
+
+
+def code_digest(code: types.CodeType) -> str:
+    """
+    Return a hash of a code object: its bytecode, the global names it uses and its constants.
+    Nested code objects (lambdas, comprehensions, inner functions) are hashed the same way,
+    since their repr holds a memory address that changes in every process.
+    """
+    sha = hashlib.sha256(code.co_code)
+    sha.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        sha.update(code_digest(const).encode() if isinstance(const, types.CodeType) else repr(const).encode())
+    return sha.hexdigest()
+
+
+def fingerprint(obj: Any, _depth: int = 0) -> Any:
+    """
+    Build a canonical, json serializable description of a pipeline object.
+
+    Functions are described by their qualified name, bytecode and the values
+    captured in their closure, so `create_pohang(roi_rect)` gives a different
+    fingerprint for every ROI. Module-level helpers a function calls are not
+    followed; edits to them are covered by `code_version`.
+    """
+    if _depth > 32:
+        raise RecursionError("Pipeline is nested too deeply to fingerprint")
+    depth = _depth + 1
+
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, (list, tuple)):
+        return [fingerprint(item, depth) for item in obj]
+    if isinstance(obj, dict):
+        return {str(key): fingerprint(val, depth) for key, val in sorted(obj.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(obj, np.ndarray):
+        return {"ndarray": hashlib.sha256(np.ascontiguousarray(obj).tobytes()).hexdigest(),
+                "shape": list(obj.shape), "dtype": str(obj.dtype)}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, functools.partial):
+        return {
+            "partial": fingerprint(obj.func, depth),
+            "args": fingerprint(obj.args, depth),
+            "keywords": fingerprint(obj.keywords, depth),
+        }
+    if is_dataclass(obj) and not isinstance(obj, type):
+        return {"type": type(obj).__qualname__, "fields": fingerprint(asdict(obj), depth)}
+    if hasattr(obj, "model_dump"):
+        return {"type": type(obj).__qualname__, "fields": json.loads(obj.model_dump_json())}
+    if isinstance(obj, types.MethodType):
+        return {"method": fingerprint(obj.__func__, depth), "self": fingerprint(obj.__self__, depth)}
+    if callable(obj) and hasattr(obj, "__code__"):
+        code = obj.__code__
+        closure = obj.__closure__ or ()
+        return {
+            "function": f"{obj.__module__}.{obj.__qualname__}",
+            "code": code_digest(code),
+            "closure": [fingerprint(cell.cell_contents, depth) for cell in closure],
+        }
+    if callable(obj):
+        return {"callable": f"{type(obj).__module__}.{type(obj).__qualname__}", "repr": repr(obj)}
+    return {"type": type(obj).__qualname__, "repr": repr(obj)}
+
+
+def hash_key(*parts: Any) -> str:
+    """Return the sha256 hex digest of the canonical json of `parts`."""
+    payload = json.dumps(parts, sort_keys=True, default=repr, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    """Hit/miss statistics of a disk cache."""
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"hits={self.hits} misses={self.misses} hit_rate={self.hit_rate:.1%} "
+            f"stores={self.stores} evictions={self.evictions}"
+        )
+
+
+class DiskLRUCache:
+    """
+    Directory of cache files with a size quota and least-recently-used eviction.
+
+    The bookkeeping (size and last access time of every entry) lives in
+    `index.json` inside the cache directory so that it survives between runs.
+    Several processes may share the directory: `flush` merges the index on disk with
+    the changes of this process under a lock file before evicting and writing it.
+
+    Args:
+        cache_dir (str): Directory where entries and the index are stored.
+        quota_bytes (int): Maximum total size of the entries.
+        suffix (str): File suffix of the entries.
+    """
+    INDEX_FILE: str = "index.json"
+    LOCK_FILE: str = "index.lock"
+    # A lock file older than this is left by a crashed process [s]
+    LOCK_TIMEOUT: float = 30.
+
+    def __init__(self, cache_dir: str, quota_bytes: int, suffix: str = "") -> None:
+        self.cache_dir: str = cache_dir
+        self.quota_bytes: int = quota_bytes
+        self.suffix: str = suffix
+        self.stats: CacheStats = CacheStats()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._entries: dict[str, dict[str, float]] = self._read_index()
+        # Entries removed by this process since the last flush, also removed from the merged index
+        self._removed: set[str] = set()
+        # Entries in use by this process, never evicted
+        self.pinned: set[str] = set()
+        self._dirty: bool = False
+
+    def path(self, key: str) -> str:
+        """Return the file path of an entry."""
+        return os.path.join(self.cache_dir, key[:2], key + self.suffix)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries and os.path.exists(self.path(key))
+
+    @property
+    def total_bytes(self) -> int:
+        return int(sum(entry["size"] for entry in self._entries.values()))
+
+    def lookup(self, key: str) -> Optional[str]:
+        """Return the path of an entry and mark it as used, or None on a miss."""
+        if key not in self:
+            if self._entries.pop(key, None) is not None:
+                self._removed.add(key)
+                self._dirty = True
+            self.stats.misses += 1
+            return None
+        self._entries[key]["last_access"] = time.time()
+        self._dirty = True
+        self.stats.hits += 1
+        return self.path(key)
+
+    def adopt(self, key: str) -> Optional[str]:
+        """Register an entry written by another process sharing the directory, or return None if there is none."""
+        file = self.path(key)
+        if not os.path.exists(file):
+            return None
+        self._entries[key] = {"size": os.path.getsize(file), "last_access": time.time()}
+        self._removed.discard(key)
+        self._dirty = True
+        return file
+
+    def commit(self, key: str, tmp_file: str) -> str:
+        """Move a fully written temporary file into the cache as `key`."""
+        file = self.path(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        os.replace(tmp_file, file)
+        self._entries[key] = {"size": os.path.getsize(file), "last_access": time.time()}
+        self._removed.discard(key)
+        self.stats.stores += 1
+        self._dirty = True
+        # Evicts against the entries of every process
+        self.flush()
+        return file
+
+    def discard(self, key: str) -> None:
+        """Remove an entry from the cache."""
+        self._entries.pop(key, None)
+        self._removed.add(key)
+        self._dirty = True
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+        except PermissionError:
+            # Still open on Windows, the file is overwritten when the entry is stored again
+            pass
+
+    def evict(self) -> None:
+        """Remove least recently used entries until the quota is respected."""
+        total = self.total_bytes
+        if total <= self.quota_bytes:
+            return
+        for key, entry in sorted(self._entries.items(), key=lambda kv: kv[1]["last_access"]):
+            if total <= self.quota_bytes:
+                break
+            if key in self.pinned:
+                continue
+            total -= entry["size"]
+            self.discard(key)
+            self.stats.evictions += 1
+
+    def flush(self) -> None:
+        """Merge the changes of this process into the index on disk, evict and write it, if anything changed."""
+        if not self._dirty:
+            return
+        with self._index_lock():
+            self._merge_index()
+            self.evict()
+            self._write_index()
+        self._removed.clear()
+        self._dirty = False
+
+    def clear(self) -> None:
+        """Remove every entry, also the ones of other processes."""
+        with self._index_lock():
+            self._merge_index()
+            for key in list(self._entries):
+                self.discard(key)
+            self._write_index()
+        self._removed.clear()
+        self._dirty = False
+
+    def _merge_index(self) -> None:
+        """Add the entries other processes wrote to the index, keeping the latest access time of every entry."""
+        for key, entry in self._read_index().items():
+            if key in self._removed:
+                continue
+            own = self._entries.get(key)
+            if own is None or entry["last_access"] > own["last_access"]:
+                self._entries[key] = entry
+
+    def _write_index(self) -> None:
+        index_file = os.path.join(self.cache_dir, self.INDEX_FILE)
+        tmp_file = f"{index_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"entries": self._entries}, f)
+        os.replace(tmp_file, index_file)
+
+    @contextmanager
+    def _index_lock(self) -> Iterator[None]:
+        """Hold the lock file of the index, which works on network shares and Windows alike."""
+        lock_file = os.path.join(self.cache_dir, self.LOCK_FILE)
+        deadline = time.monotonic() + self.LOCK_TIMEOUT
+        while True:
+            try:
+                fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_file) > self.LOCK_TIMEOUT:
+                        os.remove(lock_file)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Could not lock '{lock_file}' in {self.LOCK_TIMEOUT} s") from None
+                time.sleep(0.01)
+        try:
+            yield
+        finally:
+            os.close(fd)
+            os.remove(lock_file)
+
+    def _read_index(self) -> dict[str, dict[str, float]]:
+        index_file = os.path.join(self.cache_dir, self.INDEX_FILE)
+        if not os.path.exists(index_file):
+            return {}
+        try:
+            with open(index_file, "r", encoding="utf-8") as f:
+                return json.load(f)["entries"]
+        except (json.decoder.JSONDecodeError, KeyError):
+            return {}
+
+
+class PreprocessCache:
+    """
+    Cache of the reduced per-file outputs of preprocessing pipelines.
+
+    Args:
+        cache_dir (str): Cache directory, usually `config.path.cache_dir`.
+        quota_gb (float): Disk quota of the cache in GB.
+        content_hash (bool): Identify raw files by a content hash instead of size and mtime.
+            Safer on file systems with unreliable mtimes, but reads every raw file once.
+        dependencies (list[str], optional): Extra files whose identity is part of every key,
+            e.g. the dark file used by `subtract_dark_background`.
+    """
+    def __init__(
+        self,
+        cache_dir: str,
+        quota_gb: float = 20.,
+        content_hash: bool = False,
+        dependencies: Optional[list[str]] = None
+    ) -> None:
+        self.store: DiskLRUCache = DiskLRUCache(
+            os.path.join(cache_dir, "preprocess"), int(quota_gb * 1024 ** 3), suffix=".npz"
+        )
+        self.content_hash: bool = content_hash
+        self.dependencies: list[dict[str, Any]] = [
+            file_identity(file) for file in (dependencies or []) if os.path.exists(file)
+        ]
+        # (path, size, mtime_ns) -> identity, so that content hashes are computed once per file version
+        self._identities: dict[tuple[str, int, int], dict[str, Any]] = {}
+
+    @property
+    def stats(self) -> CacheStats:
+        return self.store.stats
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.store or self.store.adopt(key) is not None
+
+    def identity(self, file: str) -> dict[str, Any]:
+        """Return the identity of a raw file, memoized while its size and mtime do not change."""
+        stat = os.stat(file)
+        memo_key = (os.path.abspath(file), stat.st_size, stat.st_mtime_ns)
+        identity = self._identities.get(memo_key)
+        if identity is None:
+            identity = self._identities[memo_key] = file_identity(file, self.content_hash)
+        return identity
+
+    def key(self, file: str, pipeline_fingerprint: Any) -> str:
+        """Return the cache key of a raw file processed by a pipeline."""
+        return hash_key(
+            self.identity(file), pipeline_fingerprint, self.dependencies, code_version()
+        )
+
+    def get(self, key: str) -> Optional[dict[str, npt.NDArray]]:
+        """Return cached outputs or None on a miss."""
+        if key not in self.store:
+            # Written by another process sharing the cache directory
+            self.store.adopt(key)
+        file = self.store.lookup(key)
+        if file is None:
+            return None
+        try:
+            with np.load(file) as data:
+                return {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            self.store.discard(key)
+            self.store.stats.hits -= 1
+            self.store.stats.misses += 1
+            return None
+
+    def put(self, key: str, data: dict[str, npt.NDArray]) -> None:
+        """Store outputs under `key`."""
+        tmp_file = os.path.join(self.store.cache_dir, f"{key}.{os.getpid()}.tmp")
+        with open(tmp_file, "wb") as f:
+            np.savez(f, **{name: np.asarray(value) for name, value in data.items()})
+        self.store.commit(key, tmp_file)
+
+    def flush(self) -> None:
+        """Persist access times of the cache index."""
+        self.store.flush()
@@ -1,39 +1,84 @@
 import os
 from collections import defaultdict
-from typing import Optional, Any
+from contextlib import nullcontext
+from typing import TYPE_CHECKING, Optional, Any, Iterable
 
 import numpy as np
 import numpy.typing as npt
 from tqdm import tqdm
+from roi_rectangle import RoiRectangle
 
-from src.utils.file_util import get_file_list
+from src.utils.roi_util import union_roi_rect, roi_rects_to_array
 from src.processor.saver import SaverStrategy
-from src.processor.loader import RawDataLoader
+from src.processor.async_saver import AsyncSaver
+from src.processor.loader import RawDataLoader, get_hdf5_images
+from src.processor.cache import PreprocessCache, fingerprint
+from src.processor.scan_index import ScanIndex, get_scan_index
+from src.processor.staging import get_staging_cache
+from src.utils.memory_tracer import MemoryTracer, trace_stage
+from src.utils import metrics
 from src.preprocessor.image_qbpm_preprocessor import ImagesQbpmProcessor
 from src.logger import setup_logger, Logger
 from src.config.config import load_config, ExpConfig
 
+if TYPE_CHECKING:
+    # Only annotations, the modules import scipy.sparse and scipy.fft
+    from src.utils.azimuthal import Reduction
+    from src.utils.fxs import ShotStage
+
 
 class CoreProcessor:
     """
     Use ETL Pattern
+
+    When `roi_rects` is given, only the union of the ROIs is loaded, preprocessed and saved.
+    The preprocessors then receive cropped images, so ROIs they use must be given relative
+    to the union (see `src.utils.roi_util.to_local_roi_rect`). The result additionally holds
+    'crop_origin' (x1, y1 of the union), 'roi_rects' (x1, y1, x2, y2 in detector coordinates)
+    and 'full_frame', the summed full detector image of the middle file for context.
+
+    A `reduction` (e.g. `AzimuthalIntegrator.as_reduction()`) is applied to the stacked
+    result of every preprocessor, for example to save I(q) profiles instead of images.
+
+    `shot_stages` reduce the preprocessed single shots of every file before they are averaged
+    (e.g. `AngularCorrelator.as_shot_stage()`), since shots are not kept. Stage `name` returning
+    `key` for pump state `pon` is stored as 'pon_{name}_{key}', one entry per file.
+
+    Files in `skip_files` (e.g. `get_bad_files(validate_run(run_n))`) are not loaded.
+
+    With a `memory_tracer`, the memory use of loading, `get_data`, every preprocessor and the
+    final stacking is recorded per file (see `src.utils.memory_tracer`).
     """
     def __init__(
         self,
         LoaderStrategy: type[RawDataLoader],
         scan_dir: str,
         preprocessor: Optional[dict[str, ImagesQbpmProcessor]] = None,
-        logger: Optional[Logger] = None
+        logger: Optional[Logger] = None,
+        cache: Optional[PreprocessCache] = None,
+        roi_rects: Optional[list[RoiRectangle]] = None,
+        reduction: Optional["Reduction"] = None,
+        shot_stages: Optional[dict[str, "ShotStage"]] = None,
+        skip_files: Optional[Iterable[str]] = None,
+        memory_tracer: Optional[MemoryTracer] = None
     ) -> None:
         self.LoaderStrategy: type[RawDataLoader] = LoaderStrategy
         self.preprocessor: dict[str, ImagesQbpmProcessor] = preprocessor if preprocessor is not None else {"no_processing": lambda x: x}
 
         self.logger: Logger = logger if logger is not None else setup_logger()
-        self.result: dict[str, defaultdict[str, npt.NDArray]] = self.scan(scan_dir)
+        self.roi_rects: Optional[list[RoiRectangle]] = roi_rects
+        self.crop_rect: Optional[RoiRectangle] = union_roi_rect(roi_rects) if roi_rects else None
+        self.cache: Optional[PreprocessCache] = cache
+        self.reduction: Optional["Reduction"] = reduction
+        self.shot_stages: dict[str, "ShotStage"] = shot_stages if shot_stages is not None else {}
+        self.skip_files: set[str] = {os.path.abspath(file) for file in skip_files} if skip_files is not None else set()
+        self.pipeline_fingerprints: dict[str, Any] = self.get_pipeline_fingerprints() if cache is not None else {}
+        self.memory_tracer: Optional[MemoryTracer] = memory_tracer
+        with memory_tracer if memory_tracer is not None else nullcontext():
+            self.result: dict[str, defaultdict[str, npt.NDArray]] = self.scan(scan_dir)
+        # Logged once per run by the caller, not for every scan
         self.config: ExpConfig = load_config()
 
-        self.logger.info(f"Meta Data:\n{self.config}")
-
     def scan(self, scan_dir: str) -> None:
         """
         Processes a single scan directory.
@@ -51,31 +96,144 @@ class CoreProcessor:
             for pipline_name in self.preprocessor
         }
 
-        hdf5_files = get_file_list(scan_dir)
-        hdf5_files.sort(key=lambda name: int(name[1:-3]))
+        hdf5_files = self.get_hdf5_files(get_scan_index(scan_dir))
+        staging = get_staging_cache()
+        # Files whose outputs are all cached are not read, so not worth copying
+        to_stage = [
+            file if not self.is_cached(file) else None
+            for file in (os.path.join(scan_dir, hdf5_file) for hdf5_file in hdf5_files)
+        ] if staging is not None else []
         pbar = tqdm(hdf5_files, total=len(hdf5_files))
-        for hdf5_file in pbar:
-            loader_strategy = self.get_loader(os.path.join(scan_dir, hdf5_file))
-            if loader_strategy is None:
+        for file_index, hdf5_file in enumerate(pbar):
+            if staging is not None:
+                upcoming = to_stage[file_index + 1:file_index + 1 + staging.prefetch_files]
+                staging.prefetch(file for file in upcoming if file is not None)
+            with trace_stage("process_file", os.path.join(scan_dir, hdf5_file)), \
+                    metrics.timer("core.process_file", file=hdf5_file) as tags:
+                preprocessed_data = self.process_file(os.path.join(scan_dir, hdf5_file))
+                tags["ok"] = preprocessed_data is not None
+            self.logger.trace(f"Processed {file_index + 1}/{len(hdf5_files)}: {hdf5_file}")
+            if preprocessed_data is None:
+                metrics.count("core.files_failed")
                 continue
-            preprocessed_data = self.preprocess_data(loader_strategy)
 
             for preprocessor_name, data in preprocessed_data.items():
                 for data_key, data_value in data.items():
                     preprocessor_data_dict[preprocessor_name][data_key].append(data_value)
 
         self.logger.info(f"Completed processing: {scan_dir}")
+        if self.cache is not None:
+            self.cache.flush()
+            self.logger.info(f"Preprocess cache: {self.cache.stats}")
+            metrics.count("cache.hits", self.cache.stats.hits, scan_dir=scan_dir)
+            metrics.count("cache.misses", self.cache.stats.misses, scan_dir=scan_dir)
+        if staging is not None:
+            staging.flush()
+            self.logger.info(f"Staging cache: {staging.stats}")
 
         result: dict[str, defaultdict[str, npt.NDArray]] = {}
         for preprocessor_name, data in preprocessor_data_dict.items():
-            result[preprocessor_name] = {
-                data_name: np.stack(data_list) for data_name, data_list in data.items()
-            }
+            with trace_stage(f"stack.{preprocessor_name}") as stage:
+                result[preprocessor_name] = {
+                    data_name: np.stack(data_list) for data_name, data_list in data.items()
+                }
+                stage.input_bytes = sum(array.nbytes for array in result[preprocessor_name].values())
+
+        if self.crop_rect is not None and hdf5_files:
+            crop_data = self.get_crop_data(os.path.join(scan_dir, hdf5_files[len(hdf5_files) // 2]))
+            for data in result.values():
+                data.update(crop_data)
+
+        if self.reduction is not None:
+            result = {name: self.reduction(data) for name, data in result.items()}
         return result
 
+    def get_hdf5_files(self, scan_index: ScanIndex) -> list[str]:
+        """Return the names of the files with matched shots in order, logging the files that are skipped."""
+        for file_num, row in scan_index.table.iterrows():
+            if row["error"]:
+                self.logger.warning(f"Skipping '{scan_index.file(file_num)}': {row['error']}")
+            elif row["n_matched"] == 0:
+                self.logger.warning(f"Skipping '{scan_index.file(file_num)}': no matched shots")
+            elif scan_index.file(file_num) in self.skip_files:
+                self.logger.warning(f"Skipping '{scan_index.file(file_num)}': failed validation")
+        files = [os.path.basename(file) for file in scan_index.files() if file not in self.skip_files]
+        metrics.count("core.files_skipped", len(scan_index.table) - len(files), scan_dir=scan_index.scan_dir)
+        return files
+
+    def get_crop_data(self, hdf5_file: str) -> dict[str, npt.NDArray]:
+        """Return the crop geometry and the full frame context image saved along cropped stacks."""
+        self.logger.info(f"Cropped to {self.crop_rect}, full frame context from '{hdf5_file}'")
+        return {
+            "crop_origin": np.array([self.crop_rect.x1, self.crop_rect.y1], dtype=np.int64),
+            "roi_rects": roi_rects_to_array(self.roi_rects),
+            "full_frame": get_hdf5_images(hdf5_file, load_config()).sum(axis=0),
+        }
+
+    def process_file(self, hdf5_file: str) -> Optional[dict[str, dict[str, Any]]]:
+        """
+        Load and preprocess a single file, reusing cached results when possible.
+
+        Parameters:
+        - hdf5_file (str): Path of the raw HDF5 file.
+
+        Returns:
+        - Optional[dict[str, dict[str, Any]]]: Preprocessed data by preprocessor name,
+          or None if the file could not be loaded.
+        """
+        preprocessed_data: dict[str, dict[str, Any]] = {}
+        cache_keys: dict[str, str] = {}
+        if self.cache is not None:
+            for preprocessor_name, pipeline_fingerprint in self.pipeline_fingerprints.items():
+                cache_keys[preprocessor_name] = self.cache.key(hdf5_file, pipeline_fingerprint)
+                cached = self.cache.get(cache_keys[preprocessor_name])
+                if cached is not None:
+                    preprocessed_data[preprocessor_name] = cached
+
+        missing = [name for name in self.preprocessor if name not in preprocessed_data]
+        if not missing:
+            return preprocessed_data
+
+        with trace_stage("load"):
+            loader_strategy = self.get_loader(hdf5_file)
+        if loader_strategy is None:
+            return None
+        fresh_data = self.preprocess_data(loader_strategy, missing)
+
+        if self.cache is not None:
+            for preprocessor_name, data in fresh_data.items():
+                self.cache.put(cache_keys[preprocessor_name], data)
+
+        preprocessed_data.update(fresh_data)
+        return {name: preprocessed_data[name] for name in self.preprocessor}
+
+    def is_cached(self, hdf5_file: str) -> bool:
+        """Return whether the outputs of every pipeline for `hdf5_file` are in the cache."""
+        if self.cache is None:
+            return False
+        return all(
+            self.cache.key(hdf5_file, pipeline_fingerprint) in self.cache
+            for pipeline_fingerprint in self.pipeline_fingerprints.values()
+        )
+
+    def get_pipeline_fingerprints(self) -> dict[str, Any]:
+        """Canonical description of every pipeline, used as part of the cache keys."""
+        param_fingerprint = fingerprint(load_config().param)
+        crop_fingerprint = fingerprint(self.crop_rect)
+        stage_fingerprint = fingerprint(self.shot_stages)
+        return {
+            name: [
+                fingerprint(self.LoaderStrategy), param_fingerprint, crop_fingerprint,
+                fingerprint(preprocessor), stage_fingerprint
+            ]
+            for name, preprocessor in self.preprocessor.items()
+        }
+
     def get_loader(self, hdf5_dir: str) -> Optional[RawDataLoader]:
         """Get Loader"""
         try:
+            if self.crop_rect is not None:
+                return self.LoaderStrategy(hdf5_dir, crop_rect=self.crop_rect)
             return self.LoaderStrategy(hdf5_dir)
         except (KeyError, FileNotFoundError, ValueError) as e:
             self.logger.exception(f"{type(e)} happened in {hdf5_dir}")
@@ -90,30 +248,42 @@ class CoreProcessor:
     def preprocess_data(
         self,
         loader_strategy: RawDataLoader,
+        preprocessor_names: Optional[list[str]] = None
     ) -> dict[str, dict[str, Any]]:
 
+        if preprocessor_names is None:
+            preprocessor_names = list(self.preprocessor)
+
         preprocessed_data: dict[str, dict[str, Any]] = {}
-        for preprocessor_name, preprocessor in self.preprocessor.items():
-            data: dict[str, Any] = {}
+        with trace_stage("get_data") as stage:
             loader_dict = loader_strategy.get_data()
-            if "pon" in loader_dict:
-                applied_pon_images: npt.NDArray = preprocessor((loader_dict['pon'], loader_dict['pon_qbpm']))[0]
-                data['pon'] = applied_pon_images.mean(axis=0)
-            if 'poff' in loader_dict:
-                applied_poff_images: npt.NDArray = preprocessor((loader_dict['poff'], loader_dict['poff_qbpm']))[0]
-                data['poff'] = applied_poff_images.mean(axis=0)
+            stage.input_bytes = sum(np.asarray(value).nbytes for value in loader_dict.values())
+        for preprocessor_name in preprocessor_names:
+            preprocessor = self.preprocessor[preprocessor_name]
+            data: dict[str, Any] = {}
+            for pump_state in ("pon", "poff"):
+                if pump_state not in loader_dict:
+                    continue
+                with trace_stage(f"preprocess.{preprocessor_name}", input_bytes=loader_dict[pump_state].nbytes):
+                    applied_images: npt.NDArray = preprocessor((loader_dict[pump_state], loader_dict[f"{pump_state}_qbpm"]))[0]
+                data[pump_state] = applied_images.mean(axis=0)
+                for stage_name, shot_stage in self.shot_stages.items():
+                    for key, value in shot_stage(applied_images).items():
+                        data[f"{pump_state}_{stage_name}_{key}"] = value
             data["delay"] = loader_dict['delay']
             preprocessed_data[preprocessor_name] = data
 
         return preprocessed_data
 
-    def save(self, saver: SaverStrategy, run_n: int, scan_n: int):
+    def save(self, saver: SaverStrategy, run_n: int, scan_n: int, async_saver: Optional[AsyncSaver] = None):
         """
         Saves processed images using a specified saving strategy.
 
         Parameters:
         - saver (SaverStrategy): Saving strategy to use.
-        - comment (str, optional): Comment to append to the file name.
+        - run_n (int): Run number.
+        - scan_n (int): Scan number.
+        - async_saver (AsyncSaver, optional): Queue the data to be written in the background instead.
         """
         self.logger.info(f"Start to save as {saver.file_type.capitalize()}")
 
@@ -123,6 +293,11 @@ class CoreProcessor:
 
         for pipline_name, data_dict in self.result.items():
 
+            if async_saver is not None:
+                async_saver.submit(saver, run_n, scan_n, data_dict)
+                self.logger.info(f"Queued preprocessor: {pipline_name}")
+                continue
+
             saver.save(run_n, scan_n, data_dict)
             self.logger.info(f"Finished preprocessor: {pipline_name}")
             self.logger.info(f"Data Dict Keys: {data_dict.keys()}")
@@ -1,17 +1,56 @@
 import os
 from abc import ABC, abstractmethod
-from typing import Union
+from typing import Optional, Union
 
 import numpy as np
 import numpy.typing as npt
 import pandas as pd
 import h5py
 import hdf5plugin  # pylint: disable=unused-import
+from roi_rectangle import RoiRectangle
 
+from src.utils.memory_tracer import trace_stage
+from src.processor.staging import staged_file
 from src.config.config import load_config, ExpConfig
 from src.config.enums import Hertz
 
 
+def get_shot_delays(metadata: pd.DataFrame) -> npt.NDArray[np.float64]:
+    """
+    Return the delay of every shot, or θ for rocking scans.
+
+    Parameters:
+    - metadata (pd.DataFrame): Metadata of the shots.
+
+    Returns:
+    - npt.NDArray[np.float64]: 'th_value' or 'delay_value' of every shot, NaN if neither exists.
+    """
+    if "th_value" in metadata:
+        return np.asarray(metadata['th_value'], dtype=np.float64)
+    if "delay_value" in metadata:
+        return np.asarray(metadata['delay_value'], dtype=np.float64)
+    return np.full(metadata.shape[0], np.nan)
+
+
+def get_pump_mask(metadata: pd.DataFrame, config: ExpConfig) -> npt.NDArray[np.bool_]:
+    """
+    Return the pump state of every shot according to the pump setting of `config`.
+
+    Parameters:
+    - metadata (pd.DataFrame): Metadata of the shots.
+    - config (ExpConfig): Experiment configuration.
+
+    Returns:
+    - npt.NDArray[np.bool_]: True for pump-on shots.
+    """
+    if config.param.pump_setting is Hertz.ZERO:
+        return np.zeros(metadata.shape[0], dtype=np.bool_)
+    return np.asarray(
+        metadata[f'timestamp_info.RATE_{config.param.xray.value}_{config.param.pump_setting.value}'],
+        dtype=np.bool_
+    )
+
+
 class RawDataLoader(ABC):
     """
     Abstract base class for loading raw data from various sources.
@@ -24,12 +63,13 @@ class RawDataLoader(ABC):
     """
 
     @abstractmethod
-    def __init__(self, file: str) -> None:
+    def __init__(self, file: str, crop_rect: Optional[RoiRectangle] = None) -> None:
         """
         Initialize the RawDataLoader with the path to the raw data file.
 
         Args:
             file (str): The path to the raw data file.
+            crop_rect (RoiRectangle, optional): Only load the pixels inside this rectangle.
         """
 
     @abstractmethod
@@ -45,24 +85,34 @@ class RawDataLoader(ABC):
 
 class HDF5FileLoader(RawDataLoader):
     """Load hdf5 file and remove unmatching data."""
-    def __init__(self, file: str):
+    def __init__(self, file: str, crop_rect: Optional[RoiRectangle] = None):
         """
         Initializes the HDF5FileLoader by loading
         metadata, images, and qbpm data from the given file.
 
         Parameters:
-        - file (str): Path to the HDF5 file.
+        - file (str): Path to the HDF5 file. It is read from its local copy when staging is configured.
+        - crop_rect (RoiRectangle, optional): Only read the detector pixels inside this rectangle.
         """
         if not os.path.isfile(file):
             raise FileNotFoundError(f"No such file: {file}")
 
         self.file: str = file
+        self.crop_rect: Optional[RoiRectangle] = crop_rect
         self.config: ExpConfig = load_config()
 
-        metadata: pd.DataFrame = pd.read_hdf(self.file, key='metadata')
-        merged_df: pd.DataFrame = self.get_merged_df(metadata)
-
-        self.images: npt.NDArray[np.float32] = np.stack(merged_df['image'].values)
+        # The local copy is kept from eviction while it is read
+        with staged_file(file) as local_file:
+            self.local_file: str = local_file
+            with trace_stage("read_metadata"):
+                metadata: pd.DataFrame = pd.read_hdf(self.local_file, key='metadata')
+            with trace_stage("get_merged_df") as stage:
+                merged_df: pd.DataFrame = self.get_merged_df(metadata)
+                stage.input_bytes = sum(image.nbytes for image in merged_df['image'].values)
+
+        with trace_stage("stack_images") as stage:
+            self.images: npt.NDArray[np.float32] = np.stack(merged_df['image'].values)
+            stage.input_bytes = self.images.nbytes
         self.qbpm: npt.NDArray[np.float32] = np.stack(merged_df['qbpm'].values)
         self.pump_state: npt.NDArray[np.bool_] = self.get_pump_mask(merged_df)
         self.delay: npt.NDArray[np.float64] = self.get_delay(merged_df)
@@ -90,13 +140,13 @@ class HDF5FileLoader(RawDataLoader):
         Returns:
         - pd.DataFrame: Merged DataFrame containing metadata, images, and qbpm data.
         """
-        with h5py.File(self.file, "r") as hf:
+        with h5py.File(self.local_file, "r") as hf:
             if "detector" not in hf:
                 raise KeyError(f"Key 'detector' not found in {self.file}")
 
             image_group = hf[f'detector/{self.config.param.hutch.value}/{self.config.param.detector.value}/image']
             images_ts = np.asarray(image_group["block0_items"], dtype=np.int64)
-            images = np.asarray(image_group["block0_values"], dtype=np.float32)
+            images = np.asarray(self.read_images(image_group["block0_values"]), dtype=np.float32)
 
             qbpm_group = hf[f'qbpm/{self.config.param.hutch.value}/qbpm1']
             qbpm_ts = np.asarray(qbpm_group['waveforms.ch1/axis1'], dtype=np.int64)
@@ -123,6 +173,12 @@ class HDF5FileLoader(RawDataLoader):
         merged_df = pd.merge(image_df, qbpm_df, left_index=True, right_index=True, how='inner')
         return pd.merge(metadata, merged_df, left_index=True, right_index=True, how='inner')
 
+    def read_images(self, dataset: h5py.Dataset) -> npt.NDArray:
+        """Read the image dataset, only touching the chunks inside `crop_rect`."""
+        if self.crop_rect is None:
+            return dataset[()]
+        return dataset[:, self.crop_rect.y1:self.crop_rect.y2, self.crop_rect.x1:self.crop_rect.x2]
+
     def get_delay(self, merged_df: pd.DataFrame) -> Union[np.float64, float]:
         """
         Retrieves the delay value from the merged_df.
@@ -133,11 +189,8 @@ class HDF5FileLoader(RawDataLoader):
         Returns:
         - Union[np.float64, float]: Delay value or NaN if not found.
         """
-        if "th_value" in merged_df:
-            return np.asarray(merged_df['th_value'], dtype=np.float64)[0]
-        if "delay_value" in merged_df:
-            return np.asarray(merged_df['delay_value'], dtype=np.float64)[0]
-        return np.nan
+        shot_delays = get_shot_delays(merged_df)
+        return shot_delays[0] if shot_delays.size else np.nan
 
     def get_pump_mask(self, merged_df: pd.DataFrame) -> npt.NDArray[np.bool_]:
         """
@@ -149,12 +202,7 @@ class HDF5FileLoader(RawDataLoader):
         Returns:
         - npt.NDArray[np.bool_]: Pump status mask.
         """
-        if self.config.param.pump_setting is Hertz.ZERO:
-            return np.zeros(merged_df.shape[0], dtype=np.bool_)
-        return np.asarray(
-            merged_df[f'timestamp_info.RATE_{self.config.param.xray.value}_{self.config.param.pump_setting.value}'],
-            dtype=np.bool_
-            )
+        return get_pump_mask(merged_df, self.config)
 
     def get_data(self) -> dict[str, npt.NDArray]:
         """
@@ -183,8 +231,8 @@ class HDF5FileLoader(RawDataLoader):
 
 
 def get_hdf5_images(file: str, config: ExpConfig) -> npt.NDArray:
-    """get images form hdf5"""
-    with h5py.File(file, "r") as hf:
+    """get images form hdf5, from the local copy when staging is configured"""
+    with staged_file(file) as local_file, h5py.File(local_file, "r") as hf:
         if "detector" not in hf:
             raise KeyError(f"Key 'detector' not found in {file}")
 
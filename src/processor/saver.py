@@ -1,9 +1,13 @@
 import os
+import threading
 from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Optional
 
 import numpy.typing as npt
 import numpy as np
-from scipy.io import savemat
+import h5py
+import hdf5plugin
 
 from src.config.config import load_config
 from src.utils.file_util import create_run_scan_directory
@@ -15,15 +19,40 @@ def get_file_base_name(run_n: int, scan_n: int) -> str:
 
 
 class SaverStrategy(ABC):
-    """Save data_dict to a file."""
-    @abstractmethod
+    """
+    Save data_dict to a file.
+
+    The data is written to a temporary file next to the target which is renamed
+    atomically once complete, so readers never see partially written files.
+    Subclasses implement `get_file` and `write`.
+    """
+    def __init__(self):
+        self._file: str = None
+
     def save(self, run_n: int, scan_n: int, data_dict: dict[str, npt.NDArray], comment: str = ""):
-        pass
+        comment = "_" + comment if comment else ""
+        file = self.get_file(run_n, scan_n, comment)
+        tmp_file = f"{file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            self.write(tmp_file, run_n, scan_n, data_dict, comment)
+            os.replace(tmp_file, file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        self._file = file
+
+    @abstractmethod
+    def get_file(self, run_n: int, scan_n: int, comment: str) -> str:
+        """Return the path of the file to write, creating its directory."""
 
-    @property
     @abstractmethod
+    def write(self, file: str, run_n: int, scan_n: int, data_dict: dict[str, npt.NDArray], comment: str):
+        """Write data_dict to file."""
+
+    @property
     def file(self) -> str:
         """Return File Name"""
+        return self._file
 
     @property
     @abstractmethod
@@ -31,27 +60,79 @@ class SaverStrategy(ABC):
         """Return File Type"""
 
 
+MATLAB_CLASSES: dict[np.dtype, str] = {
+    np.dtype(np.float64): "double",
+    np.dtype(np.float32): "single",
+    np.dtype(np.int8): "int8",
+    np.dtype(np.int16): "int16",
+    np.dtype(np.int32): "int32",
+    np.dtype(np.int64): "int64",
+    np.dtype(np.uint8): "uint8",
+    np.dtype(np.uint16): "uint16",
+    np.dtype(np.uint32): "uint32",
+    np.dtype(np.uint64): "uint64",
+    np.dtype(np.bool_): "logical",
+}
+
+
+def get_mat73_header() -> bytes:
+    """Return the 128 byte MAT-file header written into the HDF5 user block."""
+    created = datetime.now().strftime("%a %b %d %H:%M:%S %Y")
+    text = f"MATLAB 7.3 MAT-file, Platform: PCWIN64, Created on: {created} HDF5 schema 1.00 ."
+    return text.ljust(116).encode("ascii") + b"\x00" * 8 + b"\x00\x02" + b"IM"
+
+
 class MatSaverStrategy(SaverStrategy):
+    """
+    Save every key of data_dict into one MAT v7.3 (HDF5 based) file.
 
-    def __init__(self):
-        self._file: str = None
+    MATLAB reads HDF5 datasets in column-major order, i.e. with reversed dimensions.
+    An image stack of shape (N, H, W) is therefore written frame by frame as (N, W, H),
+    which MATLAB opens as an H x W x N array, without a transposed copy of the whole stack.
+    v7.3 files have no 2 GB limit and can be read partially with `matfile` in MATLAB.
+    """
 
-    def save(self, run_n: int, scan_n: int, data_dict: dict[str, npt.NDArray], comment: str = ""):
-        comment = "_" + comment if comment else ""
+    USERBLOCK_SIZE: int = 512
+
+    def get_file(self, run_n: int, scan_n: int, comment: str) -> str:
         config = load_config()
         mat_dir = config.path.mat_dir
         os.makedirs(mat_dir, exist_ok=True)
-        for key, val in data_dict.items():
-            if val.ndim == 3:
-                mat_format_images = val.swapaxes(0, 2).swapaxes(0, 1)  # TEMP
-                file_base_name = get_file_base_name(run_n, scan_n)
-                mat_file = os.path.join(mat_dir, f"{file_base_name}_{key}{comment}.mat")
-                savemat(mat_file, {"data": mat_format_images})
-        self._file = mat_file
-
-    @property
-    def file(self) -> str:
-        return self._file
+        file_base_name = get_file_base_name(run_n, scan_n)
+        return os.path.join(mat_dir, f"{file_base_name}{comment}.mat")
+
+    def write(self, file: str, run_n: int, scan_n: int, data_dict: dict[str, npt.NDArray], comment: str):
+        with h5py.File(file, "w", userblock_size=self.USERBLOCK_SIZE, libver="earliest") as hf:
+            for key, val in data_dict.items():
+                self.write_variable(hf, key, np.asarray(val))
+
+        with open(file, "r+b") as f:
+            f.write(get_mat73_header())
+
+    def write_variable(self, hf: h5py.File, key: str, val: npt.NDArray) -> None:
+        """Write `val` as MATLAB variable `key`, streaming image stacks frame by frame."""
+        matlab_class = MATLAB_CLASSES.get(val.dtype)
+        if matlab_class is None:
+            val = val.astype(np.float64)
+            matlab_class = "double"
+        if val.dtype == np.bool_:
+            val = val.astype(np.uint8)
+
+        if val.ndim == 0:
+            dataset = hf.create_dataset(key, data=val.reshape(1, 1))
+        elif val.ndim == 1:
+            dataset = hf.create_dataset(key, data=val.reshape(1, -1))
+        elif val.ndim == 2:
+            dataset = hf.create_dataset(key, data=val.T)
+        else:
+            mat_shape = val.shape[:-2] + val.shape[-2:][::-1]
+            dataset = hf.create_dataset(key, shape=mat_shape, dtype=val.dtype, chunks=(1,) * (val.ndim - 2) + mat_shape[-2:])
+            for index in np.ndindex(val.shape[:-2]):
+                dataset[index] = val[index].T
+
+        dataset.attrs.create("MATLAB_class", np.bytes_(matlab_class))
+        if matlab_class == "logical":
+            dataset.attrs.create("MATLAB_int_decode", np.int32(1))
 
     @property
     def file_type(self) -> str:
@@ -60,34 +141,78 @@ class MatSaverStrategy(SaverStrategy):
 
 class NpzSaverStrategy(SaverStrategy):
 
-    def __init__(self):
-        self._file: str = None
-
-    def save(self, run_n: int, scan_n: int, data_dict: dict[str, npt.NDArray], comment: str = ""):
-        comment = "_" + comment if comment else ""
+    def get_file(self, run_n: int, scan_n: int, comment: str) -> str:
         config = load_config()
         processed_dir = config.path.processed_dir
         os.makedirs(processed_dir, exist_ok=True)
         file_base_name = get_file_base_name(run_n, scan_n)
         npz_dir = create_run_scan_directory(processed_dir, run_n, scan_n)
-        npz_file = os.path.join(npz_dir, file_base_name + comment + ".npz")
-        np.savez(npz_file, **data_dict)
-        self._file = npz_file
+        return os.path.join(npz_dir, file_base_name + comment + ".npz")
 
-    @property
-    def file(self) -> str:
-        return self._file
+    def write(self, file: str, run_n: int, scan_n: int, data_dict: dict[str, npt.NDArray], comment: str):
+        # Write through a file object, np.savez would append '.npz' to the temporary name
+        with open(file, "wb") as f:
+            np.savez(f, **data_dict)
 
     @property
     def file_type(self) -> str:
         return "npz"
 
 
+class H5SaverStrategy(SaverStrategy):
+    """
+    Save data_dict as a chunked, compressed HDF5 file.
+
+    Image stacks are chunked per delay frame, or per (tile x tile) ROI tile of each
+    delay frame if `tile` is given, and compressed with Blosc LZ4 + bitshuffle from
+    hdf5plugin. Reading one delay or one ROI then only decompresses the touched chunks.
+    The processing configuration is stored as json in the 'config' attribute.
+    """
+
+    def __init__(self, tile: Optional[int] = None, clevel: int = 5):
+        super().__init__()
+        self.tile: Optional[int] = tile
+        self.compression = hdf5plugin.Blosc(cname="lz4", clevel=clevel, shuffle=hdf5plugin.Blosc.BITSHUFFLE)
+
+    def get_chunks(self, shape: tuple[int, ...]) -> tuple[int, ...]:
+        """Return the chunk shape of an image stack."""
+        frame_shape = shape[-2:]
+        if self.tile is not None:
+            frame_shape = tuple(min(self.tile, size) for size in frame_shape)
+        return (1,) * (len(shape) - 2) + frame_shape
+
+    def get_file(self, run_n: int, scan_n: int, comment: str) -> str:
+        config = load_config()
+        processed_dir = config.path.processed_dir
+        file_base_name = get_file_base_name(run_n, scan_n)
+        h5_dir = create_run_scan_directory(processed_dir, run_n, scan_n)
+        return os.path.join(h5_dir, file_base_name + comment + ".h5")
+
+    def write(self, file: str, run_n: int, scan_n: int, data_dict: dict[str, npt.NDArray], comment: str):
+        config = load_config()
+        with h5py.File(file, "w") as hf:
+            hf.attrs["config"] = config.model_dump_json()
+            hf.attrs["run"] = run_n
+            hf.attrs["scan"] = scan_n
+            hf.attrs["comment"] = comment
+            for key, val in data_dict.items():
+                val = np.asarray(val)
+                if val.ndim >= 2 and val.size > 0:
+                    hf.create_dataset(key, data=val, chunks=self.get_chunks(val.shape), **self.compression)
+                else:
+                    hf.create_dataset(key, data=val)
+
+    @property
+    def file_type(self) -> str:
+        return "h5"
+
+
 def get_saver_strategy(file_type: str) -> SaverStrategy:
     """Get SaverStrategy by file type."""
     strategies = {
         'mat': MatSaverStrategy,
-        'npz': NpzSaverStrategy
+        'npz': NpzSaverStrategy,
+        'h5': H5SaverStrategy
     }
 
     strategy_class = strategies.get(file_type)
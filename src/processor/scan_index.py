@@ -0,0 +1,252 @@
+"""
+Per-scan sidecar index of the raw HDF5 files.
+
+Planning a job, checking a scan or picking a file to show only needs a few facts per file,
+but getting them means opening the file and parsing the whole pandas metadata. `ScanIndex`
+extracts them once per file and keeps them in a compact columnar npz sidecar per scan:
+    - size and mtime of the file (to detect changes),
+    - matched shot count and pump-on / pump-off counts (with the same matching as `HDF5FileLoader`),
+    - the delay (or θ) of every matched shot,
+    - image shape, dtype and chunking,
+    - the range of the summed QBPM signal.
+Files are only re-read when their size or mtime changes, in parallel.
+
+Example usage:
+    index = ScanIndex(scan_dir)
+    index.update()
+    file = index.middle_file()
+    print(index.table[["n_pon", "n_poff", "delay"]])
+"""
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Optional
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+import h5py
+import hdf5plugin  # pylint: disable=unused-import
+
+from src.processor.loader import get_pump_mask, get_shot_delays
+from src.utils.file_util import get_file_list
+from src.config.config import load_config, ExpConfig
+
+
+COLUMNS: tuple[str, ...] = (
+    "file_num", "size", "mtime_ns", "n_shots", "n_matched", "n_pon", "n_poff", "delay",
+    "image_shape", "image_dtype", "image_chunks", "qbpm_min", "qbpm_max", "error",
+)
+
+
+def config_key(config: ExpConfig) -> str:
+    """Return a hash of the settings that change the extracted facts."""
+    param = config.param
+    text = repr((param.hutch.value, param.detector.value, param.xray.value, param.pump_setting.value))
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def extract_file_facts(file: str, config: ExpConfig) -> tuple[dict[str, Any], npt.NDArray[np.float64]]:
+    """
+    Read the facts of a raw HDF5 file without reading its images.
+
+    Parameters:
+    - file (str): Path of the raw HDF5 file.
+    - config (ExpConfig): Experiment configuration.
+
+    Returns:
+    - tuple[dict[str, Any], npt.NDArray[np.float64]]: The row of the file in the index and the
+      delay of every matched shot. Failures are stored in 'error' instead of being raised.
+    """
+    # -1 and 0 until the name and the file are read, failures are stored like any other
+    facts: dict[str, Any] = {
+        "file_num": -1, "size": 0, "mtime_ns": 0,
+        "n_shots": 0, "n_matched": 0, "n_pon": 0, "n_poff": 0, "delay": np.nan,
+        "image_shape": (0, 0, 0), "image_dtype": "", "image_chunks": (0, 0, 0),
+        "qbpm_min": np.nan, "qbpm_max": np.nan, "error": "",
+    }
+    try:
+        facts["file_num"] = int(os.path.basename(file)[1:-3])
+        stat = os.stat(file)
+        facts["size"], facts["mtime_ns"] = stat.st_size, stat.st_mtime_ns
+        metadata: pd.DataFrame = pd.read_hdf(file, key='metadata')
+        with h5py.File(file, "r") as hf:
+            image_group = hf[f'detector/{config.param.hutch.value}/{config.param.detector.value}/image']
+            dataset: h5py.Dataset = image_group["block0_values"]
+            images_ts = np.asarray(image_group["block0_items"], dtype=np.int64)
+            facts["image_shape"] = tuple(dataset.shape)
+            facts["image_dtype"] = str(dataset.dtype)
+            facts["image_chunks"] = tuple(dataset.chunks) if dataset.chunks is not None else (0,) * dataset.ndim
+
+            qbpm_group = hf[f'qbpm/{config.param.hutch.value}/qbpm1']
+            qbpm_ts = np.asarray(qbpm_group['waveforms.ch1/axis1'], dtype=np.int64)
+            qbpm = np.stack(
+                [qbpm_group[f'waveforms.ch{i + 1}/block0_values'] for i in range(4)],
+                axis=0,
+                dtype=np.float32
+            ).sum(axis=(0, 2))
+    except Exception as e:  # pylint: disable=broad-except
+        # Any failure to read the file makes it invalid, e.g. a truncated file raises from PyTables
+        message = str(e).strip().splitlines()
+        facts["error"] = f"{type(e).__name__}: {message[-1] if message else ''}"
+        return facts, np.empty(0)
+
+    # Same inner join on the timestamps as HDF5FileLoader.get_merged_df
+    matched_ts = np.intersect1d(images_ts, qbpm_ts)
+    matched = metadata.loc[metadata.index.isin(matched_ts)]
+    qbpm_matched = pd.Series(qbpm, index=qbpm_ts).groupby(level=0).first().reindex(matched.index).to_numpy()
+    pump_state = get_pump_mask(matched, config)
+    shot_delays = get_shot_delays(matched)
+
+    facts["n_shots"] = len(images_ts)
+    facts["n_matched"] = len(matched)
+    facts["n_pon"] = int(pump_state.sum())
+    facts["n_poff"] = int((~pump_state).sum())
+    if len(matched):
+        facts["delay"] = float(shot_delays[0])
+        facts["qbpm_min"] = float(np.min(qbpm_matched))
+        facts["qbpm_max"] = float(np.max(qbpm_matched))
+    return facts, shot_delays
+
+
+def _extract_file_facts(file: str) -> tuple[dict[str, Any], npt.NDArray[np.float64]]:
+    return extract_file_facts(file, load_config())
+
+
+class ScanIndex:
+    """
+    Sidecar index of the files of one scan directory.
+
+    Args:
+        scan_dir (str): Directory holding the 'pXXXX.h5' files.
+        index_file (str, optional): Sidecar file. Defaults to 'scan_index/{hash of scan_dir}.npz'
+            in the configured cache directory.
+        max_workers (int, optional): Number of processes reading files, 1 reads them in this process.
+    """
+    def __init__(self, scan_dir: str, index_file: Optional[str] = None, max_workers: Optional[int] = None) -> None:
+        self.scan_dir: str = os.path.abspath(scan_dir)
+        self.config: ExpConfig = load_config()
+        if index_file is None:
+            scan_hash = hashlib.sha256(self.scan_dir.encode("utf-8")).hexdigest()[:16]
+            index_file = os.path.join(self.config.path.cache_dir, "scan_index", f"{scan_hash}.npz")
+        self.index_file: str = index_file
+        self.max_workers: Optional[int] = max_workers
+
+        self.table: pd.DataFrame = pd.DataFrame(columns=list(COLUMNS)).set_index("file_num")
+        self.shot_delays: dict[int, npt.NDArray[np.float64]] = {}
+        self.load()
+
+    def load(self) -> None:
+        """Read the sidecar if it exists and was built with the current settings."""
+        if not os.path.exists(self.index_file):
+            return
+        with np.load(self.index_file, allow_pickle=False) as data:
+            if str(data["config_key"]) != config_key(self.config):
+                return
+            columns = {name: data[name] for name in COLUMNS}
+            offsets = data["shot_offsets"]
+            shot_delays = data["shot_delays"]
+        for name in ("image_shape", "image_chunks"):
+            columns[name] = [tuple(int(v) for v in row) for row in columns[name]]
+        self.table = pd.DataFrame(columns).set_index("file_num")
+        self.shot_delays = {
+            int(file_num): shot_delays[offsets[i]:offsets[i + 1]]
+            for i, file_num in enumerate(self.table.index)
+        }
+
+    def save(self) -> None:
+        """Write the sidecar atomically."""
+        table = self.table.reset_index()
+        lengths = [len(self.shot_delays[file_num]) for file_num in table["file_num"]]
+        columns = {name: np.asarray(table[name].tolist()) for name in COLUMNS}
+        columns["image_dtype"] = columns["image_dtype"].astype(str)
+        columns["error"] = columns["error"].astype(str)
+        for name in ("image_shape", "image_chunks"):
+            columns[name] = np.asarray(table[name].tolist(), dtype=np.int64).reshape(len(table), -1)
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_file)), exist_ok=True)
+        tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            np.savez(
+                f,
+                config_key=np.array(config_key(self.config)),
+                shot_offsets=np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]),
+                shot_delays=np.concatenate([np.empty(0)] + [self.shot_delays[n] for n in table["file_num"]]),
+                **columns
+            )
+        os.replace(tmp_file, self.index_file)
+
+    def update(self) -> int:
+        """
+        Index new and changed files, drop deleted ones and save the sidecar if anything changed.
+
+        Returns:
+        - int: Number of files that were read.
+        """
+        stats = {}
+        for name in get_file_list(self.scan_dir):
+            if name.startswith("p") and name.endswith(".h5") and name[1:-3].isdigit():
+                stat = os.stat(os.path.join(self.scan_dir, name))
+                stats[int(name[1:-3])] = (name, stat.st_size, stat.st_mtime_ns)
+
+        stale = [
+            name for file_num, (name, size, mtime_ns) in stats.items()
+            if file_num not in self.table.index
+            or (self.table.at[file_num, "size"], self.table.at[file_num, "mtime_ns"]) != (size, mtime_ns)
+        ]
+        removed = [file_num for file_num in self.table.index if file_num not in stats]
+        if not stale and not removed:
+            return 0
+
+        files = [os.path.join(self.scan_dir, name) for name in stale]
+        if self.max_workers == 1 or len(files) <= 1:
+            results = [extract_file_facts(file, self.config) for file in files]
+        else:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                results = list(executor.map(_extract_file_facts, files))
+
+        table = self.table.drop(index=removed + [facts["file_num"] for facts, _ in results], errors="ignore")
+        rows = pd.DataFrame([facts for facts, _ in results], columns=list(COLUMNS)).set_index("file_num")
+        self.table = pd.concat([table, rows]).sort_index() if len(table) else rows.sort_index()
+        for file_num in removed:
+            self.shot_delays.pop(file_num, None)
+        for facts, shot_delays in results:
+            self.shot_delays[facts["file_num"]] = shot_delays
+        self.save()
+        return len(files)
+
+    def valid_file_nums(self) -> list[int]:
+        """Return the numbers of the files without errors that have matched shots, in order."""
+        valid = (self.table["error"] == "") & (self.table["n_matched"] > 0)
+        return [int(file_num) for file_num in self.table.index[valid]]
+
+    def file(self, file_num: int) -> str:
+        """Return the path of file `file_num`."""
+        return os.path.join(self.scan_dir, f"p{file_num:0>4}.h5")
+
+    def files(self) -> list[str]:
+        """Return the paths of the valid files in order."""
+        return [self.file(file_num) for file_num in self.valid_file_nums()]
+
+    def middle_file(self) -> str:
+        """Return the path of the middle valid file, e.g. to select ROIs on."""
+        file_nums = self.valid_file_nums()
+        if not file_nums:
+            raise FileNotFoundError(f"No valid files in {self.scan_dir}")
+        return self.file(file_nums[len(file_nums) // 2])
+
+
+def get_scan_index(scan_dir: str) -> ScanIndex:
+    """Return the up to date index of `scan_dir`."""
+    index = ScanIndex(scan_dir)
+    index.update()
+    return index
+
+
+if __name__ == "__main__":
+    from src.utils.file_util import get_run_scan_directory
+
+    config: ExpConfig = load_config()
+    scan_dir: str = get_run_scan_directory(config.path.load_dir, 154, 1)
+    index = get_scan_index(scan_dir)
+    print(index.table)
@@ -0,0 +1,229 @@
+"""
+Local staging of raw files read from a network share.
+
+`load_dir` is usually a network share, so re-reading the same raw files across reruns
+and analysis passes is limited by the network. With `path.staging_dir` set in the config,
+the loaders read raw files through `staged_file`, which copies each file once into the
+staging directory (e.g. on a local SSD) and yields the local copy:
+
+    - entries are keyed by the path, size and mtime of the source file, so a file that
+      changes on the share is copied again, and the old copy is eventually evicted,
+    - a copy is only used if its size and mtime match the source,
+    - the directory is bounded by `path.staging_quota_gb`, least recently used files are
+      removed first (`DiskLRUCache`), except the copies being read,
+    - `CoreProcessor` prefetches the next files of the scan in background threads while
+      the current one is processed.
+
+Files that cannot be staged (disk full, file changing while copied, ...) are read in place.
+
+Example usage:
+    with staged_file(file) as local_file, h5py.File(local_file, "r") as hf:
+        ...
+"""
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Iterable, Iterator, Optional
+
+from src.processor.cache import DiskLRUCache, CacheStats, file_identity, hash_key
+from src.config.config import load_config
+from src.logger import setup_logger, Logger
+from src.utils import metrics
+
+
+class StagingCache:
+    """
+    Size-bounded local copies of raw files.
+
+    Args:
+        staging_dir (str): Local directory of the copies.
+        quota_gb (float): Disk quota of the copies in GB. Keep it above the size of a few scans,
+            or the prefetched files of a scan evict each other.
+        max_workers (int): Files copied at the same time by `prefetch`.
+        prefetch_files (int): Number of upcoming files `CoreProcessor` keeps prefetched.
+        logger (Logger, optional): Logger for the files that could not be staged.
+    """
+    def __init__(
+        self,
+        staging_dir: str,
+        quota_gb: float = 50.,
+        max_workers: int = 2,
+        prefetch_files: int = 4,
+        logger: Optional[Logger] = None
+    ) -> None:
+        self.store: DiskLRUCache = DiskLRUCache(staging_dir, int(quota_gb * 1024 ** 3), suffix=".h5")
+        self.prefetch_files: int = prefetch_files
+        self.logger: Logger = logger if logger is not None else setup_logger()
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers, thread_name_prefix="staging")
+        # DiskLRUCache is not thread safe
+        self._lock = threading.Lock()
+        self._pending: dict[str, Future] = {}
+        # key -> number of readers of the copy
+        self._readers: Counter[str] = Counter()
+
+    @property
+    def stats(self) -> CacheStats:
+        return self.store.stats
+
+    @contextmanager
+    def open_local(self, file: str) -> Iterator[str]:
+        """
+        Yield the path of the local copy of `file`, copying it first if needed.
+        The copy is not evicted by this process until the block exits.
+
+        Parameters:
+        - file (str): Raw file in `load_dir`.
+
+        Yields:
+        - str: The local copy, or `file` itself if it could not be staged.
+        """
+        file = os.path.abspath(file)
+        with self._lock:
+            future = self._pending.pop(file, None)
+        if future is not None:
+            # The source is checked again below, in case it changed since the prefetch
+            future.result()
+
+        identity = file_identity(file)
+        key = hash_key(identity)
+        local_file = self._lookup(key, identity)
+        metrics.count("staging.hits" if local_file is not None else "staging.misses")
+        if local_file is None:
+            local_file = self._copy(file, identity, pin=True)
+        if local_file is not None and not os.path.exists(local_file):
+            # Evicted by another process sharing the directory
+            with self._lock:
+                self._unpin(key)
+            local_file = None
+        if local_file is None:
+            yield file
+            return
+        try:
+            yield local_file
+        finally:
+            with self._lock:
+                self._unpin(key)
+
+    def prefetch(self, files: Iterable[str]) -> None:
+        """Copy `files` in the background, skipping the ones already staged or being copied."""
+        for file in files:
+            file = os.path.abspath(file)
+            with self._lock:
+                if file in self._pending:
+                    continue
+                future = self._executor.submit(self._prefetch, file)
+                self._pending[file] = future
+
+    def _prefetch(self, file: str) -> None:
+        try:
+            identity = file_identity(file)
+        except OSError as e:
+            self.logger.warning(f"Could not prefetch '{file}': {type(e).__name__}: {e}")
+            return
+        key = hash_key(identity)
+        with self._lock:
+            staged = key in self.store or self.store.adopt(key) is not None
+        if not staged:
+            self._copy(file, identity)
+
+    def _pin(self, key: str) -> None:
+        """Keep `key` from being evicted, must be called with the lock held."""
+        self._readers[key] += 1
+        self.store.pinned.add(key)
+
+    def _unpin(self, key: str) -> None:
+        """Release a `_pin`, must be called with the lock held."""
+        self._readers[key] -= 1
+        if self._readers[key] <= 0:
+            del self._readers[key]
+            self.store.pinned.discard(key)
+
+    def _lookup(self, key: str, identity: dict[str, Any]) -> Optional[str]:
+        """Return the local copy of `key`, pinned, if it is complete."""
+        with self._lock:
+            if key not in self.store:
+                # Staged by another process sharing the directory
+                self.store.adopt(key)
+            local_file = self.store.lookup(key)
+            if local_file is not None:
+                try:
+                    stat = os.stat(local_file)
+                    complete = stat.st_size == identity["size"] and stat.st_mtime_ns == identity["mtime_ns"]
+                except FileNotFoundError:
+                    complete = False
+                if not complete:
+                    self.store.discard(key)
+                    local_file = None
+            if local_file is not None:
+                self._pin(key)
+        return local_file
+
+    def _copy(self, file: str, identity: dict[str, Any], pin: bool = False) -> Optional[str]:
+        """
+        Copy `file` into the cache and return the copy, or None if it failed or the file changed meanwhile.
+        With `pin`, the copy is pinned before it is committed, so the commit cannot evict it.
+        """
+        key = hash_key(identity)
+        tmp_file = os.path.join(self.store.cache_dir, f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        start = time.perf_counter()
+        try:
+            shutil.copyfile(file, tmp_file)
+            if file_identity(file) != identity or os.path.getsize(tmp_file) != identity["size"]:
+                self.logger.warning(f"'{file}' changed while it was staged, reading it in place")
+                os.remove(tmp_file)
+                return None
+            # The mtime of the copy is checked against the source on lookup
+            os.utime(tmp_file, ns=(identity["mtime_ns"], identity["mtime_ns"]))
+            with self._lock:
+                if pin:
+                    self._pin(key)
+                try:
+                    local_file = self.store.commit(key, tmp_file)
+                except OSError:
+                    if pin:
+                        self._unpin(key)
+                    raise
+        except OSError as e:
+            self.logger.warning(f"Could not stage '{file}', reading it in place: {type(e).__name__}: {e}")
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+            return None
+        metrics.emit("timer", "staging.copy", time.perf_counter() - start, file=file, nbytes=identity["size"])
+        return local_file
+
+    def flush(self) -> None:
+        """Persist access times of the cache index."""
+        with self._lock:
+            self.store.flush()
+
+    def close(self) -> None:
+        """Cancel the prefetches that did not start and wait for the running ones."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self.flush()
+
+
+@lru_cache(maxsize=1)
+def get_staging_cache() -> Optional[StagingCache]:
+    """Return the staging cache of the process, or None if `path.staging_dir` is not set."""
+    config = load_config()
+    if not config.path.staging_dir:
+        return None
+    return StagingCache(config.path.staging_dir, config.path.staging_quota_gb)
+
+
+@contextmanager
+def staged_file(file: str) -> Iterator[str]:
+    """Yield the local copy of a raw file if staging is configured, else the file itself."""
+    staging = get_staging_cache()
+    if staging is None:
+        yield file
+        return
+    with staging.open_local(file) as local_file:
+        yield local_file
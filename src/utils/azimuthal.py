@@ -0,0 +1,237 @@
+"""
+Azimuthal integration with a precomputed sparse pixel to (q, χ) bin matrix.
+
+Every pixel is split into split x split sub-pixels whose q and χ are binned, so a pixel
+contributes to the neighbouring bins in proportion to its area inside them. The weights form
+a CSR matrix of shape (bins, pixels) which integrates a whole stack of frames with one
+sparse-dense product. Masked (bad) pixels get no weight.
+
+Example usage:
+    integrator = AzimuthalIntegrator(get_geometry(), images.shape[-2:], q_bins=500)
+    profiles = integrator.integrate(images)  # (N, 500)
+    processor = CoreProcessor(..., reduction=integrator.as_reduction())
+"""
+import hashlib
+import os
+from collections.abc import Callable, Iterable
+from typing import Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+from scipy import sparse
+
+from src.config.config import load_config
+from src.utils.geometry import DetectorGeometry
+
+
+Reduction = Callable[[dict[str, npt.NDArray]], dict[str, npt.NDArray]]
+
+
+def load_bad_pixel_mask() -> Optional[npt.NDArray[np.bool_]]:
+    """Return the bad pixel mask (True for bad pixels) saved as 'MASK/mask.npy' in the analysis directory."""
+    config = load_config()
+    mask_file = os.path.join(config.path.analysis_dir, "MASK/mask.npy")
+    if not os.path.exists(mask_file):
+        return None
+    return np.load(mask_file).astype(np.bool_)
+
+
+def image_q_range(
+    geometry: DetectorGeometry,
+    shape: tuple[int, int],
+    origin: tuple[int, int] = (0, 0),
+    detector_shape: Optional[tuple[int, int]] = None
+) -> tuple[float, float]:
+    """Return the smallest and largest q covered by an image of `shape` whose first pixel is at detector `origin` (x, y)."""
+    beam_x, beam_y = geometry.beam_center(detector_shape if detector_shape is not None else shape)
+    ys = np.array([0, shape[0] - 1]) + origin[1] - beam_y
+    xs = np.array([0, shape[1] - 1]) + origin[0] - beam_x
+    distances = np.hypot(*np.meshgrid(xs, ys))
+    # The beam center may lie inside the image
+    inside = (ys[0] <= 0 <= ys[1]) and (xs[0] <= 0 <= xs[1])
+    minimum = 0. if inside else np.hypot(max(xs[0], -xs[1], 0), max(ys[0], -ys[1], 0))
+    return float(geometry.q_from_distance(minimum)), float(geometry.q_from_distance(distances.max() + 1))
+
+
+def load_or_build_matrix(file: Optional[str], build: Callable[[], sparse.csr_matrix]) -> sparse.csr_matrix:
+    """Return the sparse matrix stored in `file`, building and storing it first if it does not exist."""
+    if file is None:
+        return build()
+    if os.path.exists(file):
+        return sparse.load_npz(file).tocsr()
+    matrix = build()
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    tmp_file = f"{file}.{os.getpid()}.tmp.npz"
+    sparse.save_npz(tmp_file, matrix)
+    os.replace(tmp_file, file)
+    return matrix
+
+
+class AzimuthalIntegrator:
+    """
+    Integrate detector images onto q, or (χ, q), bins.
+
+    Args:
+        geometry (DetectorGeometry): Detector geometry.
+        shape (tuple[int, int]): Shape (H, W) of the images.
+        q_bins (int | npt.NDArray): Number of q bins over the q range of the images, or bin edges.
+        chi_bins (int | npt.NDArray): Number of azimuthal bins over (-π, π], or bin edges [rad].
+            With 1 the result is a 1D profile.
+        mask (npt.NDArray, optional): Bad pixel mask (H, W), True for pixels to ignore.
+        split (int): Pixels are split into split x split sub-pixels.
+        solid_angle (bool): Correct the intensities by the relative solid angle of each pixel.
+        origin (tuple[int, int]): Detector coordinates (x, y) of the first image pixel, e.g. the crop origin.
+        detector_shape (tuple[int, int], optional): Full detector shape used for the default beam center.
+        cache_dir (str, optional): Directory where the matrix is stored, keyed by all of the above.
+    """
+    def __init__(
+        self,
+        geometry: DetectorGeometry,
+        shape: tuple[int, int],
+        q_bins: Union[int, npt.NDArray] = 500,
+        chi_bins: Union[int, npt.NDArray] = 1,
+        mask: Optional[npt.NDArray] = None,
+        split: int = 4,
+        solid_angle: bool = True,
+        origin: tuple[int, int] = (0, 0),
+        detector_shape: Optional[tuple[int, int]] = None,
+        cache_dir: Optional[str] = None
+    ) -> None:
+        self.geometry: DetectorGeometry = geometry
+        self.shape: tuple[int, int] = tuple(int(v) for v in shape)
+        self.split: int = split
+        self.origin: tuple[int, int] = origin
+        self.detector_shape: tuple[int, int] = tuple(detector_shape) if detector_shape is not None else self.shape
+        self.mask: Optional[npt.NDArray[np.bool_]] = None if mask is None else np.asarray(mask, dtype=np.bool_)
+
+        if np.ndim(q_bins) == 0:
+            q_range = image_q_range(self.geometry, self.shape, self.origin, self.detector_shape)
+            q_bins = np.linspace(q_range[0], q_range[1], int(q_bins) + 1)
+        if np.ndim(chi_bins) == 0:
+            chi_bins = np.linspace(-np.pi, np.pi, int(chi_bins) + 1)
+        self.q_edges: npt.NDArray = np.asarray(q_bins, dtype=np.float64)
+        self.chi_edges: npt.NDArray = np.asarray(chi_bins, dtype=np.float64)
+
+        self.matrix: sparse.csr_matrix = load_or_build_matrix(
+            None if cache_dir is None else os.path.join(cache_dir, "azimuthal", f"{self.key()}.npz"),
+            self.build_matrix
+        )
+        norm = np.asarray(self.matrix.sum(axis=1)).ravel()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self._inverse_norm: npt.NDArray = np.where(norm > 0, 1 / norm, np.nan)
+        if solid_angle:
+            self.matrix = self.matrix @ sparse.diags(1 / self._relative_solid_angle())
+
+    @property
+    def q(self) -> npt.NDArray:
+        """Bin centers in q."""
+        return (self.q_edges[1:] + self.q_edges[:-1]) / 2
+
+    @property
+    def chi(self) -> npt.NDArray:
+        """Bin centers in χ [rad]."""
+        return (self.chi_edges[1:] + self.chi_edges[:-1]) / 2
+
+    @property
+    def output_shape(self) -> tuple[int, ...]:
+        n_chi, n_q = len(self.chi_edges) - 1, len(self.q_edges) - 1
+        return (n_q,) if n_chi == 1 else (n_chi, n_q)
+
+    def _pixel_coordinates(self, rows: npt.NDArray, sub_y: float, sub_x: float) -> tuple[npt.NDArray, npt.NDArray]:
+        """Return (dx, dy) from the beam center in pixels of sub-pixel (sub_y, sub_x) of every pixel in `rows`."""
+        beam_x, beam_y = self.geometry.beam_center(self.detector_shape)
+        dy = (rows[:, np.newaxis] + sub_y + self.origin[1] - beam_y) * np.ones(self.shape[1])
+        dx = np.arange(self.shape[1])[np.newaxis, :] + sub_x + self.origin[0] - beam_x
+        return np.broadcast_to(dx, dy.shape), dy
+
+    def _relative_solid_angle(self) -> npt.NDArray:
+        rows = np.arange(self.shape[0])
+        dx, dy = self._pixel_coordinates(rows, 0., 0.)
+        r = self.geometry.dps * np.hypot(dx, dy)
+        cos_cubed = (self.geometry.sdd / np.sqrt(self.geometry.sdd ** 2 + r ** 2)) ** 3
+        return cos_cubed.ravel()
+
+    def key(self) -> str:
+        """Return a hash identifying the bin matrix."""
+        digest = hashlib.sha256()
+        digest.update(self.geometry.key(self.detector_shape).encode())
+        digest.update(repr((self.shape, self.split, self.origin)).encode())
+        digest.update(self.q_edges.tobytes())
+        digest.update(self.chi_edges.tobytes())
+        if self.mask is not None:
+            digest.update(np.packbits(self.mask).tobytes())
+        return digest.hexdigest()[:16]
+
+    def build_matrix(self, rows_per_chunk: int = 64) -> sparse.csr_matrix:
+        """Build the (bins, pixels) matrix of sub-pixel area weights."""
+        height, width = self.shape
+        n_q, n_chi = len(self.q_edges) - 1, len(self.chi_edges) - 1
+        offsets = (np.arange(self.split) + 0.5) / self.split - 0.5
+        weight = 1 / self.split ** 2
+        valid_pixels = np.ones(height * width, dtype=np.bool_) if self.mask is None else ~self.mask.ravel()
+
+        bin_indices: list[npt.NDArray] = []
+        pixel_indices: list[npt.NDArray] = []
+        for start in range(0, height, rows_per_chunk):
+            rows = np.arange(start, min(start + rows_per_chunk, height))
+            pixels = (rows[:, np.newaxis] * width + np.arange(width)).ravel()
+            for sub_y in offsets:
+                for sub_x in offsets:
+                    dx, dy = self._pixel_coordinates(rows, sub_y, sub_x)
+                    q = self.geometry.q_from_distance(np.hypot(dx, dy)).ravel()
+                    chi = np.arctan2(dy, dx).ravel()
+                    q_index = np.searchsorted(self.q_edges, q, side="right") - 1
+                    chi_index = np.searchsorted(self.chi_edges, chi, side="right") - 1
+                    # The last edge is inclusive like np.histogram
+                    q_index[q == self.q_edges[-1]] = n_q - 1
+                    chi_index[chi == self.chi_edges[-1]] = n_chi - 1
+                    valid = (q_index >= 0) & (q_index < n_q) & (chi_index >= 0) & (chi_index < n_chi) & valid_pixels[pixels]
+                    bin_indices.append(chi_index[valid] * n_q + q_index[valid])
+                    pixel_indices.append(pixels[valid])
+
+        bin_index = np.concatenate(bin_indices)
+        pixel_index = np.concatenate(pixel_indices)
+        # Duplicate (bin, pixel) entries of the sub-pixels are summed
+        return sparse.csr_matrix(
+            (np.full(len(bin_index), weight), (bin_index, pixel_index)),
+            shape=(n_q * n_chi, height * width)
+        )
+
+    def integrate(self, images: npt.NDArray) -> npt.NDArray:
+        """
+        Return the mean intensity of every bin for every image.
+
+        Parameters:
+            images (npt.NDArray): Images of shape (..., H, W).
+
+        Returns:
+            npt.NDArray: Shape (..., n_q), or (..., n_chi, n_q) with azimuthal bins. Empty bins are NaN.
+        """
+        images = np.asarray(images)
+        if images.shape[-2:] != self.shape:
+            raise ValueError(f"Expected images of shape (..., {self.shape[0]}, {self.shape[1]}), got {images.shape}")
+        leading = images.shape[:-2]
+        flat = images.reshape(-1, self.shape[0] * self.shape[1]).astype(np.float64, copy=False)
+        sums = self.matrix @ flat.T
+        return (sums * self._inverse_norm[:, np.newaxis]).T.reshape(leading + self.output_shape)
+
+    def as_reduction(self, keys: Iterable[str] = ("poff", "pon"), keep_images: bool = False) -> Reduction:
+        """
+        Return a `CoreProcessor` reduction replacing image stacks by their integrated profiles.
+
+        Each stack `key` becomes '{key}_azimuthal' and the bin centers are stored as
+        'q' (and 'chi'). Without `keep_images` the stacks themselves are dropped.
+        """
+        keys = tuple(keys)
+
+        def azimuthal_reduction(data: dict[str, npt.NDArray]) -> dict[str, npt.NDArray]:
+            reduced = {key: val for key, val in data.items() if keep_images or key not in keys}
+            for key in keys:
+                if key in data:
+                    reduced[f"{key}_azimuthal"] = self.integrate(data[key])
+            reduced["q"] = self.q
+            if len(self.output_shape) == 2:
+                reduced["chi"] = self.chi
+            return reduced
+
+        return azimuthal_reduction
@@ -0,0 +1,301 @@
+"""
+Persistent catalog of the raw data tree 'run=XXX/scan=XXX/pXXXX.h5'.
+
+Walking the tree on the network share takes seconds to minutes, so runs, scans and files
+(with size and mtime) are kept in a SQLite database. `refresh` only lists the directories
+whose mtime changed since the last refresh, and stats the scan directories in parallel.
+Queries are then answered from the database. A catalog can be shared between threads.
+
+Adding or removing a file changes the mtime of its scan directory, but growing a file does not;
+use `refresh(full=True)` to update the sizes of files still being written.
+
+Example usage:
+    catalog = get_catalog()
+    catalog.refresh()
+    scan_nums = catalog.scans(run_n)
+    missing = catalog.missing_file_nums(run_n, scan_n)
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Iterable, Optional
+
+from src.config.config import load_config
+
+
+RUN_PATTERN = re.compile(r"run=(\d+)")
+SCAN_PATTERN = re.compile(r"scan=(\d+)")
+FILE_PATTERN = re.compile(r"p(\d+)\.h5")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scans (
+    run INTEGER NOT NULL,
+    scan INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (run, scan)
+);
+CREATE TABLE IF NOT EXISTS files (
+    run INTEGER NOT NULL,
+    scan INTEGER NOT NULL,
+    file_num INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    cataloged_at REAL NOT NULL,
+    PRIMARY KEY (run, scan, file_num)
+);
+CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime_ns);
+"""
+
+
+@dataclass(frozen=True)
+class FileRecord:
+    """A cataloged raw data file."""
+    run: int
+    scan: int
+    file_num: int
+    path: str
+    size: int
+    mtime_ns: int
+
+
+def _numbered_entries(directory: str, pattern: re.Pattern, is_dir: bool) -> dict[int, os.DirEntry]:
+    """Return the entries of `directory` whose whole name matches `pattern`, by their number."""
+    entries: dict[int, os.DirEntry] = {}
+    with os.scandir(directory) as iterator:
+        for entry in iterator:
+            match = pattern.fullmatch(entry.name)
+            if match is None:
+                continue
+            if (entry.is_dir() if is_dir else entry.is_file()):
+                entries[int(match.group(1))] = entry
+    return entries
+
+
+def _list_scan(path: str, stored_mtime_ns: Optional[int]) -> Optional[tuple[int, list[tuple[int, str, int, int]]]]:
+    """
+    Return the mtime and the (file_num, name, size, mtime_ns) of the files of a scan directory,
+    or None if its mtime is still `stored_mtime_ns`.
+    """
+    # Stat before listing, files added meanwhile change the mtime again and are picked up next time
+    mtime_ns = os.stat(path).st_mtime_ns
+    if mtime_ns == stored_mtime_ns:
+        return None
+    files = []
+    for file_num, entry in _numbered_entries(path, FILE_PATTERN, is_dir=False).items():
+        stat = entry.stat()
+        files.append((file_num, entry.name, stat.st_size, stat.st_mtime_ns))
+    return mtime_ns, files
+
+
+class RawDataCatalog:
+    """
+    SQLite backed catalog of a raw data directory.
+
+    Args:
+        root_dir (str): Directory holding the 'run=XXX' directories.
+        db_file (str, optional): Database file. Defaults to 'catalog/{hash of root_dir}.sqlite'
+            in the configured cache directory.
+        max_workers (int): Number of threads listing scan directories.
+    """
+    def __init__(self, root_dir: str, db_file: Optional[str] = None, max_workers: int = 16) -> None:
+        self.root_dir: str = os.path.abspath(root_dir)
+        if db_file is None:
+            root_hash = hashlib.sha256(self.root_dir.encode("utf-8")).hexdigest()[:16]
+            db_file = os.path.join(load_config().path.cache_dir, "catalog", f"{root_hash}.sqlite")
+        os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+        self.db_file: str = db_file
+        self.max_workers: int = max_workers
+
+        # One connection shared by the threads of the process, serialized by the lock
+        self._lock = threading.RLock()
+        # Other processes may hold the database while they refresh it
+        self._connection: sqlite3.Connection = sqlite3.connect(db_file, timeout=30., check_same_thread=False)
+        # The cache directory may be on a network share, where the shared memory of WAL is unsafe.
+        # The journal mode is stored in the file, so databases created in WAL mode are switched back
+        self._connection.execute("PRAGMA journal_mode=DELETE")
+        self._connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self) -> "RawDataCatalog":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def refresh(self, runs: Optional[Iterable[int]] = None, full: bool = False) -> int:
+        """
+        Bring the catalog up to date with the directory tree.
+
+        Parameters:
+        - runs (Iterable[int], optional): Only refresh these runs. Defaults to all runs.
+        - full (bool): Re-list every directory even if its mtime did not change.
+
+        Returns:
+        - int: Number of scan directories that were listed.
+        """
+        wanted = None if runs is None else set(runs)
+        run_entries = _numbered_entries(self.root_dir, RUN_PATTERN, is_dir=True)
+        if wanted is not None:
+            run_entries = {run: entry for run, entry in run_entries.items() if run in wanted}
+
+        with self._lock:
+            stored_runs = dict(self._connection.execute("SELECT run, mtime_ns FROM runs"))
+            stored_scans: dict[tuple[int, int], tuple[str, int]] = {
+                (run, scan): (name, mtime_ns)
+                for run, scan, name, mtime_ns in self._connection.execute("SELECT run, scan, name, mtime_ns FROM scans")
+            }
+
+        removed_runs = [run for run in stored_runs if run not in run_entries and (wanted is None or run in wanted)]
+        run_updates: list[tuple[int, str, int]] = []
+        scan_dirs: dict[tuple[int, int], tuple[str, str]] = {}
+        relisted_runs: list[int] = []
+        for run, run_entry in run_entries.items():
+            run_mtime_ns = run_entry.stat().st_mtime_ns
+            if full or stored_runs.get(run) != run_mtime_ns:
+                # Scan directories were added or removed
+                relisted_runs.append(run)
+                run_updates.append((run, run_entry.name, run_mtime_ns))
+                for scan, scan_entry in _numbered_entries(run_entry.path, SCAN_PATTERN, is_dir=True).items():
+                    scan_dirs[(run, scan)] = (scan_entry.name, scan_entry.path)
+            else:
+                for (stored_run, scan), (name, _) in stored_scans.items():
+                    if stored_run == run:
+                        scan_dirs[(run, scan)] = (name, os.path.join(run_entry.path, name))
+
+        keys = list(scan_dirs)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            listings = list(executor.map(
+                lambda key: _list_scan(scan_dirs[key][1], None if full else stored_scans.get(key, (None, None))[1]),
+                keys
+            ))
+
+        now = time.time()
+        with self._lock, self._connection:
+            for run in removed_runs:
+                for table in ("files", "scans", "runs"):
+                    self._connection.execute(f"DELETE FROM {table} WHERE run = ?", (run,))
+            for run in relisted_runs:
+                for (stored_run, scan) in stored_scans:
+                    if stored_run == run and (run, scan) not in scan_dirs:
+                        self._connection.execute("DELETE FROM files WHERE run = ? AND scan = ?", (run, scan))
+                        self._connection.execute("DELETE FROM scans WHERE run = ? AND scan = ?", (run, scan))
+            self._connection.executemany(
+                "INSERT INTO runs VALUES (?, ?, ?) ON CONFLICT (run) DO UPDATE SET name = excluded.name, mtime_ns = excluded.mtime_ns",
+                run_updates
+            )
+
+            listed = 0
+            for (run, scan), listing in zip(keys, listings):
+                if listing is None:
+                    continue
+                listed += 1
+                mtime_ns, files = listing
+                self._connection.execute(
+                    "INSERT INTO scans VALUES (?, ?, ?, ?) ON CONFLICT (run, scan) DO UPDATE SET mtime_ns = excluded.mtime_ns",
+                    (run, scan, scan_dirs[(run, scan)][0], mtime_ns)
+                )
+                file_nums = [file_num for file_num, *_ in files]
+                self._connection.execute(
+                    f"DELETE FROM files WHERE run = ? AND scan = ? AND file_num NOT IN ({','.join('?' * len(file_nums))})",
+                    (run, scan, *file_nums)
+                )
+                self._connection.executemany(
+                    "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (run, scan, file_num) "
+                    "DO UPDATE SET name = excluded.name, size = excluded.size, mtime_ns = excluded.mtime_ns",
+                    [(run, scan, file_num, name, size, file_mtime_ns, now) for file_num, name, size, file_mtime_ns in files]
+                )
+        return listed
+
+    def runs(self) -> list[int]:
+        """Return the cataloged run numbers."""
+        with self._lock:
+            return [run for run, in self._connection.execute("SELECT run FROM runs ORDER BY run")]
+
+    def scans(self, run: int) -> list[int]:
+        """Return the cataloged scan numbers of `run`."""
+        with self._lock:
+            return [scan for scan, in self._connection.execute("SELECT scan FROM scans WHERE run = ? ORDER BY scan", (run,))]
+
+    def file_nums(self, run: int, scan: int) -> list[int]:
+        """Return the cataloged file numbers of a scan."""
+        with self._lock:
+            return [
+                file_num for file_num, in
+                self._connection.execute("SELECT file_num FROM files WHERE run = ? AND scan = ? ORDER BY file_num", (run, scan))
+            ]
+
+    def files(self, run: int, scan: int) -> list[FileRecord]:
+        """Return the cataloged files of a scan ordered by file number."""
+        return self._records("WHERE f.run = ? AND f.scan = ? ORDER BY f.file_num", (run, scan))
+
+    def missing_file_nums(self, run: int, scan: int) -> list[int]:
+        """Return the file numbers between 1 and the last file of a scan that do not exist."""
+        present = self.file_nums(run, scan)
+        if not present:
+            return []
+        return sorted(set(range(1, present[-1] + 1)) - set(present))
+
+    def new_files(self, since: float) -> list[FileRecord]:
+        """Return the files modified after `since` (seconds since the epoch), oldest first."""
+        return self._records("WHERE f.mtime_ns > ? ORDER BY f.mtime_ns", (int(since * 1e9),))
+
+    def status(self) -> dict[str, tuple[int, list[int]]]:
+        """Return the last file number and the missing file numbers of every scan by 'run=XXX_scan=XXX'."""
+        status: dict[str, tuple[int, list[int]]] = {}
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT r.name, s.name, s.run, s.scan, MAX(f.file_num) FROM scans s "
+                "JOIN runs r ON r.run = s.run JOIN files f ON f.run = s.run AND f.scan = s.scan "
+                "GROUP BY s.run, s.scan ORDER BY s.run, s.scan"
+            ).fetchall()
+        for run_name, scan_name, run, scan, max_num in rows:
+            status[f"{run_name}_{scan_name}"] = (max_num, self.missing_file_nums(run, scan))
+        return status
+
+    def __contains__(self, item: tuple[int, int, int]) -> bool:
+        run, scan, file_num = item
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM files WHERE run = ? AND scan = ? AND file_num = ?", (run, scan, file_num)
+            ).fetchone()
+        return row is not None
+
+    def _records(self, condition: str, params: tuple) -> list[FileRecord]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT f.run, f.scan, f.file_num, r.name, s.name, f.name, f.size, f.mtime_ns FROM files f "
+                "JOIN scans s ON s.run = f.run AND s.scan = f.scan JOIN runs r ON r.run = f.run " + condition,
+                params
+            ).fetchall()
+        return [
+            FileRecord(run, scan, file_num, os.path.join(self.root_dir, run_name, scan_name, name), size, mtime_ns)
+            for run, scan, file_num, run_name, scan_name, name, size, mtime_ns in rows
+        ]
+
+
+def get_catalog() -> RawDataCatalog:
+    """Return the catalog of the configured raw data directory, shared by the threads of the process."""
+    config = load_config()
+    return _get_catalog(config.path.load_dir, config.path.cache_dir)
+
+
+@lru_cache(maxsize=4)
+def _get_catalog(load_dir: str, cache_dir: str) -> RawDataCatalog:  # pylint: disable=unused-argument
+    # `cache_dir` is part of the cache key, since the database is stored there
+    return RawDataCatalog(load_dir)
@@ -1,27 +1,22 @@
 from pathlib import Path
+from typing import Optional
+
+from src.utils.catalog import RawDataCatalog
 
 
 class StorageHandler:
-    def __init__(self, root_dir: str):
+    def __init__(self, root_dir: str, catalog: Optional[RawDataCatalog] = None):
         self.root_dir: Path = Path(root_dir)
+        self.catalog: RawDataCatalog = catalog if catalog is not None else RawDataCatalog(root_dir)
         self.dirs: dict[int, dict[int, set[int]]] = self._parse_directory_structure()
 
     def _parse_directory_structure(self) -> dict[int, dict[int, set[int]]]:
-        """walk through root get structure of storage"""
-        dirs: dict[int, dict[int, set[int]]] = {}
-        for run_dir in self.root_dir.glob("run=[0-9][0-9][0-9]"):
-            run_id: int = int(run_dir.name.split("=")[1])
-            dirs[run_id] = {}
-
-            for scan_dir in run_dir.glob("scan=[0-9][0-9][0-9]"):
-                scan_id: int = int(scan_dir.name.split("=")[1])
-                dirs[run_id][scan_id] = set()
-
-                for p_dir in scan_dir.glob("p[0-9][0-9][0-9][0-9].h5"):
-                    p_id: int = int(p_dir.stem[1:])
-                    dirs[run_id][scan_id].add(p_id)
-
-        return dirs
+        """Refresh the catalog of root and get structure of storage"""
+        self.catalog.refresh()
+        return {
+            run_id: {scan_id: set(self.catalog.file_nums(run_id, scan_id)) for scan_id in self.catalog.scans(run_id)}
+            for run_id in self.catalog.runs()
+        }
 
     def __contains__(self, item: tuple[int, int, int]) -> bool:
         run_id, scan_id, p_id = item
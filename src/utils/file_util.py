@@ -3,9 +3,7 @@ import json
 from typing import Optional
 
 from roi_rectangle import RoiRectangle
-import numpy as np
 import numpy.typing as npt
-import scipy.io
 
 from src.config.config import load_config
 
@@ -22,7 +20,8 @@ def get_file_list(mother: str = ".") -> list[str]:
         list: A list of filenames in the specified directory.
     """
 
-    files = [file for file in os.listdir(mother) if os.path.isfile(os.path.join(mother, file))]
+    with os.scandir(mother) as entries:
+        files = [entry.name for entry in entries if entry.is_file()]
     return files
 
 
@@ -37,7 +36,8 @@ def get_folder_list(mother: str = ".") -> list[str]:
     Returns:
         list: A list of folder names in the specified directory.
     """
-    folders = [folder for folder in os.listdir(mother) if os.path.isdir(os.path.join(mother, folder))]
+    with os.scandir(mother) as entries:
+        folders = [entry.name for entry in entries if entry.is_dir()]
     return folders
 
 
@@ -194,9 +194,21 @@ def save_sigma_factor(mother: str, sig_fac: float) -> None:
         f.write(str(sig_fac))
 
 
-def mat_to_ndarray(run: int, scan: int) -> npt.NDArray:
+def mat_to_ndarray(run: int, scan: int, key: str, comment: str = "") -> npt.NDArray:
+    """
+    Read an image stack of the mat file written by `MatSaverStrategy` for a scan.
+
+    Parameters:
+    - run (int), scan (int): The scan.
+    - key (str): Variable to read, e.g. 'poff'.
+    - comment (str): Comment appended to the file name when it was saved.
+
+    Returns:
+    - npt.NDArray: The images as (N, H, W).
+    """
+    from src.analyzer.loader import MatLoader
+    from src.processor.saver import get_file_base_name
+
     config = load_config()
-    path = os.path.join(config.path.mat_dir, f'run={run:0>3d}_scan={scan}.mat')
-    mat_data = scipy.io.loadmat(path)
-    images = mat_data["data"]
-    return np.transpose(images, axes=range(images.ndim)[::-1])
+    path = os.path.join(config.path.mat_dir, f"{get_file_base_name(run, scan)}{comment}.mat")
+    return MatLoader(path, key).images
@@ -0,0 +1,249 @@
+"""
+Fluctuation X-ray scattering (FXS): per-shot angular cross-correlations.
+
+Averaging shots destroys the angular structure of the speckle, so the correlations are
+reduced shot by shot while the frames of a file are still in memory:
+    1. every shot is remapped onto a polar (q, φ) grid with a precomputed sparse bilinear
+       interpolation matrix; samples touching masked or outside pixels are invalid,
+    2. the ring fluctuations δI(q, φ) = I(q, φ) - <I(q)>_φ are autocorrelated along φ with
+       real FFTs: C(q, Δφ) = IFFT(|FFT(δI · M)|²) / IFFT(|FFT(M)|²), M being the valid mask,
+    3. C and <I(q)>_φ are summed over the shots of the file.
+
+The sums are stacked per file (one delay) and pump state by `CoreProcessor`, so files and
+scans can be merged by adding sums and shot counts. `AngularCorrelator.as_reduction` turns
+them into the normalized mean C(q, Δφ) / <I(q)>².
+
+Example usage:
+    correlator = AngularCorrelator(PolarRemapper(get_geometry(), detector_shape, q_bins=100))
+    processor = CoreProcessor(
+        ..., shot_stages={"fxs": correlator.as_shot_stage()}, reduction=correlator.as_reduction()
+    )
+"""
+import hashlib
+import os
+from collections.abc import Callable, Iterable
+from typing import Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+from scipy import fft, sparse
+
+from src.utils.azimuthal import Reduction, image_q_range, load_or_build_matrix
+from src.utils.geometry import DetectorGeometry
+
+
+ShotStage = Callable[[npt.NDArray], dict[str, npt.NDArray]]
+
+
+class PolarRemapper:
+    """
+    Remap detector images onto a polar (q, φ) grid.
+
+    Args:
+        geometry (DetectorGeometry): Detector geometry.
+        shape (tuple[int, int]): Shape (H, W) of the images.
+        q_bins (int | npt.NDArray): Number of rings over the q range of the images, or the ring q values.
+        phi_bins (int): Number of azimuthal samples over [0, 2π).
+        mask (npt.NDArray, optional): Bad pixel mask (H, W), True for pixels to ignore.
+        origin (tuple[int, int]): Detector coordinates (x, y) of the first image pixel, e.g. the crop origin.
+        detector_shape (tuple[int, int], optional): Full detector shape used for the default beam center.
+        cache_dir (str, optional): Directory where the matrix is stored, keyed by all of the above.
+    """
+    def __init__(
+        self,
+        geometry: DetectorGeometry,
+        shape: tuple[int, int],
+        q_bins: Union[int, npt.NDArray] = 100,
+        phi_bins: int = 360,
+        mask: Optional[npt.NDArray] = None,
+        origin: tuple[int, int] = (0, 0),
+        detector_shape: Optional[tuple[int, int]] = None,
+        cache_dir: Optional[str] = None
+    ) -> None:
+        self.geometry: DetectorGeometry = geometry
+        self.shape: tuple[int, int] = tuple(int(v) for v in shape)
+        self.origin: tuple[int, int] = origin
+        self.detector_shape: tuple[int, int] = tuple(detector_shape) if detector_shape is not None else self.shape
+        self.mask: Optional[npt.NDArray[np.bool_]] = None if mask is None else np.asarray(mask, dtype=np.bool_)
+
+        if np.ndim(q_bins) == 0:
+            q_min, q_max = image_q_range(self.geometry, self.shape, self.origin, self.detector_shape)
+            edges = np.linspace(q_min, q_max, int(q_bins) + 1)
+            q_bins = (edges[1:] + edges[:-1]) / 2
+        self.q: npt.NDArray = np.asarray(q_bins, dtype=np.float64)
+        self.phi: npt.NDArray = 2 * np.pi * np.arange(phi_bins) / phi_bins
+
+        self.matrix: sparse.csr_matrix = load_or_build_matrix(
+            None if cache_dir is None else os.path.join(cache_dir, "polar", f"{self.key()}.npz"),
+            self.build_matrix
+        )
+        # Interpolated samples have weights summing to one, invalid samples have none
+        self.valid: npt.NDArray[np.bool_] = (np.asarray(self.matrix.sum(axis=1)).ravel() > 0.5).reshape(self.output_shape)
+
+    def __repr__(self) -> str:
+        return f"PolarRemapper(key={self.key()})"
+
+    @property
+    def output_shape(self) -> tuple[int, int]:
+        return len(self.q), len(self.phi)
+
+    def key(self) -> str:
+        """Return a hash identifying the interpolation matrix."""
+        digest = hashlib.sha256()
+        digest.update(self.geometry.key(self.detector_shape).encode())
+        digest.update(repr((self.shape, self.origin)).encode())
+        digest.update(self.q.tobytes())
+        digest.update(self.phi.tobytes())
+        if self.mask is not None:
+            digest.update(np.packbits(self.mask).tobytes())
+        return digest.hexdigest()[:16]
+
+    def build_matrix(self) -> sparse.csr_matrix:
+        """Build the (q * φ, pixels) matrix of bilinear interpolation weights."""
+        height, width = self.shape
+        beam_x, beam_y = self.geometry.beam_center(self.detector_shape)
+        radius = self.geometry.distance_from_q(self.q)[:, np.newaxis]
+        x = (beam_x - self.origin[0] + radius * np.cos(self.phi)).ravel()
+        y = (beam_y - self.origin[1] + radius * np.sin(self.phi)).ravel()
+        x0, y0 = np.floor(x).astype(np.int64), np.floor(y).astype(np.int64)
+        fx, fy = x - x0, y - y0
+
+        corners = [
+            (y0, x0, (1 - fy) * (1 - fx)),
+            (y0, x0 + 1, (1 - fy) * fx),
+            (y0 + 1, x0, fy * (1 - fx)),
+            (y0 + 1, x0 + 1, fy * fx),
+        ]
+        # A sample is valid when all four neighbours are inside the image and unmasked
+        valid = (x0 >= 0) & (x0 + 1 < width) & (y0 >= 0) & (y0 + 1 < height)
+        if self.mask is not None:
+            for rows, cols, _ in corners:
+                valid &= ~self.mask[np.clip(rows, 0, height - 1), np.clip(cols, 0, width - 1)]
+
+        samples = np.flatnonzero(valid)
+        sample_index = np.tile(samples, 4)
+        pixel_index = np.concatenate([rows[samples] * width + cols[samples] for rows, cols, _ in corners])
+        weights = np.concatenate([weight[samples] for _, _, weight in corners])
+        return sparse.csr_matrix(
+            (weights, (sample_index, pixel_index)),
+            shape=(len(self.q) * len(self.phi), height * width)
+        )
+
+    def remap(self, images: npt.NDArray) -> npt.NDArray:
+        """
+        Interpolate images onto the polar grid.
+
+        Parameters:
+            images (npt.NDArray): Images of shape (..., H, W).
+
+        Returns:
+            npt.NDArray: Shape (..., n_q, n_φ). Invalid samples are 0, see `valid`.
+        """
+        images = np.asarray(images)
+        if images.shape[-2:] != self.shape:
+            raise ValueError(f"Expected images of shape (..., {self.shape[0]}, {self.shape[1]}), got {images.shape}")
+        leading = images.shape[:-2]
+        flat = images.reshape(-1, self.shape[0] * self.shape[1]).astype(np.float64, copy=False)
+        return (self.matrix @ flat.T).T.reshape(leading + self.output_shape)
+
+
+class AngularCorrelator:
+    """
+    Accumulate the angular autocorrelations C(q, Δφ) of single shots.
+
+    Args:
+        remapper (PolarRemapper): Polar grid of the shots.
+        batch_size (int): Number of shots remapped and transformed at once.
+    """
+    def __init__(self, remapper: PolarRemapper, batch_size: int = 32) -> None:
+        self.remapper: PolarRemapper = remapper
+        self.batch_size: int = batch_size
+
+        n_phi = len(remapper.phi)
+        self._valid: npt.NDArray = remapper.valid.astype(np.float64)
+        self._ring_counts: npt.NDArray = self._valid.sum(axis=-1)
+        # Number of valid sample pairs at every Δφ, shared by all shots
+        pair_counts = np.rint(fft.irfft(np.abs(fft.rfft(self._valid, axis=-1)) ** 2, n=n_phi, axis=-1))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self._inverse_pair_counts: npt.NDArray = np.where(pair_counts > 0, 1 / pair_counts, np.nan)
+
+    def __repr__(self) -> str:
+        return f"AngularCorrelator(remapper={self.remapper!r})"
+
+    @property
+    def q(self) -> npt.NDArray:
+        return self.remapper.q
+
+    @property
+    def delta_phi(self) -> npt.NDArray:
+        """Angular lags Δφ [rad] of the correlations."""
+        return self.remapper.phi
+
+    def correlate(self, images: npt.NDArray) -> tuple[npt.NDArray, npt.NDArray]:
+        """
+        Compute the angular autocorrelation of every shot.
+
+        Parameters:
+            images (npt.NDArray): Shots (N, H, W).
+
+        Returns:
+            tuple[npt.NDArray, npt.NDArray]: C(q, Δφ) of shape (N, n_q, n_φ), NaN where no sample
+            pair exists, and the ring mean intensities <I(q)>_φ of shape (N, n_q).
+        """
+        polar = self.remapper.remap(images)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ring_means = polar.sum(axis=-1) / self._ring_counts
+        fluctuations = (polar - np.nan_to_num(ring_means)[..., np.newaxis]) * self._valid
+        spectrum = fft.rfft(fluctuations, axis=-1, workers=-1)
+        correlation = fft.irfft(spectrum.real ** 2 + spectrum.imag ** 2, n=len(self.delta_phi), axis=-1, workers=-1)
+        return correlation * self._inverse_pair_counts, ring_means
+
+    def accumulate(self, images: npt.NDArray) -> dict[str, npt.NDArray]:
+        """
+        Sum the correlations of a stack of shots in batches of `batch_size`.
+
+        Returns:
+            dict[str, npt.NDArray]: 'correlation_sum' (n_q, n_φ), 'intensity_sum' (n_q,) and 'shots'.
+        """
+        correlation_sum = np.zeros(self.remapper.output_shape)
+        intensity_sum = np.zeros(len(self.q))
+        for start in range(0, len(images), self.batch_size):
+            correlation, ring_means = self.correlate(images[start:start + self.batch_size])
+            correlation_sum += correlation.sum(axis=0)
+            intensity_sum += ring_means.sum(axis=0)
+        return {
+            "correlation_sum": correlation_sum,
+            "intensity_sum": intensity_sum,
+            "shots": np.int64(len(images)),
+        }
+
+    def as_shot_stage(self) -> ShotStage:
+        """Return a `CoreProcessor` shot stage reducing the shots of every file to correlation sums."""
+        return self.accumulate
+
+    def as_reduction(self, name: str = "fxs", keys: Iterable[str] = ("poff", "pon")) -> Reduction:
+        """
+        Return a `CoreProcessor` reduction adding the mean normalized correlations.
+
+        The sums of the shot stage `name` of every pump state `key` give
+        '{key}_{name}_correlation' = <C(q, Δφ)> / <I(q)>² of shape (N_files, n_q, n_φ);
+        the grid is stored as '{name}_q' and '{name}_delta_phi'.
+        """
+        keys = tuple(keys)
+
+        def correlation_reduction(data: dict[str, npt.NDArray]) -> dict[str, npt.NDArray]:
+            reduced = dict(data)
+            for key in keys:
+                prefix = f"{key}_{name}"
+                if f"{prefix}_shots" not in data:
+                    continue
+                shots = data[f"{prefix}_shots"].astype(np.float64)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    correlation = data[f"{prefix}_correlation_sum"] / shots[:, np.newaxis, np.newaxis]
+                    intensity = data[f"{prefix}_intensity_sum"] / shots[:, np.newaxis]
+                    reduced[f"{prefix}_correlation"] = correlation / intensity[..., np.newaxis] ** 2
+            reduced[f"{name}_q"] = self.q
+            reduced[f"{name}_delta_phi"] = self.delta_phi
+            return reduced
+
+        return correlation_reduction
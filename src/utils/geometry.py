@@ -0,0 +1,146 @@
+"""
+Detector geometry and per-pixel scattering maps.
+
+`DetectorGeometry` is built once from `ExpParams` (sdd, dps, wavelength and beam center).
+It converts pixel distances to exact scattering angles and momentum transfers, and
+precomputes per-pixel 2θ, q, azimuth χ and solid angle maps which are cached in memory and
+on disk keyed by the geometry, so later conversions are lookups.
+
+The detector is flat and perpendicular to the beam, which hits it at (beam_x, beam_y):
+    r = dps * sqrt((x - beam_x)^2 + (y - beam_y)^2)
+    2θ = arctan(r / sdd)
+    q = 4π / λ * sin(θ)
+    χ = arctan2(y - beam_y, x - beam_x)
+    Ω = dps^2 * sdd / (sdd^2 + r^2)^(3/2)
+
+Example usage:
+    geometry = get_geometry()
+    maps = geometry.get_maps(images.shape[-2:], config.path.cache_dir)
+    q_of_pixels = maps.q
+"""
+import hashlib
+import os
+from dataclasses import dataclass, asdict, fields
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from src.config.config import load_config
+from src.config.config_definitions import ExpParams
+
+
+@dataclass(frozen=True)
+class GeometryMaps:
+    """Per-pixel maps (H, W) of a detector geometry."""
+    two_theta: npt.NDArray
+    q: npt.NDArray
+    chi: npt.NDArray
+    solid_angle: npt.NDArray
+
+
+@dataclass(frozen=True)
+class DetectorGeometry:
+    """
+    Geometry of a flat detector perpendicular to the beam.
+
+    Attributes:
+        sdd (float): Sample to detector distance [m].
+        dps (float): Detector pixel size [m].
+        wavelength (float): X-ray wavelength [Å]. q is in 1/Å.
+        beam_x (float, optional): Beam center column [pixel]. Defaults to the detector center.
+        beam_y (float, optional): Beam center row [pixel]. Defaults to the detector center.
+    """
+    sdd: float
+    dps: float
+    wavelength: float
+    beam_x: Optional[float] = None
+    beam_y: Optional[float] = None
+
+    @classmethod
+    def from_params(cls, params: ExpParams) -> "DetectorGeometry":
+        return cls(params.sdd, params.dps, params.wavelength, params.beam_x, params.beam_y)
+
+    @property
+    def k(self) -> float:
+        """4π / λ"""
+        return 4 * np.pi / self.wavelength
+
+    def key(self, shape: Optional[tuple[int, int]] = None) -> str:
+        """Return a hash identifying the geometry (and detector shape)."""
+        text = repr(sorted(asdict(self).items())) + repr(shape)
+        return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+    def two_theta_from_distance(self, pixels: npt.NDArray) -> npt.NDArray:
+        """Return the exact scattering angle 2θ [rad] at `pixels` pixels from the beam center."""
+        return np.arctan2(np.asarray(pixels, dtype=np.float64) * self.dps, self.sdd)
+
+    def q_from_distance(self, pixels: npt.NDArray) -> npt.NDArray:
+        """Return the exact momentum transfer q at `pixels` pixels from the beam center."""
+        return np.sign(pixels) * self.k * np.sin(self.two_theta_from_distance(np.abs(pixels)) / 2)
+
+    def distance_from_q(self, q: npt.NDArray) -> npt.NDArray:
+        """Return the distance from the beam center in pixels at which `q` is scattered, the inverse of `q_from_distance`."""
+        two_theta = 2 * np.arcsin(np.clip(np.abs(np.asarray(q, dtype=np.float64)) / self.k, 0, 1))
+        return np.sign(q) * self.sdd * np.tan(two_theta) / self.dps
+
+    @property
+    def q_per_pixel(self) -> float:
+        """Momentum transfer of a displacement of one pixel from the beam center."""
+        return float(self.q_from_distance(1.))
+
+    def beam_center(self, shape: tuple[int, int]) -> tuple[float, float]:
+        """Return (beam_x, beam_y), the detector center where unset."""
+        height, width = shape
+        beam_x = self.beam_x if self.beam_x is not None else (width - 1) / 2
+        beam_y = self.beam_y if self.beam_y is not None else (height - 1) / 2
+        return beam_x, beam_y
+
+    def compute_maps(self, shape: tuple[int, int]) -> GeometryMaps:
+        """Compute the per-pixel maps of a detector of `shape` (H, W)."""
+        beam_x, beam_y = self.beam_center(shape)
+        y, x = np.mgrid[:shape[0], :shape[1]]
+        dx, dy = x - beam_x, y - beam_y
+        r = self.dps * np.hypot(dx, dy)
+        two_theta = np.arctan2(r, self.sdd)
+        return GeometryMaps(
+            two_theta=two_theta,
+            q=self.k * np.sin(two_theta / 2),
+            chi=np.arctan2(dy, dx),
+            solid_angle=self.dps ** 2 * self.sdd / (self.sdd ** 2 + r ** 2) ** 1.5,
+        )
+
+    def get_maps(self, shape: tuple[int, int], cache_dir: Optional[str] = None) -> GeometryMaps:
+        """
+        Return the per-pixel maps of a detector of `shape` (H, W).
+
+        Maps are kept in memory and, if `cache_dir` is given, in
+        '{cache_dir}/geometry/{key}.npz' so they are computed once per geometry.
+        """
+        return _get_maps(self, tuple(int(v) for v in shape), cache_dir)
+
+
+@lru_cache(maxsize=8)
+def _get_maps(geometry: DetectorGeometry, shape: tuple[int, int], cache_dir: Optional[str]) -> GeometryMaps:
+    if cache_dir is None:
+        return geometry.compute_maps(shape)
+
+    file = os.path.join(cache_dir, "geometry", f"{geometry.key(shape)}.npz")
+    if os.path.exists(file):
+        with np.load(file) as data:
+            return GeometryMaps(**{key: data[key] for key in data.files})
+
+    maps = geometry.compute_maps(shape)
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    tmp_file = f"{file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        np.savez(f, **{field.name: getattr(maps, field.name) for field in fields(maps)})
+    os.replace(tmp_file, file)
+    return maps
+
+
+@lru_cache(maxsize=1)
+def get_geometry() -> DetectorGeometry:
+    """Return the geometry of the configured experiment."""
+    return DetectorGeometry.from_params(load_config().param)
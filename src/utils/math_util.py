@@ -1,10 +1,10 @@
-from typing import Final
+from typing import Final, Optional
 
 import numpy as np
 import numpy.typing as npt
 from scipy.integrate import quad, dblquad
 
-from src.config.config import load_config
+from src.utils.geometry import DetectorGeometry, get_geometry
 
 
 FWHM_COEFFICIENT: Final[float] = 2.35482  # FWHM_COEFFICIENT = 2 * np.sqrt(2 * np.log(2))
@@ -84,33 +84,45 @@ def integrate_fwhm_2d(
     return result
 
 
-def pixel_to_del_q(pixels: npt.NDArray) -> npt.NDArray:
+def pixel_to_del_q(pixels: npt.NDArray, geometry: Optional[DetectorGeometry] = None) -> npt.NDArray:
+    """
+    Convert pixel positions to the momentum transfer of their displacement from the first one.
+
+    Parameters:
+        pixels (npt.NDArray): Pixel positions.
+        geometry (DetectorGeometry, optional): Detector geometry. Defaults to the configured one.
+    """
+    geometry = geometry if geometry is not None else get_geometry()
+    return geometry.q_from_distance(pixels - pixels[0])
+
 
-    config = load_config()
-    del_pixels = pixels - pixels[0]
-    del_two_theta = np.arctan2(config.param.dps, config.param.sdd * del_pixels)
-    return 4 * np.pi / config.param.wavelength * np.sin(del_two_theta / 2)
+def mul_delta_q(pixels: npt.NDArray, geometry: Optional[DetectorGeometry] = None) -> npt.NDArray:
+    """
+    Convert pixel displacements to momentum transfer with the exact q of one pixel.
 
+    delta_q = 4 * pi / wavelength * sin(arctan(dps / sdd) / 2)
 
-def mul_delta_q(pixels: npt.NDArray) -> npt.NDArray:
-    config = load_config()
-    two_theta = np.arctan2(config.param.dps, config.param.sdd)
-    delta_q = (4 * np.pi / config.param.wavelength) * (two_theta)
-    return pixels * delta_q
+    Parameters:
+        pixels (npt.NDArray): Pixel displacements, e.g. of a center of mass.
+        geometry (DetectorGeometry, optional): Detector geometry. Defaults to the configured one.
+    """
+    geometry = geometry if geometry is not None else get_geometry()
+    return pixels * geometry.q_per_pixel
 
 
-def pixel_to_q(pixels: npt.NDArray) -> npt.NDArray:
+def pixel_to_q(pixels: npt.NDArray, geometry: Optional[DetectorGeometry] = None) -> npt.NDArray:
     """
+    Convert distances from the beam center in pixels to momentum transfer.
+
     two_theta = arctan(dps * pixels / sdd)
     Q = (4 * pi / wavelength) * sin(two_theta / 2)
-      = (4 * pi / wavelength) * two_theta / 2
-      = (4 * pi / wavelength) * arctan(dps * pixels / sdd) / 2
-      = pixels * (4 * pi / wavelength) * arctan(dps / sdd) / 2
-    """
-    config = load_config()
 
-    two_theta = np.arctan2(config.param.dps, config.param.sdd * pixels)
-    return 4 * np.pi / config.param.wavelength * np.sin(two_theta / 2)
+    Parameters:
+        pixels (npt.NDArray): Distances from the beam center in pixels.
+        geometry (DetectorGeometry, optional): Detector geometry. Defaults to the configured one.
+    """
+    geometry = geometry if geometry is not None else get_geometry()
+    return geometry.q_from_distance(pixels)
 
 
 def get_min_max(arr: npt.NDArray) -> tuple[float, float]:
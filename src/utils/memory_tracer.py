@@ -0,0 +1,232 @@
+"""
+Opt-in memory tracing of the processing stages.
+
+`MemoryTracer` records, for every stage of every file, the peak of the memory traced by
+tracemalloc (numpy and Python allocations) above the level at the start of the stage, and the
+RSS before and after it (psutil), which also covers HDF5 and decompression buffers.
+Stages whose traced peak exceeds `peak_factor` times their input are logged as warnings.
+
+Stages are marked in the processing code with `trace_stage`, which does nothing unless a
+tracer is active, so the instrumentation costs nothing in normal runs:
+
+    with trace_stage("get_merged_df") as stage:
+        merged_df = self.get_merged_df(metadata)
+        stage.input_bytes = ...
+
+Example usage:
+    tracer = MemoryTracer(logger=logger)
+    processor = CoreProcessor(HDF5FileLoader, scan_dir, preprocessors, memory_tracer=tracer)
+    tracer.log_summary()
+    tracer.write_report("memory.json")
+"""
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from typing import TYPE_CHECKING, Any, Iterator, Optional
+
+import pandas as pd
+
+from src.logger import setup_logger, Logger
+
+if TYPE_CHECKING:
+    import psutil
+
+
+_active_tracer: Optional["MemoryTracer"] = None
+
+
+@dataclass
+class StageRecord:
+    """Memory use of one stage of one file. Sizes are in bytes."""
+    stage: str
+    file: Optional[str] = None
+    input_bytes: int = 0
+    traced_peak: int = 0
+    traced_retained: int = 0
+    rss_before: int = 0
+    rss_after: int = 0
+    max_rss: Optional[int] = None
+    seconds: float = 0.
+
+    @property
+    def rss_delta(self) -> int:
+        return self.rss_after - self.rss_before
+
+    @property
+    def peak_ratio(self) -> float:
+        """Traced peak as a multiple of the input, NaN if the input is unknown."""
+        return self.traced_peak / self.input_bytes if self.input_bytes else float("nan")
+
+    def to_dict(self) -> dict[str, Any]:
+        return {**asdict(self), "rss_delta": self.rss_delta, "peak_ratio": self.peak_ratio if self.input_bytes else None}
+
+
+def _max_rss(process: "psutil.Process") -> Optional[int]:
+    """Return the high-water mark of the RSS of the process, if the platform reports it."""
+    memory_info = process.memory_info()
+    if hasattr(memory_info, "peak_wset"):
+        return memory_info.peak_wset
+    try:
+        import resource
+    except ImportError:
+        return None
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryTracer:
+    """
+    Record the memory use of the stages marked with `trace_stage` while active.
+
+    Args:
+        peak_factor (float): Stages whose traced peak exceeds this multiple of their input are flagged.
+        logger (Logger, optional): Logger for the flagged stages and the summary.
+    """
+    def __init__(self, peak_factor: float = 3., logger: Optional[Logger] = None) -> None:
+        # Imported here, so that the untraced processing does not need psutil
+        import psutil  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+        self.peak_factor: float = peak_factor
+        self.logger: Logger = logger if logger is not None else setup_logger()
+        self.records: list[StageRecord] = []
+        self._process: "psutil.Process" = psutil.Process()
+        # (record, traced memory at the start, highest traced memory seen so far)
+        self._stack: list[list[Any]] = []
+        self._thread: Optional[int] = None
+        self._started_tracemalloc: bool = False
+        self._depth: int = 0
+
+    def __enter__(self) -> "MemoryTracer":
+        global _active_tracer  # pylint: disable=global-statement
+        if self._depth == 0:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+            self._thread = threading.get_ident()
+            _active_tracer = self
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        global _active_tracer  # pylint: disable=global-statement
+        self._depth -= 1
+        if self._depth:
+            return
+        _active_tracer = None
+        self._thread = None
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    @contextmanager
+    def stage(self, name: str, file: Optional[str] = None, input_bytes: int = 0) -> Iterator[StageRecord]:
+        """
+        Trace the block as stage `name`. The yielded record's `input_bytes` may be set inside the block.
+        Nested stages inherit `file` from the enclosing stage.
+        """
+        if file is None and self._stack:
+            file = self._stack[-1][0].file
+        record = StageRecord(name, file, input_bytes)
+
+        # The enclosing stages keep the peak reached so far, since the peak is reset for this one
+        current, peak = tracemalloc.get_traced_memory()
+        for entry in self._stack:
+            entry[2] = max(entry[2], peak)
+        tracemalloc.reset_peak()
+        record.rss_before = self._process.memory_info().rss
+        entry = [record, current, current]
+        self._stack.append(entry)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds = time.perf_counter() - start
+            current_end, peak = tracemalloc.get_traced_memory()
+            entry[2] = max(entry[2], peak)
+            self._stack.pop()
+            for outer in self._stack:
+                outer[2] = max(outer[2], entry[2])
+            tracemalloc.reset_peak()
+
+            record.traced_peak = entry[2] - entry[1]
+            record.traced_retained = current_end - entry[1]
+            record.rss_after = self._process.memory_info().rss
+            record.max_rss = _max_rss(self._process)
+            self.records.append(record)
+            if self.is_flagged(record):
+                self.logger.warning(
+                    f"Memory: stage '{record.stage}' peaked at {record.traced_peak / 1e6:.1f} MB, "
+                    f"{record.peak_ratio:.1f}x its input of {record.input_bytes / 1e6:.1f} MB ({record.file})"
+                )
+
+    def is_flagged(self, record: StageRecord) -> bool:
+        return record.input_bytes > 0 and record.traced_peak > self.peak_factor * record.input_bytes
+
+    def flagged(self) -> list[StageRecord]:
+        """Return the records whose traced peak exceeds `peak_factor` times their input."""
+        return [record for record in self.records if self.is_flagged(record)]
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame([record.to_dict() for record in self.records])
+
+    def summary(self) -> pd.DataFrame:
+        """Return the largest traced peak, RSS delta and peak ratio and the number of flagged files by stage."""
+        df = self.to_dataframe()
+        if df.empty:
+            return df
+        df["flagged"] = [self.is_flagged(record) for record in self.records]
+        summary = df.groupby("stage", sort=False).agg(
+            calls=("stage", "size"),
+            max_input_mb=("input_bytes", lambda v: v.max() / 1e6),
+            max_traced_peak_mb=("traced_peak", lambda v: v.max() / 1e6),
+            max_rss_delta_mb=("rss_delta", lambda v: v.max() / 1e6),
+            max_peak_ratio=("peak_ratio", "max"),
+            flagged=("flagged", "sum"),
+        )
+        return summary.sort_values("max_traced_peak_mb", ascending=False)
+
+    def log_summary(self) -> None:
+        """Write the summary by stage to the log."""
+        summary = self.summary()
+        if summary.empty:
+            self.logger.info("Memory: no stages were traced")
+            return
+        max_rss = max((record.max_rss or 0 for record in self.records), default=0)
+        self.logger.info(
+            f"Memory by stage (peak RSS {max_rss / 1e6:.1f} MB, flagged above {self.peak_factor}x the input):\n"
+            f"{summary.to_string(float_format=lambda v: f'{v:.1f}')}"
+        )
+
+    def write_report(self, file: str) -> None:
+        """Write every record, the summary and the flagged records as JSON."""
+        summary = self.summary()
+        report = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "peak_factor": self.peak_factor,
+            "summary": json.loads(summary.reset_index().to_json(orient="records")) if not summary.empty else [],
+            "flagged": [record.to_dict() for record in self.flagged()],
+            "records": [record.to_dict() for record in self.records],
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+        with open(file, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+@contextmanager
+def trace_stage(name: str, file: Optional[str] = None, input_bytes: int = 0) -> Iterator[StageRecord]:
+    """
+    Trace the block as stage `name` with the active `MemoryTracer`.
+
+    Without an active tracer, or in another thread than the one that activated it,
+    the block runs untraced and the yielded record is discarded.
+    """
+    tracer = _active_tracer
+    if tracer is None or tracer._thread != threading.get_ident():  # pylint: disable=protected-access
+        yield StageRecord(name, file, input_bytes)
+        return
+    with tracer.stage(name, file, input_bytes) as record:
+        yield record
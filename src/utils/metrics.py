@@ -0,0 +1,86 @@
+"""
+Structured metrics of the pipeline, written as JSON lines.
+
+Counters and timers are written through the enqueued metrics sink of `src.logger`
+to 'logs/{date}/{timestamp}.metrics.jsonl', one JSON object per line:
+
+    {"time": 1729292400.12, "pid": 4242, "kind": "timer", "name": "core.process_file", "value": 0.183, "file": "..."}
+
+A metric only costs a `json.dumps` in the calling thread; the file is written in the background.
+Totals by name are also kept in memory for summaries at the end of a run.
+
+Example usage:
+    with timer("core.process_file", file=hdf5_file):
+        ...
+    count("core.files_skipped", len(skipped))
+    logger.info(f"Metrics: {summary()}")
+"""
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+from src.logger import setup_logger, Logger, METRIC_KEY
+
+
+# Bound on the first metric, so that importing this module does not open log files
+_logger: Optional[Logger] = None
+_lock = threading.Lock()
+# name -> [number of metrics, sum of their values]
+_totals: defaultdict[str, list[float]] = defaultdict(lambda: [0, 0.])
+
+
+def emit(kind: str, name: str, value: float, **tags: Any) -> None:
+    """
+    Write one metric.
+
+    Parameters:
+    - kind (str): 'counter' or 'timer'.
+    - name (str): Dotted name of the metric, e.g. 'saver.save'.
+    - value (float): Increment of a counter, or seconds of a timer.
+    - tags: Extra JSON fields, e.g. the file or the run.
+    """
+    global _logger  # pylint: disable=global-statement
+    record = {"time": time.time(), "pid": os.getpid(), "kind": kind, "name": name, "value": value, **tags}
+    with _lock:
+        total = _totals[name]
+        total[0] += 1
+        total[1] += value
+        if _logger is None:
+            _logger = setup_logger().bind(**{METRIC_KEY: True})
+    _logger.debug(json.dumps(record, default=str))
+
+
+def count(name: str, value: float = 1, **tags: Any) -> None:
+    """Increment counter `name` by `value`."""
+    emit("counter", name, value, **tags)
+
+
+@contextmanager
+def timer(name: str, **tags: Any) -> Iterator[dict[str, Any]]:
+    """
+    Time the block as `name`. Fields added to the yielded dict inside the block are written as tags.
+    The metric is written even if the block raises, with `"error": true`.
+    """
+    start = time.perf_counter()
+    try:
+        yield tags
+    except BaseException:
+        tags["error"] = True
+        raise
+    finally:
+        emit("timer", name, time.perf_counter() - start, **tags)
+
+
+def summary() -> dict[str, dict[str, float]]:
+    """Return the number of metrics and the sum of their values by name, since the start or `reset`."""
+    with _lock:
+        return {name: {"n": n, "total": total} for name, (n, total) in sorted(_totals.items())}
+
+
+def reset() -> None:
+    with _lock:
+        _totals.clear()
@@ -0,0 +1,54 @@
+from typing import Iterable
+
+import numpy as np
+import numpy.typing as npt
+from roi_rectangle import RoiRectangle
+
+
+def union_roi_rect(roi_rects: Iterable[RoiRectangle]) -> RoiRectangle:
+    """
+    Return the smallest rectangle containing every given ROI.
+
+    Parameters:
+        roi_rects (Iterable[RoiRectangle]): ROIs in detector coordinates.
+
+    Returns:
+        RoiRectangle: Bounding rectangle of the ROIs.
+    """
+    roi_rects = list(roi_rects)
+    if not roi_rects:
+        raise ValueError("At least one ROI is required")
+    return RoiRectangle(
+        x1=min(roi_rect.x1 for roi_rect in roi_rects),
+        y1=min(roi_rect.y1 for roi_rect in roi_rects),
+        x2=max(roi_rect.x2 for roi_rect in roi_rects),
+        y2=max(roi_rect.y2 for roi_rect in roi_rects),
+    )
+
+
+def shift_roi_rect(roi_rect: RoiRectangle, dx: int, dy: int) -> RoiRectangle:
+    """Return `roi_rect` translated by (dx, dy)."""
+    return RoiRectangle(
+        x1=roi_rect.x1 + dx,
+        y1=roi_rect.y1 + dy,
+        x2=roi_rect.x2 + dx,
+        y2=roi_rect.y2 + dy,
+    )
+
+
+def to_local_roi_rect(roi_rect: RoiRectangle, crop_rect: RoiRectangle) -> RoiRectangle:
+    """Convert a ROI in detector coordinates to coordinates of images cropped by `crop_rect`."""
+    return shift_roi_rect(roi_rect, -crop_rect.x1, -crop_rect.y1)
+
+
+def roi_rects_to_array(roi_rects: Iterable[RoiRectangle]) -> npt.NDArray[np.int64]:
+    """Return ROIs as an (N, 4) array of (x1, y1, x2, y2)."""
+    return np.array(
+        [[roi_rect.x1, roi_rect.y1, roi_rect.x2, roi_rect.y2] for roi_rect in roi_rects],
+        dtype=np.int64
+    ).reshape(-1, 4)
+
+
+def array_to_roi_rects(array: npt.NDArray) -> list[RoiRectangle]:
+    """Inverse of `roi_rects_to_array`."""
+    return [RoiRectangle(x1=int(x1), y1=int(y1), x2=int(x2), y2=int(y2)) for x1, y1, x2, y2 in array]